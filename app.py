@@ -3,10 +3,17 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import mido
+from mido.frozen import freeze_message, thaw_message
+from mido.midifiles.meta import encode_variable_int, meta_charset
+from mido.midifiles.tracks import fix_end_of_track
 import random
 import numpy as np
 import io
+import itertools
 import base64
+import math
+import heapq
+import struct
 from collections import defaultdict
 
 # --- Configurazione della Pagina ---
@@ -52,26 +59,19 @@ def get_scale_notes(scale_name):
     }
     return scales.get(scale_name, scales["Cromatica"])
 
-def extract_notes(track, ticks_per_beat=384):
-    """Helper per estrarre note e il loro tempo assoluto da una traccia."""
-    notes = []
-    active_notes = {}
-    current_abs_time = 0
-    for msg in track:
-        current_abs_time += msg.time
-        if msg.type == 'note_on' and msg.velocity > 0:
-            active_notes[(msg.note, msg.channel)] = {'start': current_abs_time, 'velocity': msg.velocity}
-        elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-            key = (msg.note, msg.channel)
-            if key in active_notes:
-                start_data = active_notes.pop(key)
-                notes.append({'start': start_data['start'], 'end': current_abs_time, 'pitch': msg.note, 'velocity': start_data['velocity'], 'channel': key[1]})
-    # Note rimaste aperte senza note_off — chiuse con durata stimata di 1 beat
-    # invece di usare current_abs_time che creerebbe note lunghissime
-    for key, start_data in active_notes.items():
-        estimated_end = start_data['start'] + ticks_per_beat  # 1 beat di default
-        notes.append({'start': start_data['start'], 'end': estimated_end, 'pitch': key[0], 'velocity': start_data['velocity'], 'channel': key[1]})
-    return notes
+def extract_notes(track, ticks_per_beat=384, policy="FIFO"):
+    """
+    Helper per estrarre note e il loro tempo assoluto da una traccia.
+    L'abbinamento note_on/note_off e' quello ad array di extract_note_table:
+    code per (canale, pitch) con policy "FIFO" (default) o "LIFO", quindi note
+    sovrapposte sullo stesso pitch non si sovrascrivono. Restituisce i dict
+    in ordine di attacco; le note rimaste aperte sono chiuse con durata
+    stimata di 1 beat invece di arrivare a fine traccia.
+    """
+    table = extract_note_table(track, ticks_per_beat, policy)
+    columns = [table[name].tolist() for name in ('start', 'end', 'pitch', 'velocity', 'channel')]
+    return [{'start': start, 'end': end, 'pitch': pitch, 'velocity': velocity, 'channel': channel}
+            for start, end, pitch, velocity, channel in zip(*columns)]
 
 
 def _extract_instrument_header(track):
@@ -124,75 +124,1482 @@ def reconstruct_track(notes, ticks_per_beat):
         last_abs_time = event['abs_time']
     return new_track
 
-# --- Costas Array Utilities (costruzione di Welch, GF(p)) ---
+# --- Tracce condivise (copy-on-write) ---
+# Le tracce che uno stadio non modifica passano allo stadio successivo (e ai
+# risultati in cache) per riferimento. Per garantire che nessuno stadio
+# alteri l'input di un altro, le tracce condivise sono in sola lettura e i
+# loro messaggi congelati (mido.frozen): chi deve modificarle le materializza.
+
+class SharedTrack(mido.MidiTrack):
+    """
+    MidiTrack in sola lettura condivisa tra stadi della pipeline. Ogni
+    mutazione della lista (append, insert, assegnazione, nome, ...) solleva
+    TypeError: lo stadio che vuole modificarla chiama writable_track().
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Traccia condivisa in sola lettura: materializzala con writable_track() prima di modificarla.")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+
+    @property
+    def name(self):
+        return mido.MidiTrack.name.fget(self)
+
+    @name.setter
+    def name(self, name):
+        self._read_only()
+
+    def __reduce__(self):
+        # il pickle di default ricostruisce la lista con append
+        return (self.__class__, (list(self),), dict(vars(self)))
+
+
+def share_track(track):
+    """
+    Versione condivisibile di una traccia: la stessa SharedTrack se lo e'
+    gia' (nessuna copia), altrimenti una SharedTrack con i messaggi congelati.
+    """
+    if isinstance(track, SharedTrack):
+        return track
+    return SharedTrack(freeze_message(msg) for msg in track)
+
+
+def share_tracks(midi):
+    """Rende condivise (share_track) tutte le tracce di un MidiFile, sul posto, e lo restituisce."""
+    midi.tracks = [share_track(track) for track in midi.tracks]
+    return midi
+
+
+def writable_track(track):
+    """
+    Materializza una traccia in una MidiTrack nuova e modificabile. I
+    messaggi di canale restano quelli condivisi (immutabili: si cambiano
+    solo con msg.copy), i meta vengono scongelati perche' MidiTrack.name li
+    modifica sul posto.
+    """
+    return mido.MidiTrack(thaw_message(msg) if msg.is_meta else msg for msg in track)
+
+
+# --- Tracce generate in streaming ---
+# I generatori lunghi (Eno, Reich, Xenakis, Costas) producono le note in
+# ordine di attacco con generatori Python pigri invece di liste complete di
+# eventi; quelli vettoriali (Eno, Reich) costruiscono gli array numpy a
+# blocchi di circa STREAM_CHUNK_NOTES note. LazyTrack le converte in
+# messaggi solo mentre vengono scritte (save_midi_file), quindi la memoria
+# dipende dal blocco e dalla polifonia, non dalla durata del render.
+
+STREAM_CHUNK_NOTES = 4096
+
+
+def _note_chunks_to_stream(chunks, channel):
+    """Note (start, end, pitch, velocity, channel) da blocchi di colonne numpy gia' in ordine di attacco, un blocco alla volta."""
+    for start, end, pitch, velocity in chunks:
+        for s, e, p, v in zip(start.tolist(), end.tolist(), pitch.tolist(), velocity.tolist()):
+            yield s, e, p, v, channel
+
+
+def _merge_note_stream(notes):
+    """
+    Converte un iteratore di note (start, end, pitch, velocity, channel) in
+    ordine di attacco in eventi (tick, tipo, pitch, velocity, channel) in
+    ordine di tempo, con i note_off prima dei note_on allo stesso tick. Le
+    note ancora aperte stanno in un heap, quindi la memoria e' limitata alla
+    polifonia.
+    """
+    pending = []
+    for seq, (start, end, pitch, velocity, channel) in enumerate(notes):
+        while pending and pending[0][0] <= start:
+            off_tick, _, off_pitch, off_channel = heapq.heappop(pending)
+            yield off_tick, 'note_off', off_pitch, 0, off_channel
+        yield start, 'note_on', pitch, velocity, channel
+        heapq.heappush(pending, (end, seq, pitch, channel))
+    while pending:
+        off_tick, _, off_pitch, off_channel = heapq.heappop(pending)
+        yield off_tick, 'note_off', off_pitch, 0, off_channel
+
+
+class LazyTrack:
+    """
+    Traccia generata al volo: nome, messaggi di testa (program_change, ...) e
+    una funzione che restituisce ogni volta un nuovo iteratore di note in
+    ordine di attacco. Iterarla produce i messaggi mido con i delta, senza
+    mai tenere l'intera traccia in memoria; ogni iterazione rigenera le
+    stesse note (i generatori ricreano il proprio RNG dal seed).
+    """
+    def __init__(self, name, header, make_notes):
+        self._name = name
+        self._header = list(header)
+        self._make_notes = make_notes
+
+    @property
+    def name(self):
+        return self._name
+
+    def __iter__(self):
+        yield mido.MetaMessage('track_name', name=self._name, time=0)
+        yield from self._header
+        last = 0
+        for tick, kind, pitch, velocity, channel in _merge_note_stream(self._make_notes()):
+            yield mido.Message(kind, skip_checks=True, note=pitch, velocity=velocity, channel=channel, time=tick - last)
+            last = tick
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def materialize(self):
+        """MidiTrack completa in memoria con gli stessi messaggi."""
+        return mido.MidiTrack(self)
+
+
+def _generated_track(name, header, make_notes, streaming):
+    """LazyTrack (streaming=True) oppure la stessa traccia materializzata in una MidiTrack."""
+    track = LazyTrack(name, header, make_notes)
+    return track if streaming else track.materialize()
+
+
+def save_midi_file(midi, file, note_off_as_note_on=False):
+    """
+    Salva midi su un file binario seekable (file su disco o BytesIO) traccia
+    per traccia e messaggio per messaggio, con running status come mido. Le
+    LazyTrack vengono consumate in streaming; la lunghezza di ogni chunk
+    MTrk viene scritta a fine traccia tornando indietro nel file. Con
+    note_off_as_note_on i note_off sono scritti come note_on a velocity 0
+    (la velocity di rilascio si perde), cosi' il running status non si
+    interrompe tra attacchi e rilasci dello stesso canale.
+    """
+    with meta_charset(midi.charset):
+        file.write(b'MThd' + struct.pack('>LhhH', 6, midi.type, len(midi.tracks), midi.ticks_per_beat))
+        for track in midi.tracks:
+            chunk_start = file.tell()
+            file.write(b'MTrk\x00\x00\x00\x00')
+            length = 0
+            data = bytearray()
+            running_status = None
+            for msg in fix_end_of_track(track):
+                data.extend(encode_variable_int(msg.time))
+                if msg.is_meta:
+                    data.extend(msg.bytes())
+                    running_status = None
+                elif msg.type == 'sysex':
+                    data.append(0xf0)
+                    data.extend(encode_variable_int(len(msg.data) + 1))
+                    data.extend(msg.data)
+                    data.append(0xf7)
+                    running_status = None
+                else:
+                    msg_bytes = msg.bytes()
+                    if note_off_as_note_on and msg.type == 'note_off':
+                        msg_bytes = [0x90 | msg.channel, msg.note, 0]
+                    data.extend(msg_bytes[1:] if msg_bytes[0] == running_status else msg_bytes)
+                    running_status = msg_bytes[0] if msg_bytes[0] < 0xf0 else None
+                if len(data) >= 1 << 16:
+                    file.write(data)
+                    length += len(data)
+                    data.clear()
+            file.write(data)
+            length += len(data)
+            chunk_end = file.tell()
+            file.seek(chunk_start + 4)
+            file.write(struct.pack('>L', length))
+            file.seek(chunk_end)
+    return file
+
+
+# --- Helper vettoriali (NumPy) ---
+# Le trasformazioni a livello di messaggio lavorano su colonne NumPy (tick
+# assoluti, flag note_on/note_off, chiave canale*128+pitch) invece di
+# ricalcolare somme correnti e dizionari di note aperte messaggio per messaggio.
+
+# Codici di tipo della MessageTable (-1 = meta / sysex / altro) e campi dati
+# data1/data2 di ciascun tipo di messaggio di canale.
+MESSAGE_TYPE_CODES = {'note_off': 0, 'note_on': 1, 'polytouch': 2, 'control_change': 3,
+                      'program_change': 4, 'aftertouch': 5, 'pitchwheel': 6}
+_MESSAGE_DATA_FIELDS = [('note', 'velocity'), ('note', 'velocity'), ('note', 'value'), ('control', 'value'),
+                        ('program', None), ('value', None), ('pitch', None)]
+
+
+def message_table(track):
+    """
+    MessageTable di una traccia: dict di colonne NumPy 'time' (delta),
+    'abs_tick' (np.cumsum), 'type' (MESSAGE_TYPE_CODES, -1 per meta/sysex),
+    'channel', 'data1', 'data2' (-1 se assenti) e 'msg' (colonna oggetto con
+    i messaggi originali, unica fonte per meta e sysex). Costruita in un solo
+    passaggio. Sulle SharedTrack (immutabili, messaggi congelati) viene
+    memorizzata sulla traccia e riusata dalle trasformazioni successive; le
+    tracce modificabili possono cambiare sul posto (track[i] = ...,
+    msg.time = ...) senza che la cache se ne accorga, quindi per loro la
+    tabella viene ricostruita a ogni chiamata. Le colonne sono in sola
+    lettura (copy-on-write).
+    """
+    table = getattr(track, '_message_table', None)
+    if table is not None:
+        return table
+
+    n = len(track)
+    time = np.empty(n, dtype=np.int64)
+    type_code = np.full(n, -1, dtype=np.int64)
+    channel = np.full(n, -1, dtype=np.int64)
+    data1 = np.full(n, -1, dtype=np.int64)
+    data2 = np.full(n, -1, dtype=np.int64)
+    msgs = np.empty(n, dtype=object)
+    rows = []
+    for i, msg in enumerate(track):
+        code = MESSAGE_TYPE_CODES.get(msg.type, -1)
+        if code >= 0:
+            d = vars(msg)
+            first, second = _MESSAGE_DATA_FIELDS[code]
+            rows.append((i, code, d['channel'], d[first], d[second] if second else -1))
+    msgs[:] = list(track)
+    time[:] = [msg.time for msg in track]
+    if rows:
+        idx, codes, chans, d1, d2 = (np.array(col, dtype=np.int64) for col in zip(*rows))
+        type_code[idx], channel[idx], data1[idx], data2[idx] = codes, chans, d1, d2
+
+    table = {'time': time, 'abs_tick': np.cumsum(time), 'type': type_code, 'channel': channel,
+             'data1': data1, 'data2': data2, 'msg': msgs}
+    # colonne condivise in sola lettura: chi le modifica ne fa una copia
+    for column in table.values():
+        column.flags.writeable = False
+    if isinstance(track, SharedTrack):
+        track._message_table = table
+    return table
+
+
+def _message_table_to_track(new_track, table, order=None, abs_tick=None, data1=None, data2=None):
+    """
+    Scrive in new_track i messaggi di una MessageTable nell'ordine order
+    (default: quello originale). abs_tick, data1 e data2 sono le sole colonne
+    che la trasformazione ha cambiato (None = invariata): i messaggi di
+    canale in cui nessun valore cambia sono riusati cosi' come sono
+    (copy-on-write), gli altri copiati con skip_checks; i meta sono sempre
+    copiati e scongelati, perche' MidiTrack.name li modifica sul posto.
+    """
+    n = table['msg'].size
+    rows = np.arange(n) if order is None else np.asarray(order, dtype=np.int64)
+    ticks = (table['abs_tick'] if abs_tick is None else np.asarray(abs_tick))[rows]
+    deltas = np.diff(ticks, prepend=0)
+    d1 = table['data1'][rows] if data1 is None else np.asarray(data1)[rows]
+    d2 = table['data2'][rows] if data2 is None else np.asarray(data2)[rows]
+    codes = table['type'][rows]
+    changed = ((deltas != table['time'][rows]) | (d1 != table['data1'][rows])
+               | (d2 != table['data2'][rows]) | (codes < 0))
+    out = table['msg'][rows].tolist()
+    for j in np.flatnonzero(changed).tolist():
+        msg, code = out[j], int(codes[j])
+        if code < 0:
+            out[j] = thaw_message(msg).copy(time=int(deltas[j]))
+            continue
+        first, second = _MESSAGE_DATA_FIELDS[code]
+        overrides = {'time': int(deltas[j]), first: int(d1[j])}
+        if second:
+            overrides[second] = int(d2[j])
+        out[j] = msg.copy(skip_checks=True, **overrides)
+    new_track.extend(out)
+    return new_track
+
+
+def _track_note_columns(track):
+    """
+    Colonne per-messaggio di una traccia: tick assoluto (np.cumsum dei delta),
+    maschere note_on (velocity > 0) / note_off (incluso note_on a velocity 0)
+    e chiave nota canale*128+pitch (-1 per i messaggi che non sono note).
+    Derivate dalla MessageTable in cache (message_table).
+    """
+    table = message_table(track)
+    code = table['type']
+    is_note = (code == MESSAGE_TYPE_CODES['note_on']) | (code == MESSAGE_TYPE_CODES['note_off'])
+    is_on = (code == MESSAGE_TYPE_CODES['note_on']) & (table['data2'] > 0)
+    is_off = is_note & ~is_on
+    keys = np.where(is_note, table['channel'] * 128 + table['data1'], -1)
+    return table['abs_tick'], is_on, is_off, keys
+
+
+def _ragged_arange(counts):
+    """Concatenazione di arange(c) per ogni c in counts, senza loop Python."""
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    return np.arange(total, dtype=np.int64) - np.repeat(starts, counts)
+
+
+def _pair_note_events(keys, is_on, is_off, policy="FIFO"):
+    """
+    Accoppia note_on e note_off con la stessa chiave (canale, pitch) in modo
+    vettoriale. I note_off orfani (nessuna nota aperta su quella chiave)
+    vengono ignorati. Con policy "FIFO" il k-esimo note_off chiude la nota
+    aperta da piu' tempo; con "LIFO" chiude l'ultima aperta.
+    Ritorna (on_pos, off_pos): posizioni dei note_on nell'array originale e,
+    per ciascuno, la posizione del note_off abbinato (-1 se resta aperto).
+    """
+    idx = np.flatnonzero(is_on | is_off)
+    if idx.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    order = np.argsort(keys[idx], kind='stable')
+    idx = idx[order]
+    k = keys[idx]
+    on = is_on[idx]
+    big = 2 * idx.size + 2
+
+    def _group_ids(k):
+        first = np.empty(k.size, dtype=bool)
+        first[:1] = True
+        first[1:] = k[1:] != k[:-1]
+        return first, np.cumsum(first) - 1
+
+    # Conteggio note aperte per chiave; un note_off che porta il conteggio
+    # sotto il minimo precedente (e sotto zero) e' orfano.
+    first, grp = _group_ids(k)
+    step = np.where(on, 1, -1)
+    run = np.cumsum(step)
+    run = run - (run - step)[first][grp]
+    low = np.minimum(np.minimum.accumulate(run - grp * big) + grp * big, 0)
+    prev_low = np.empty_like(low)
+    prev_low[1:] = low[:-1]
+    prev_low[first] = 0
+    valid = on | (low >= prev_low)
+    idx, k, on = idx[valid], k[valid], on[valid]
+    first, grp = _group_ids(k)
+
+    if policy == "LIFO":
+        # Profondita' di annidamento: note_on e note_off allo stesso livello
+        # di una chiave si alternano, quindi ogni on e' chiuso dall'off successivo.
+        step = np.where(on, 1, -1)
+        run = np.cumsum(step)
+        run = run - (run - step)[first][grp]
+        level = np.where(on, run, run + 1)
+        lv_order = np.lexsort((level, grp))
+        idx_l, on_l = idx[lv_order], on[lv_order]
+        grp_l, level_l = grp[lv_order], level[lv_order]
+        nxt_ok = np.zeros(idx_l.size, dtype=bool)
+        nxt_ok[:-1] = on_l[:-1] & ~on_l[1:] & (grp_l[:-1] == grp_l[1:]) & (level_l[:-1] == level_l[1:])
+        off_of = np.full(idx_l.size, -1, dtype=np.int64)
+        off_of[:-1][nxt_ok[:-1]] = idx_l[1:][nxt_ok[:-1]]
+        on_pos, off_pos = idx_l[on_l], off_of[on_l]
+        ord_out = np.argsort(on_pos, kind='stable')
+        return on_pos[ord_out], off_pos[ord_out]
+
+    # FIFO: il k-esimo note_on di una chiave e' chiuso dal k-esimo note_off.
+    group_start = np.flatnonzero(first)
+    on_rank = np.cumsum(on) - 1
+    off_rank = np.cumsum(~on) - 1
+    on_rank = on_rank - (np.cumsum(on) - on)[group_start][grp]
+    off_rank = off_rank - (np.cumsum(~on) - ~on)[group_start][grp]
+    on_key = (grp * big + on_rank)[on]
+    off_key = (grp * big + off_rank)[~on]
+    on_pos = idx[on]
+    off_idx = idx[~on]
+    found = np.searchsorted(off_key, on_key)
+    found_c = np.minimum(found, max(off_key.size - 1, 0))
+    matched = (found < off_key.size) & (off_key[found_c] == on_key) if off_key.size else np.zeros(on_key.size, dtype=bool)
+    off_pos = np.where(matched, off_idx[found_c] if off_idx.size else -1, -1)
+    ord_out = np.argsort(on_pos, kind='stable')
+    return on_pos[ord_out], off_pos[ord_out]
+
+
+# --- Indice temporale (tempo map e metrica) ---
+# set_tempo e time_signature di tutte le tracce raccolti in un solo passaggio
+# sulle MessageTable: conversioni tick -> secondi e tick <-> battuta/beat in
+# blocco con ricerca binaria sui punti di cambio, senza riscandire i
+# messaggi come MidiFile.length.
+
+DEFAULT_TEMPO = 500000  # microsecondi per beat (120 BPM), come mido
+
+
+def build_time_index(midi):
+    """
+    Indice temporale del file, in cache: 'end_tick' (fine dell'ultima
+    traccia), tempo map ('tempo_ticks', 'tempos', 'tempo_seconds' = secondi
+    all'inizio di ogni tempo), cambi di metrica dichiarati ('ts_ticks',
+    'ts_num', 'ts_den'; a parita' di tick vale l'ultima traccia, come in
+    _meter_grid), segmenti di battuta per la metrica del file con 4/4 dove
+    non dichiarata ('seg_ticks', 'seg_bar_len', 'seg_beat_len',
+    'seg_first_bar') e 'duration' in secondi.
+    """
+    cache = _midi_cache(midi)
+    if 'time_index' in cache:
+        return cache['time_index']
+
+    tpb = midi.ticks_per_beat
+    end_tick = 0
+    tempo_changes = {}
+    ts_changes = {}
+    for track in midi.tracks:
+        table = message_table(track)
+        if table['abs_tick'].size:
+            end_tick = max(end_tick, int(table['abs_tick'][-1]))
+        for row in np.flatnonzero(table['type'] < 0):
+            msg = table['msg'][row]
+            if msg.type == 'set_tempo':
+                tempo_changes.setdefault(int(table['abs_tick'][row]), []).append(msg.tempo)
+            elif msg.type == 'time_signature':
+                ts_changes[int(table['abs_tick'][row])] = (msg.numerator, msg.denominator)
+
+    # allo stesso tick vale l'ultimo set_tempo nell'ordine di merge (traccia, posizione)
+    tempo_ticks = np.array(sorted(set(tempo_changes) | {0}), dtype=np.int64)
+    tempos = np.array([tempo_changes[t][-1] if t in tempo_changes else DEFAULT_TEMPO for t in tempo_ticks.tolist()], dtype=float)
+    seconds_per_tick = tempos * 1e-6 / tpb
+    tempo_seconds = np.concatenate([[0.0], np.cumsum(np.diff(tempo_ticks) * seconds_per_tick[:-1])])
+
+    ts_ticks = np.array(sorted(ts_changes), dtype=np.int64)
+    file_meter = dict(ts_changes)
+    file_meter.setdefault(0, (4, 4))
+    seg_ticks = np.array(sorted(file_meter), dtype=np.int64)
+    seg_meter = np.array([file_meter[t] for t in seg_ticks.tolist()], dtype=np.int64).reshape(-1, 2)
+    seg_bar_len = np.maximum(1, np.rint(tpb * 4 * seg_meter[:, 0] / seg_meter[:, 1])).astype(np.int64)
+    seg_bars = -(-np.diff(seg_ticks) // seg_bar_len[:-1])  # battute (anche troncate) di ogni segmento
+    index = {
+        'end_tick': end_tick,
+        'tempo_ticks': tempo_ticks,
+        'tempos': tempos,
+        'tempo_seconds': tempo_seconds,
+        'ts_ticks': ts_ticks,
+        'ts_num': np.array([ts_changes[t][0] for t in ts_ticks.tolist()], dtype=np.int64),
+        'ts_den': np.array([ts_changes[t][1] for t in ts_ticks.tolist()], dtype=np.int64),
+        'seg_ticks': seg_ticks,
+        'seg_num': seg_meter[:, 0],
+        'seg_den': seg_meter[:, 1],
+        'seg_bar_len': seg_bar_len,
+        'seg_beat_len': tpb * 4 / seg_meter[:, 1],
+        'seg_first_bar': np.concatenate([[0], np.cumsum(seg_bars)]).astype(np.int64),
+    }
+    index['duration'] = float(_ticks_to_seconds(index, tpb, end_tick))
+    cache['time_index'] = index
+    return index
+
+
+def _ticks_to_seconds(index, tpb, ticks):
+    ticks = np.asarray(ticks, dtype=np.int64)
+    seg = np.maximum(np.searchsorted(index['tempo_ticks'], ticks, side='right') - 1, 0)
+    return index['tempo_seconds'][seg] + (ticks - index['tempo_ticks'][seg]) * index['tempos'][seg] * 1e-6 / tpb
+
+
+def ticks_to_seconds(midi, ticks):
+    """Secondi dall'inizio per tick assoluti (scalare o array), seguendo la tempo map."""
+    return _ticks_to_seconds(build_time_index(midi), midi.ticks_per_beat, ticks)
+
+
+def ticks_to_bar_beat(midi, ticks):
+    """
+    (battuta, beat) per tick assoluti secondo la metrica del file (4/4 dove
+    non dichiarata): battuta contata da 0, beat da 0 in unita' del
+    denominatore, frazionario tra un beat e l'altro.
+    """
+    index = build_time_index(midi)
+    ticks = np.asarray(ticks, dtype=np.int64)
+    seg = np.maximum(np.searchsorted(index['seg_ticks'], ticks, side='right') - 1, 0)
+    offset = ticks - index['seg_ticks'][seg]
+    bars_in = offset // index['seg_bar_len'][seg]
+    beat = (offset - bars_in * index['seg_bar_len'][seg]) / index['seg_beat_len'][seg]
+    return index['seg_first_bar'][seg] + bars_in, beat
+
+
+def bar_beat_to_ticks(midi, bars, beats=0):
+    """Tick assoluti dell'inizio di una battuta (da 0) piu' beats, inversa di ticks_to_bar_beat."""
+    index = build_time_index(midi)
+    bars = np.asarray(bars, dtype=np.int64)
+    seg = np.maximum(np.searchsorted(index['seg_first_bar'], bars, side='right') - 1, 0)
+    bar_start = index['seg_ticks'][seg] + (bars - index['seg_first_bar'][seg]) * index['seg_bar_len'][seg]
+    return np.rint(bar_start + np.asarray(beats) * index['seg_beat_len'][seg]).astype(np.int64)
+
+
+def _meter_grid(midi, end_tick, default_meter=(4, 4), follow_file=True):
+    """
+    Griglia di battute da 0 fino a oltre end_tick: (inizi, numeratori,
+    denominatori) come array NumPy. Con follow_file segue i time_signature
+    presenti in qualunque traccia del file (dall'indice temporale);
+    default_meter vale dove il file non ne dichiara (da tick 0). L'ultimo
+    inizio e' sempre > end_tick, cosi' ogni battuta ha una fine.
+    """
+    tpb = midi.ticks_per_beat
+    changes = {}
+    if follow_file:
+        index = build_time_index(midi)
+        changes = {t: (num, den) for t, num, den in zip(index['ts_ticks'].tolist(), index['ts_num'].tolist(), index['ts_den'].tolist())}
+    if 0 not in changes:
+        changes[0] = tuple(default_meter)
+    change_ticks = sorted(changes)
+    segments = []
+    for i, t in enumerate(change_ticks):
+        num, den = changes[t]
+        bar_len = max(1, int(round(tpb * 4 * num / den)))
+        seg_end = change_ticks[i + 1] if i + 1 < len(change_ticks) else max(t, end_tick) + bar_len + 1
+        segments.append(np.arange(t, seg_end, bar_len, dtype=np.int64))
+    bar_starts = np.unique(np.concatenate(segments))
+    meter_idx = np.searchsorted(np.asarray(change_ticks), bar_starts, side='right') - 1
+    meters = np.array([changes[t] for t in change_ticks], dtype=np.int64)
+    return bar_starts, meters[meter_idx, 0], meters[meter_idx, 1]
+
+
+def _bar_grid_ticks(midi, end_tick):
+    """
+    Inizi di battuta (tick assoluti) da 0 fino a oltre end_tick, seguendo i
+    time_signature presenti in qualunque traccia del file (4/4 se assenti),
+    dall'indice temporale: la battuta di end_tick (ticks_to_bar_beat) e gli
+    inizi delle battute fino alla successiva (bar_beat_to_ticks). L'ultimo
+    valore e' sempre > end_tick, cosi' ogni battuta ha una fine.
+    """
+    last_bar = int(ticks_to_bar_beat(midi, max(int(end_tick), 0))[0])
+    return bar_beat_to_ticks(midi, np.arange(last_bar + 2))
+
+def extract_note_table(track, ticks_per_beat=384, policy="FIFO"):
+    """
+    Versione ad array di extract_notes: dict di colonne NumPy 'start', 'end',
+    'pitch', 'velocity', 'channel', in ordine di attacco. Le note rimaste
+    aperte vengono chiuse con durata stimata di 1 beat, come in extract_notes.
+    'on_row'/'off_row' sono gli indici dei messaggi nella traccia (-1 se la
+    nota non ha note_off).
+    """
+    abs_ticks, is_on, is_off, keys = _track_note_columns(track)
+    on_pos, off_pos = _pair_note_events(keys, is_on, is_off, policy)
+    start = abs_ticks[on_pos]
+    end = np.where(off_pos >= 0, abs_ticks[np.maximum(off_pos, 0)], start + ticks_per_beat)
+    return {
+        'start': start,
+        'end': end,
+        'pitch': keys[on_pos] % 128,
+        'velocity': message_table(track)['data2'][on_pos],
+        'channel': keys[on_pos] // 128,
+        'on_row': on_pos,
+        'off_row': off_pos,
+    }
+
+
+def _note_arrays_to_track(new_track, start, end, pitch, velocity, channel):
+    """
+    Scrive note date come colonne NumPy in new_track: coppie note_on/note_off
+    ordinate per tick assoluto (note_off prima di note_on allo stesso tick),
+    delta ricavati con np.diff. I valori arrivano da array gia' nei range
+    MIDI, quindi i messaggi sono costruiti con skip_checks=True. Ogni nota
+    dura almeno 1 tick: con start == end il suo note_off finirebbe prima
+    del proprio note_on e la nota resterebbe appesa.
+    """
+    n = len(start)
+    if n == 0:
+        return new_track
+    start = np.asarray(start, dtype=np.int64)
+    end = np.maximum(np.asarray(end, dtype=np.int64), start + 1)
+    ticks = np.concatenate([start, end])
+    is_on = np.concatenate([np.ones(n, dtype=bool), np.zeros(n, dtype=bool)])
+    note_idx = np.concatenate([np.arange(n), np.arange(n)])
+    order = np.lexsort((is_on, ticks))
+    deltas = np.diff(ticks[order], prepend=0)
+    pitch = np.asarray(pitch, dtype=np.int64).tolist()
+    velocity = np.asarray(velocity, dtype=np.int64).tolist()
+    channel = np.asarray(channel, dtype=np.int64).tolist()
+    for i, on, d in zip(note_idx[order].tolist(), is_on[order].tolist(), deltas.tolist()):
+        if on:
+            new_track.append(mido.Message('note_on', skip_checks=True, note=pitch[i], velocity=velocity[i], channel=channel[i], time=d))
+        else:
+            new_track.append(mido.Message('note_off', skip_checks=True, note=pitch[i], velocity=0, channel=channel[i], time=d))
+    return new_track
+
+
+# --- Ricampionamento della risoluzione (PPQ) ---
+# File con ticks_per_beat molto alti (fino a 15360) portano delta enormi in
+# tutte le trasformazioni e nei file esportati. Il ricampionamento converte i
+# tick assoluti della MessageTable alla nuova risoluzione con un arrotondamento
+# intero vettoriale; tempo e metrica non cambiano (set_tempo e' in
+# microsecondi per beat). Si applica al caricamento (load_midi_file) o
+# all'esportazione.
+
+RESAMPLE_PPQ_CHOICES = (96, 120, 192, 240, 384, 480, 960)
+# tipi di messaggio di cui allo stesso tick conta solo l'ultimo valore
+_COALESCE_TYPE_CODES = (MESSAGE_TYPE_CODES['polytouch'], MESSAGE_TYPE_CODES['control_change'],
+                        MESSAGE_TYPE_CODES['program_change'], MESSAGE_TYPE_CODES['aftertouch'],
+                        MESSAGE_TYPE_CODES['pitchwheel'])
+# controller che non sono curve ma comandi o parti di una sequenza: bank
+# select (0, 32), data entry e incremento (6, 38, 96, 97), selettori NRPN / RPN
+# (98-101) e messaggi di modo del canale (120-127, All Notes Off, Reset All
+# Controllers, ...). Due valori allo stesso tick non si sostituiscono.
+STATEFUL_CONTROLLERS = np.array([0, 32, 6, 38, 96, 97, 98, 99, 100, 101] + list(range(120, 128)), dtype=np.int64)
+
+
+def resample_ticks(ticks, src_ppq, dst_ppq):
+    """Tick assoluti convertiti da src_ppq a dst_ppq, arrotondati al tick piu' vicino (meta' per eccesso)."""
+    ticks = np.asarray(ticks, dtype=np.int64)
+    return (ticks * (2 * dst_ppq) + src_ppq) // (2 * src_ppq)
+
+
+def resample_track(track, src_ppq, dst_ppq, coalesce=False):
+    """
+    MidiTrack nuova con i tick di track convertiti a dst_ppq. Le note che
+    avevano durata ma finirebbero lunghe 0 tick vengono allungate a 1 tick
+    (se la nota successiva sulla stessa chiave non lo impedisce). Con
+    coalesce, dei controller, pitchwheel, aftertouch e program_change che
+    cadono sullo stesso tick con lo stesso canale (e controller / nota)
+    resta solo l'ultimo, l'unico che si sente; i STATEFUL_CONTROLLERS (RPN,
+    NRPN, data entry, bank select, modo del canale) restano tutti.
+    """
+    table = message_table(track)
+    n = table['msg'].size
+    ticks = resample_ticks(table['abs_tick'], src_ppq, dst_ppq)
+    if n == 0:
+        return mido.MidiTrack()
+
+    abs_tick, is_on, is_off, keys = _track_note_columns(track)
+    on_pos, off_pos = _pair_note_events(keys, is_on, is_off)
+    on_pos, off_pos = on_pos[off_pos >= 0], off_pos[off_pos >= 0]
+    note_rows = np.flatnonzero(keys >= 0)
+    note_rows = note_rows[np.argsort(keys[note_rows], kind='stable')]
+    next_tick = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+    same_key = keys[note_rows[:-1]] == keys[note_rows[1:]]
+    next_tick[note_rows[:-1][same_key]] = ticks[note_rows[1:][same_key]]
+    bump = ((ticks[off_pos] == ticks[on_pos]) & (abs_tick[off_pos] > abs_tick[on_pos])
+            & (next_tick[off_pos] > ticks[off_pos]))
+    ticks[off_pos[bump]] += 1
+    if table['msg'][-1].type == 'end_of_track':
+        ticks[-1] = ticks.max()
+
+    keep = np.ones(n, dtype=bool)
+    if coalesce:
+        code = table['type']
+        rows = np.flatnonzero(np.isin(code, _COALESCE_TYPE_CODES)
+                              & ~((code == MESSAGE_TYPE_CODES['control_change']) & np.isin(table['data1'], STATEFUL_CONTROLLERS)))
+        target = np.where(np.isin(code[rows], (MESSAGE_TYPE_CODES['polytouch'], MESSAGE_TYPE_CODES['control_change'])),
+                          table['data1'][rows], -1)
+        group = np.stack([ticks[rows], code[rows], table['channel'][rows], target])
+        order = np.lexsort(group[::-1])
+        rows, group = rows[order], group[:, order]
+        superseded = np.all(group[:, :-1] == group[:, 1:], axis=0)
+        keep[rows[:-1][superseded]] = False
+
+    order = np.flatnonzero(keep)
+    order = order[np.argsort(ticks[order], kind='stable')]
+    return _message_table_to_track(mido.MidiTrack(), table, order=order, abs_tick=ticks)
+
+
+def resample_midi(midi, ticks_per_beat, coalesce=False):
+    """
+    Copia di midi alla risoluzione ticks_per_beat (resample_track per ogni
+    traccia). Le LazyTrack restano in streaming: le loro note vengono
+    convertite mentre sono generate. Con ticks_per_beat None la risoluzione
+    resta quella del file (con coalesce gli eventi vengono comunque uniti);
+    senza coalesce e senza cambio di risoluzione ritorna midi stesso.
+    """
+    src_ppq = midi.ticks_per_beat
+    ticks_per_beat = ticks_per_beat or src_ppq
+    if ticks_per_beat == src_ppq and not coalesce:
+        return midi
+    new_midi = mido.MidiFile(type=midi.type, ticks_per_beat=ticks_per_beat, charset=midi.charset)
+    for track in midi.tracks:
+        if isinstance(track, LazyTrack):
+            new_midi.tracks.append(LazyTrack(track.name, track._header,
+                                             lambda make_notes=track._make_notes: _resample_note_stream(make_notes(), src_ppq, ticks_per_beat)))
+        else:
+            new_midi.tracks.append(resample_track(track, src_ppq, ticks_per_beat, coalesce))
+    return new_midi
+
+
+def _resample_note_stream(notes, src_ppq, dst_ppq):
+    """Note (start, end, pitch, velocity, channel) in streaming convertite a dst_ppq, durata minima 1 tick."""
+    for start, end, pitch, velocity, channel in notes:
+        new_start = int(resample_ticks(start, src_ppq, dst_ppq))
+        yield new_start, max(int(resample_ticks(end, src_ppq, dst_ppq)), new_start + 1), pitch, velocity, channel
+
+
+# --- Ottimizzazione dell'output ---
+# Passaggio opzionale prima dell'esportazione: le note di ogni traccia
+# vengono riscritte dalle colonne di extract_note_table senza duplicati,
+# sovrapposizioni sulla stessa chiave, note di durata nulla e note_off
+# orfani; gli altri messaggi di canale vengono riportati nei range MIDI e
+# deduplicati. save_midi_file(..., note_off_as_note_on=True) completa la
+# compattazione scrivendo i note_off come note_on a velocity 0, cosi' il
+# running status copre anche i rilasci.
+
+# range (min, max) di data1 / data2 per ogni codice di MESSAGE_TYPE_CODES (None = campo assente)
+_MESSAGE_DATA_RANGES = [((0, 127), (0, 127)), ((0, 127), (0, 127)), ((0, 127), (0, 127)), ((0, 127), (0, 127)),
+                        ((0, 127), None), ((0, 127), None), ((-8192, 8191), None)]
+
+
+def merge_note_overlaps(start, end, pitch, velocity, channel):
+    """
+    Colonne di note senza note di durata nulla e con le note sovrapposte
+    sulla stessa chiave (canale, pitch) fuse in una sola, dal primo attacco
+    alla fine piu' tarda, con la velocity del primo attacco. Pitch,
+    velocity e canale vengono riportati nei range MIDI. Ritorna
+    (start, end, pitch, velocity, channel) in ordine di attacco.
+    """
+    pitch = np.clip(np.asarray(pitch, dtype=np.int64), 0, 127)
+    velocity = np.clip(np.asarray(velocity, dtype=np.int64), 1, 127)
+    channel = np.clip(np.asarray(channel, dtype=np.int64), 0, 15)
+    start = np.asarray(start, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    valid = end > start
+    start, end, pitch, velocity, channel = start[valid], end[valid], pitch[valid], velocity[valid], channel[valid]
+    if start.size == 0:
+        return start, end, pitch, velocity, channel
+
+    keys = channel * 128 + pitch
+    order = np.lexsort((start, keys))
+    start, end, keys, velocity = start[order], end[order], keys[order], velocity[order]
+    first = np.empty(start.size, dtype=bool)
+    first[0] = True
+    first[1:] = keys[1:] != keys[:-1]
+    grp = np.cumsum(first) - 1
+    # fine piu' tarda delle note precedenti della stessa chiave (massimo corrente per gruppo)
+    big = int(end.max()) + 1
+    reach = np.maximum.accumulate(end + grp * big) - grp * big
+    prev_reach = np.empty_like(reach)
+    prev_reach[1:] = reach[:-1]
+    heads = np.flatnonzero(first | (start >= prev_reach))
+    merged_end = np.maximum.reduceat(end, heads)
+    start, keys, velocity = start[heads], keys[heads], velocity[heads]
+    by_start = np.argsort(start, kind='stable')
+    return (start[by_start], merged_end[by_start], keys[by_start] % 128, velocity[by_start],
+            keys[by_start] // 128)
+
+
+def _merge_note_overlaps_stream(notes):
+    """
+    merge_note_overlaps in streaming per le LazyTrack: da note (start, end,
+    pitch, velocity, channel) in ordine di attacco a note fuse, sempre in
+    ordine di attacco. Una nota fusa e' definitiva quando arriva un attacco
+    non prima della sua fine (gli attacchi successivi non possono piu'
+    sovrapporsi); fino ad allora resta in un heap, quindi la memoria dipende
+    dalle note aperte, non dalla durata.
+    """
+    open_notes = {}
+    pending = []
+    for seq, (start, end, pitch, velocity, channel) in enumerate(notes):
+        if end <= start:
+            continue
+        pitch, velocity, channel = min(max(pitch, 0), 127), min(max(velocity, 1), 127), min(max(channel, 0), 15)
+        note = open_notes.get((channel, pitch))
+        if note is not None and start < note[1]:
+            note[1] = max(note[1], end)
+        else:
+            note = [start, end, pitch, velocity, channel]
+            open_notes[(channel, pitch)] = note
+            heapq.heappush(pending, (start, seq, note))
+        while pending and pending[0][2][1] <= start:
+            done = heapq.heappop(pending)[2]
+            if open_notes.get((done[4], done[2])) is done:
+                del open_notes[(done[4], done[2])]
+            yield tuple(done)
+    while pending:
+        yield tuple(heapq.heappop(pending)[2])
+
+
+def optimize_track(track, ticks_per_beat):
+    """
+    MidiTrack ottimizzata: note ricostruite con merge_note_overlaps (le note
+    rimaste aperte durano 1 beat, come in extract_note_table), messaggi di
+    canale non-nota riportati nei range MIDI e senza ripetizioni identiche
+    allo stesso tick, meta invariati. Allo stesso tick i note_off precedono
+    gli altri messaggi e questi i note_on; end_of_track resta l'ultimo.
+    """
+    table = message_table(track)
+    notes = extract_note_table(track, ticks_per_beat)
+    start, end, pitch, velocity, channel = merge_note_overlaps(
+        notes['start'], notes['end'], notes['pitch'], notes['velocity'], notes['channel'])
+
+    code = table['type']
+    is_note = (code == MESSAGE_TYPE_CODES['note_on']) | (code == MESSAGE_TYPE_CODES['note_off'])
+    rows = np.flatnonzero(~is_note)
+    is_eot = np.array([msg.type == 'end_of_track' for msg in table['msg'][rows]], dtype=bool)
+    rows = rows[~is_eot]
+    d1, d2 = table['data1'][rows].copy(), table['data2'][rows].copy()
+    for c, (range1, range2) in enumerate(_MESSAGE_DATA_RANGES):
+        sel = code[rows] == c
+        d1[sel] = np.clip(d1[sel], *range1)
+        if range2:
+            d2[sel] = np.clip(d2[sel], *range2)
+    ticks = table['abs_tick'][rows]
+    repeat = np.zeros(rows.size, dtype=bool)
+    repeat[1:] = ((code[rows][1:] >= 0) & (ticks[1:] == ticks[:-1]) & (code[rows][1:] == code[rows][:-1])
+                  & (table['channel'][rows][1:] == table['channel'][rows][:-1]) & (d1[1:] == d1[:-1]) & (d2[1:] == d2[:-1]))
+    rows, d1, d2, ticks = rows[~repeat], d1[~repeat], d2[~repeat], ticks[~repeat]
+
+    # eventi: 0 = note_off, 1 = altri messaggi, 2 = note_on
+    n = start.size
+    ev_tick = np.concatenate([end, ticks, start])
+    ev_kind = np.concatenate([np.zeros(n, dtype=np.int64), np.ones(rows.size, dtype=np.int64), np.full(n, 2)])
+    ev_idx = np.concatenate([np.arange(n), np.arange(rows.size), np.arange(n)])
+    order = np.lexsort((ev_idx, ev_kind, ev_tick))
+    deltas = np.diff(ev_tick[order], prepend=0).tolist()
+    pitch, velocity, channel = pitch.tolist(), velocity.tolist(), channel.tolist()
+    new_track = mido.MidiTrack()
+    for kind, i, delta in zip(ev_kind[order].tolist(), ev_idx[order].tolist(), deltas):
+        if kind == 0:
+            new_track.append(mido.Message('note_off', skip_checks=True, note=pitch[i], velocity=0, channel=channel[i], time=delta))
+        elif kind == 2:
+            new_track.append(mido.Message('note_on', skip_checks=True, note=pitch[i], velocity=velocity[i], channel=channel[i], time=delta))
+        else:
+            msg, c = table['msg'][rows[i]], int(code[rows[i]])
+            if c < 0:
+                new_track.append(thaw_message(msg).copy(time=delta))
+                continue
+            first_field, second_field = _MESSAGE_DATA_FIELDS[c]
+            overrides = {'time': delta, first_field: int(d1[i])}
+            if second_field:
+                overrides[second_field] = int(d2[i])
+            new_track.append(msg.copy(skip_checks=True, **overrides))
+    last_tick = int(ev_tick.max()) if ev_tick.size else 0
+    new_track.append(mido.MetaMessage('end_of_track', time=max(int(table['abs_tick'][-1]) if table['abs_tick'].size else 0, last_tick) - last_tick))
+    return new_track
+
+
+def optimize_midi(midi):
+    """
+    Copia di midi con ogni traccia passata da optimize_track. Le LazyTrack
+    restano in streaming: le loro note passano da _merge_note_overlaps_stream
+    mentre vengono generate.
+    """
+    new_midi = mido.MidiFile(type=midi.type, ticks_per_beat=midi.ticks_per_beat, charset=midi.charset)
+    for track in midi.tracks:
+        if isinstance(track, LazyTrack):
+            new_midi.tracks.append(LazyTrack(track.name, track._header,
+                                             lambda make_notes=track._make_notes: _merge_note_overlaps_stream(make_notes())))
+        else:
+            new_midi.tracks.append(optimize_track(track, midi.ticks_per_beat))
+    return new_midi
+
+
+def prepare_export(midi, ticks_per_beat=None, optimize=False):
+    """File pronto per l'esportazione: ricampionato (resample_midi) e, con optimize, ottimizzato (optimize_midi)."""
+    midi = resample_midi(midi, ticks_per_beat)
+    return optimize_midi(midi) if optimize else midi
+
+
+# --- Sfoltimento delle curve di controller ---
+# Control change, pitchwheel e aftertouch arrivano spesso in flussi molto
+# piu' densi delle note e ogni trasformazione che copia i messaggi li porta
+# avanti uno per uno. Lo sfoltimento, al caricamento, tiene per ogni serie
+# (tipo, canale, controller / nota) solo i punti necessari: elimina i valori
+# ripetuti e riduce le curve con una suddivisione alla Douglas-Peucker, in
+# blocco su tutte le serie di una traccia. Solo i controller continui: i
+# STATEFUL_CONTROLLERS (RPN / NRPN, data entry, bank select, modo del canale)
+# sono comandi e passano tutti.
+
+THIN_TYPE_CODES = (MESSAGE_TYPE_CODES['polytouch'], MESSAGE_TYPE_CODES['control_change'],
+                   MESSAGE_TYPE_CODES['aftertouch'], MESSAGE_TYPE_CODES['pitchwheel'])
+PITCHWHEEL_TOLERANCE_SCALE = 128  # pitchwheel a 14 bit contro i 7 bit dei controller
+RESET_ALL_CONTROLLERS = 121
+
+
+def thin_controller_rows(table, tolerance):
+    """
+    Maschera delle righe di una MessageTable da tenere. Si sfoltiscono solo
+    le curve continue (control_change esclusi i STATEFUL_CONTROLLERS,
+    pitchwheel, aftertouch, polytouch). Un Reset All Controllers (CC 121)
+    chiude tutte le serie del suo canale: il valore successivo apre una
+    serie nuova e resta. Per ogni serie (tipo, canale, controller o nota,
+    tratto tra due reset) cadono i valori uguali al precedente,
+    poi i punti interni vengono scartati finche' ogni punto eliminato dista
+    al massimo tolerance dal valore del punto tenuto che lo precede, cioe'
+    da quello che il ricevitore mantiene in quel momento (tolerance in unita'
+    a 7 bit, scalata per il pitchwheel). Come in Douglas-Peucker ogni
+    segmento tra due punti tenuti che supera la tolleranza viene diviso nel
+    punto piu' lontano dalla retta tra gli estremi; se la curva e' una retta
+    entro la tolleranza (una rampa) viene diviso a meta', cosi' le iterazioni
+    restano logaritmiche. Un'iterazione divide tutti i segmenti di tutte le
+    serie insieme.
+    """
+    code = table['type']
+    keep = np.ones(code.size, dtype=bool)
+    is_cc = code == MESSAGE_TYPE_CODES['control_change']
+    rows = np.flatnonzero(np.isin(code, THIN_TYPE_CODES) & ~(is_cc & np.isin(table['data1'], STATEFUL_CONTROLLERS)))
+    if rows.size == 0:
+        return keep
+
+    # numero di Reset All Controllers del canale prima di ogni riga
+    resets = np.flatnonzero(is_cc & (table['data1'] == RESET_ALL_CONTROLLERS))
+    reset_keys = np.sort(table['channel'][resets] * code.size + resets)
+    channel_base = table['channel'][rows] * code.size
+    epoch = np.searchsorted(reset_keys, channel_base + rows) - np.searchsorted(reset_keys, channel_base)
+
+    is_pair = np.isin(code[rows], (MESSAGE_TYPE_CODES['polytouch'], MESSAGE_TYPE_CODES['control_change']))
+    target = np.where(is_pair, table['data1'][rows], -1)
+    value = np.where(is_pair, table['data2'][rows], table['data1'][rows])
+    order = np.lexsort((rows, epoch, target, table['channel'][rows], code[rows]))
+    rows, value = rows[order], value[order]
+    series = np.stack([code[rows], table['channel'][rows], target[order], epoch[order]])
+    first = np.ones(rows.size, dtype=bool)
+    first[1:] = np.any(series[:, 1:] != series[:, :-1], axis=0)
+
+    repeat = ~first
+    repeat[1:] &= value[1:] == value[:-1]
+    keep[rows[repeat]] = False
+    rows, value, first = rows[~repeat], value[~repeat], first[~repeat]
+    ticks = table['abs_tick'][rows]
+    tol = np.where(code[rows] == MESSAGE_TYPE_CODES['pitchwheel'], tolerance * PITCHWHEEL_TOLERANCE_SCALE, tolerance)
+
+    kept = first.copy()
+    kept[:-1] |= first[1:]
+    kept[-1] = True
+    positions = np.arange(rows.size)
+    while True:
+        anchor = np.maximum.accumulate(np.where(kept, positions, 0))
+        hold_error = np.where(kept, 0, np.abs(value - value[anchor]))
+        over = hold_error > tol
+        if not over.any():
+            break
+        end = np.minimum.accumulate(np.where(kept, positions, rows.size)[::-1])[::-1]
+        span = ticks[end] - ticks[anchor]
+        frac = (ticks - ticks[anchor]) / np.maximum(span, 1)
+        line_error = np.where(kept, 0, np.abs(value - (value[anchor] + (value[end] - value[anchor]) * frac)))
+        # segmenti da dividere: punto piu' lontano dalla retta, o il punto centrale se sono tutti entro tol
+        split = np.zeros(rows.size, dtype=bool)
+        split[anchor[over]] = True
+        inside = np.flatnonzero(split[anchor] & ~kept)
+        score = np.where(line_error[inside] > tol[inside], line_error[inside] + 1,
+                         -np.abs(inside - (anchor[inside] + end[inside]) / 2))
+        inside = inside[np.lexsort((inside, -score, anchor[inside]))]
+        head = np.ones(inside.size, dtype=bool)
+        head[1:] = anchor[inside][1:] != anchor[inside][:-1]
+        kept[inside[head]] = True
+    keep[rows[~kept]] = False
+    return keep
+
+
+def thin_controller_curves(midi, tolerance=2):
+    """
+    Copia di midi con le curve di controller sfoltite (thin_controller_rows).
+    Le tracce senza punti da togliere restano le stesse (per riferimento);
+    le altre sono riscritte dalla MessageTable con i tick assoluti invariati.
+    """
+    new_midi = mido.MidiFile(type=midi.type, ticks_per_beat=midi.ticks_per_beat, charset=midi.charset)
+    for track in midi.tracks:
+        table = message_table(track)
+        keep = thin_controller_rows(table, tolerance)
+        if keep.all():
+            new_midi.tracks.append(track)
+        else:
+            new_midi.tracks.append(_message_table_to_track(mido.MidiTrack(), table, order=np.flatnonzero(keep)))
+    return new_midi
+
+
+# --- Analisi tonale (profili di Krumhansl-Kessler) ---
+# Tonalita' indicizzate 0..23: 0-11 maggiori (tonica C..B), 12-23 minori.
+# La tonalita' locale e' quella il cui profilo correla meglio (Pearson) con
+# l'istogramma delle classi di altezza pesato per durata della finestra.
+
+KRUMHANSL_MAJOR = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+KRUMHANSL_MINOR = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+PITCH_CLASS_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+def _build_key_profiles():
+    """Matrice 24x12 dei profili di tonalita' normalizzati (z-score per riga)."""
+    rows = [np.roll(KRUMHANSL_MAJOR, t) for t in range(12)] + [np.roll(KRUMHANSL_MINOR, t) for t in range(12)]
+    profiles = np.array(rows, dtype=float)
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+
+def _build_key_snap_lut():
+    """
+    LUT 24x128: per ogni tonalita', il pitch della scala (maggiore o minore
+    naturale) piu' vicino a ciascun pitch MIDI; a parita' di distanza vince
+    quello sotto, cosi' terze e quinte cromatiche diventano diatoniche.
+    """
+    pitches = np.arange(128)
+    lut = np.empty((24, 128), dtype=np.int64)
+    for k in range(24):
+        tonic = k % 12
+        scale = np.array(get_scale_notes("Maggiore" if k < 12 else "Minore Naturale"))
+        in_key = np.flatnonzero(np.isin((np.arange(-12, 140) - tonic) % 12, scale)) - 12
+        nearest = np.abs(pitches[:, None] - in_key[None, :]) + (in_key[None, :] > pitches[:, None]) * 0.5
+        lut[k] = np.clip(in_key[np.argmin(nearest, axis=1)], 0, 127)
+    return lut
+
+
+KEY_PROFILES = _build_key_profiles()
+KEY_SNAP_LUT = _build_key_snap_lut()
+
+
+def key_index_name(key_idx):
+    """Nome di una tonalita' 0..23 nel formato dei selettori ('C', 'F#', 'Am'...)."""
+    return PITCH_CLASS_NAMES[key_idx % 12] + ('m' if key_idx >= 12 else '')
+
+
+def _keys_from_histograms(histograms):
+    """Tonalita' (0..23) per ogni riga di un array N x 12 di istogrammi di classi di altezza."""
+    h = np.atleast_2d(np.asarray(histograms, dtype=float))
+    h = h - h.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(h, axis=1, keepdims=True)
+    scores = (h / np.where(norms > 0, norms, 1)) @ KEY_PROFILES.T
+    return np.argmax(scores, axis=1)
+
+
+def _midi_cache(midi):
+    """
+    Cache delle analisi per-file (indici, tabelle), agganciata all'oggetto
+    MidiFile: costruita una volta al caricamento e riusata da tutte le
+    trasformazioni che ricevono lo stesso file.
+    """
+    cache = getattr(midi, '_decomposer_cache', None)
+    if cache is None:
+        cache = {}
+        midi._decomposer_cache = cache
+    return cache
+
+
+def build_key_index(midi):
+    """
+    Indice tonale del file: somme prefisse nel tempo degli istogrammi di
+    classi di altezza pesati per durata, su tutte le tracce. Tra due
+    breakpoint consecutivi (inizi/fini di nota) il numero di note sounding
+    per classe e' costante, quindi l'integrale cumulativo e' lineare a tratti:
+    l'istogramma di qualunque finestra [a, b) e' C(b) - C(a), senza
+    riscandire le note (_key_index_histograms). Le note del canale 10
+    (percussioni, channel 9) sono escluse: le altezze di cassa, rullante e
+    hi-hat non sono classi tonali. Calcolato in un solo passaggio e
+    conservato nella cache del file.
+    """
+    cache = _midi_cache(midi)
+    if 'key_index' in cache:
+        return cache['key_index']
+
+    tables = [extract_note_table(t, midi.ticks_per_beat) for t in midi.tracks]
+    tonal = [t['channel'] != 9 for t in tables]
+    start = np.concatenate([np.zeros(0, dtype=np.int64)] + [t['start'][m] for t, m in zip(tables, tonal)])
+    end = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.maximum(t['end'], t['start'])[m] for t, m in zip(tables, tonal)])
+    pc = np.concatenate([np.zeros(0, dtype=np.int64)] + [t['pitch'][m] for t, m in zip(tables, tonal)]) % 12
+
+    ticks, inverse = np.unique(np.concatenate([start, end, [0]]), return_inverse=True)
+    rate_change = np.zeros((ticks.size, 12))
+    np.add.at(rate_change, (inverse[:start.size], pc), 1.0)
+    np.add.at(rate_change, (inverse[start.size:start.size + end.size], pc), -1.0)
+    rate = np.cumsum(rate_change, axis=0)
+    cumulative = np.zeros((ticks.size, 12))
+    cumulative[1:] = np.cumsum(rate[:-1] * np.diff(ticks)[:, None], axis=0)
+
+    index = {'ticks': ticks, 'rate': rate, 'cumulative': cumulative}
+    cache['key_index'] = index
+    return index
+
+
+def _key_index_cumulative(index, t):
+    """Integrale cumulativo C(t) (array N x 12) per un array di tick."""
+    t = np.asarray(t, dtype=np.int64)
+    i = np.maximum(np.searchsorted(index['ticks'], t, side='right') - 1, 0)
+    return index['cumulative'][i] + index['rate'][i] * np.maximum(t - index['ticks'][i], 0)[:, None]
+
+
+def _key_index_histograms(index, window_start, window_end):
+    """Istogrammi pesati per durata (N x 12) delle finestre [window_start, window_end)."""
+    return _key_index_cumulative(index, window_end) - _key_index_cumulative(index, window_start)
+
+
+def local_keys_at(midi, ticks, window_beats=16):
+    """
+    Tonalita' (0..23) nelle finestre di window_beats beat centrate su ciascun
+    tick: un'unica moltiplicazione matriciale istogrammi x profili.
+    """
+    index = build_key_index(midi)
+    half = int(midi.ticks_per_beat * window_beats) // 2
+    ticks = np.asarray(ticks, dtype=np.int64)
+    return _keys_from_histograms(_key_index_histograms(index, ticks - half, ticks + half))
+
+
+def global_key(midi):
+    """Tonalita' (0..23) dell'intero brano."""
+    index = build_key_index(midi)
+    return int(_keys_from_histograms(index['cumulative'][-1:])[0])
+
+
+# --- Indice degli intervalli di nota ---
+# Per ogni traccia le note sono organizzate in una NCList (Nested Containment
+# List) su array: ogni nota contenuta in un'altra sta nella sottolista di
+# quella, e dentro una sottolista inizi e fini sono entrambi crescenti, quindi
+# le note di una sottolista che si sovrappongono a [a, b) sono un intervallo
+# contiguo trovato con due ricerche binarie. Le sottoliste sono disposte una
+# dopo l'altra negli stessi array, con chiavi sottolista * span + tick, cosi'
+# una query in blocco scende un livello di annidamento alla volta per tutte
+# le query insieme: O(log n + k) per query. Costruito una volta per file (al
+# caricamento) e conservato nella cache del file.
+
+def _build_nclist(start, end):
+    """
+    Layout NCList di intervalli [start, end): dict con 'start_key' e
+    'end_key' (sottolista * 'span' + tick, ordinati), 'row' (indice
+    dell'intervallo in input), 'child' (sottolista dei contenuti, -1 se non
+    ne ha) e 'span'. La sottolista 0 e' il livello principale.
+    """
+    order = np.lexsort((-end, start))
+    parent_sub = np.zeros(order.size, dtype=np.int64)
+    stack = []
+    ends = end[order].tolist()
+    # pila delle note aperte: la cima e' la piu' interna che puo' ancora contenere le successive
+    for pos, e in enumerate(ends):
+        while stack and ends[stack[-1]] < e:
+            stack.pop()
+        parent_sub[pos] = stack[-1] + 1 if stack else 0
+        stack.append(pos)
+    layout = np.argsort(parent_sub, kind='stable')
+    span = int(end.max()) + 2 if end.size else 2
+    has_children = np.zeros(order.size, dtype=bool)
+    has_children[parent_sub[parent_sub > 0] - 1] = True
+    sub = parent_sub[layout]
+    return {
+        'start_key': sub * span + start[order][layout],
+        'end_key': sub * span + end[order][layout],
+        'row': order[layout],
+        'child': np.where(has_children[layout], layout + 1, -1),
+        'span': span,
+    }
+
+
+def _nclist_overlaps(nclist, a, b):
+    """
+    Coppie (indice della query, riga) per ogni intervallo che si sovrappone
+    a [a[i], b[i]): una ricerca binaria per sottolista visitata, livello per
+    livello, senza loop Python sulle note.
+    """
+    span = nclist['span']
+    a = np.clip(np.asarray(a, dtype=np.int64), -1, span - 1)
+    b = np.clip(np.asarray(b, dtype=np.int64), -1, span - 1)
+    query = np.arange(a.size)
+    sub = np.zeros(a.size, dtype=np.int64)
+    found_query, found_pos = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    while query.size:
+        lo = np.searchsorted(nclist['end_key'], sub * span + a[query], side='right')
+        hi = np.searchsorted(nclist['start_key'], sub * span + b[query], side='left')
+        counts = np.maximum(hi - lo, 0)
+        query = np.repeat(query, counts)
+        pos = np.repeat(lo, counts) + _ragged_arange(counts)
+        found_query.append(query)
+        found_pos.append(pos)
+        nested = nclist['child'][pos] >= 0
+        query, sub = query[nested], nclist['child'][pos[nested]]
+    query, pos = np.concatenate(found_query), np.concatenate(found_pos)
+    return query, nclist['row'][pos]
+
+
+def build_note_interval_index(midi):
+    """
+    Indice degli intervalli di nota del file: per ogni traccia un dict con
+    la NCList delle note (_build_nclist, righe riferite a extract_note_table)
+    e 'pitch' (per riga, nell'ordine della tabella). Array in sola lettura,
+    in cache.
+    """
+    cache = _midi_cache(midi)
+    if 'note_intervals' in cache:
+        return cache['note_intervals']
+
+    index = []
+    for track in midi.tracks:
+        table = extract_note_table(track, midi.ticks_per_beat)
+        entry = _build_nclist(table['start'], np.maximum(table['end'], table['start']))
+        entry['pitch'] = table['pitch']
+        for column in entry.values():
+            if isinstance(column, np.ndarray):
+                column.flags.writeable = False
+        index.append(entry)
+    cache['note_intervals'] = index
+    return index
+
+
+def notes_active_at_ticks(midi, track_idx, ticks):
+    """
+    Note della traccia che suonano (start <= tick < end) a ciascun tick di un
+    array: coppie (indice del tick, riga della nota in extract_note_table).
+    """
+    ticks = np.asarray(ticks, dtype=np.int64)
+    return _nclist_overlaps(build_note_interval_index(midi)[track_idx], ticks, ticks + 1)
+
+
+# --- Analisi metrica (autocorrelazione degli attacchi) ---
+# Periodi di battuta candidati, in sedicesimi -> metrica. Il periodo di 12
+# sedicesimi e' 3/4 o 6/8 a seconda della pulsazione (vedi detect_meter).
+METER_CANDIDATES = {6: (3, 8), 8: (2, 4), 10: (5, 8), 12: (3, 4), 14: (7, 8), 16: (4, 4), 20: (5, 4), 24: (6, 4)}
+PHRASE_BAR_CANDIDATES = (2, 4, 8)
+
+
+def _onset_autocorrelation(strength):
+    """Autocorrelazione (non polarizzata, normalizzata a lag 0) via FFT, O(n log n)."""
+    n = strength.size
+    x = strength - strength.mean()
+    n_fft = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(x, n_fft)
+    ac = np.fft.irfft(spectrum * np.conj(spectrum), n_fft)[:n]
+    if ac[0] <= 0:
+        return np.zeros(n)
+    return ac / ac[0] * n / (n - np.arange(n))
+
+
+def detect_meter(midi):
+    """
+    Metrica rilevata dal file: segnale di onset-strength sulla griglia dei
+    sedicesimi (attacchi pesati per velocity, batteria esclusa), periodo di
+    battuta dall'autocorrelazione FFT (media dei picchi ai multipli del lag),
+    fase = posizione piu' accentata nel periodo, lunghezza di frase in battute
+    dal picco di autocorrelazione tra PHRASE_BAR_CANDIDATES. Restituisce un
+    dict con 'numerator', 'denominator', 'bar_ticks', 'phase_ticks',
+    'phrase_bars', 'confidence'; conservato nella cache del file.
+    """
+    cache = _midi_cache(midi)
+    if 'meter' in cache:
+        return cache['meter']
+
+    tpb = midi.ticks_per_beat
+    step = tpb / 4
+    onsets, weights = [], []
+    for track in midi.tracks:
+        abs_t, is_on, _, keys = _track_note_columns(track)
+        rows = np.flatnonzero(is_on & (keys // 128 != 9))
+        onsets.append(abs_t[rows])
+        weights.append(message_table(track)['data2'][rows].astype(float))
+    onsets, weights = np.concatenate(onsets), np.concatenate(weights) / 127
+
+    meter = {'numerator': 4, 'denominator': 4, 'bar_ticks': tpb * 4, 'phase_ticks': 0,
+             'phrase_bars': 4, 'confidence': 0.0}
+    if onsets.size:
+        strength = np.bincount(np.rint(onsets / step).astype(np.int64), weights=weights)
+        n = strength.size
+        ac = _onset_autocorrelation(strength)
+        scores = {}
+        for period in METER_CANDIDATES:
+            lags = np.arange(period, n // 2, period)[:4]
+            if lags.size:
+                scores[period] = ac[lags].mean()
+        if scores:
+            # un periodo multiplo di uno piu' corto quasi altrettanto periodico
+            # e' la stessa metrica ripetuta: prevale il divisore
+            period = max(scores, key=scores.get)
+            divisors = [p for p in scores if period % p == 0 and scores[p] >= scores[period] - 0.05]
+            period = min(divisors)
+            numerator, denominator = METER_CANDIDATES[period]
+            if period == 12 and ac[6] > ac[4]:
+                numerator, denominator = 6, 8
+            folded = np.bincount(np.arange(n) % period, weights=strength, minlength=period)
+            phrase_scores = {bars: ac[bars * period] for bars in PHRASE_BAR_CANDIDATES if bars * period < n // 2}
+            phrase_bars = max(phrase_scores, key=phrase_scores.get) if phrase_scores else 4
+            if phrase_scores.get(4, -np.inf) >= phrase_scores.get(phrase_bars, 0) - 0.05:
+                phrase_bars = 4
+            meter = {
+                'numerator': numerator,
+                'denominator': denominator,
+                'bar_ticks': int(round(tpb * 4 * numerator / denominator)),
+                'phase_ticks': int(round(int(np.argmax(folded)) * step)),
+                'phrase_bars': phrase_bars,
+                'confidence': float(max(scores[period], 0.0)),
+            }
+    cache['meter'] = meter
+    return meter
+
+
+def _detected_meter_grid(midi, end_tick):
+    """
+    Griglia di battute della metrica rilevata, nello stesso formato di
+    _meter_grid. Il primo inizio e' la fase meno una battuta (puo' essere
+    negativo), cosi' anche gli attacchi prima della prima battuta piena
+    cadono in una battuta.
+    """
+    meter = detect_meter(midi)
+    bar = meter['bar_ticks']
+    first = meter['phase_ticks'] % bar
+    first = first - bar if first > 0 else 0
+    bar_starts = np.arange(first, max(end_tick, 0) + bar + 1, bar, dtype=np.int64)
+    return (bar_starts, np.full(bar_starts.size, meter['numerator']),
+            np.full(bar_starts.size, meter['denominator']))
+
+# --- Costas Array Utilities (costruzioni di Welch, Lempel e Golomb) ---
 # Rif: J.P. Costas (1965); L. Welch construction via radice primitiva mod p.
 # Scott Rickard ha usato la stessa costruzione per generare melodie prive di
 # autocorrelazione ("la canzone piu' irritante mai composta").
+# Lempel e Golomb (1984) costruiscono matrici di ordine q-2 su GF(q), q
+# potenza di un primo: con alfa, beta elementi primitivi, il punto (i, j)
+# appartiene alla matrice se alfa^i + beta^j = 1 (Lempel: beta = alfa).
+# Primi, fattorizzazioni e radici primitive arrivano da un crivello di
+# Eratostene in cache (fattore primo minimo per ogni intero), le permutazioni
+# generate sono memoizzate per (costruzione, q).
+
+COSTAS_CONSTRUCTIONS = ["Welch", "Lempel", "Golomb", "Auto (ordine minimo)"]
+_COSTAS_SIEVE = {'limit': 0, 'spf': np.zeros(0, dtype=np.int64), 'primes': np.zeros(0, dtype=np.int64)}
+_COSTAS_PRIMITIVE_ROOTS = {}
+_COSTAS_PERMUTATIONS = {}
+_GF_TABLES = {}
+
+
+def _costas_sieve(limit):
+    """
+    Crivello del fattore primo minimo fino ad almeno limit, cresciuto per
+    raddoppio e conservato in _COSTAS_SIEVE: restituisce (spf, primi).
+    """
+    if _COSTAS_SIEVE['limit'] < limit:
+        size = max(1 << 16, 2 * int(limit))
+        spf = np.zeros(size + 1, dtype=np.int64)
+        for i in range(2, int(size ** 0.5) + 1):
+            if spf[i] == 0:
+                block = spf[i * i::i]
+                block[block == 0] = i
+        rest = spf[2:]
+        rest[rest == 0] = np.flatnonzero(rest == 0) + 2  # i primi sono fattore minimo di se stessi
+        primes = np.flatnonzero(spf == np.arange(size + 1))
+        _COSTAS_SIEVE.update(limit=size, spf=spf, primes=primes[primes >= 2])
+    return _COSTAS_SIEVE['spf'], _COSTAS_SIEVE['primes']
+
 
 def _costas_is_prime(n):
     if n < 2:
         return False
-    if n in (2, 3):
-        return True
-    if n % 2 == 0:
-        return False
-    i = 3
-    while i * i <= n:
-        if n % i == 0:
-            return False
-        i += 2
-    return True
+    spf, _ = _costas_sieve(n)
+    return int(spf[n]) == n
 
 def _costas_prime_factors(n):
+    spf, _ = _costas_sieve(n)
     factors = set()
-    d = 2
-    while d * d <= n:
-        while n % d == 0:
-            factors.add(d)
-            n //= d
-        d += 1
-    if n > 1:
-        factors.add(n)
+    while n > 1:
+        f = int(spf[n])
+        factors.add(f)
+        while n % f == 0:
+            n //= f
     return factors
 
+def _costas_prime_power(q):
+    """(p, k) se q = p^k con p primo, altrimenti None."""
+    if q < 2:
+        return None
+    spf, _ = _costas_sieve(q)
+    p = int(spf[q])
+    k = 0
+    while q % p == 0:
+        q //= p
+        k += 1
+    return (p, k) if q == 1 else None
+
 def _costas_find_prime(min_order):
     """Trova il piu' piccolo primo p tale che p-1 >= min_order."""
-    p = max(3, min_order + 1)
-    while not _costas_is_prime(p):
-        p += 1
-    return p
+    target = max(3, min_order + 1)
+    _, primes = _costas_sieve(target)
+    return int(primes[np.searchsorted(primes, target)])
 
 def _costas_primitive_root(p):
-    """Trova una radice primitiva di p (esiste sempre per p primo)."""
+    """Trova una radice primitiva di p (esiste sempre per p primo), in cache."""
     if p == 2:
         return 1
+    if p in _COSTAS_PRIMITIVE_ROOTS:
+        return _COSTAS_PRIMITIVE_ROOTS[p]
     phi = p - 1
     factors = _costas_prime_factors(phi)
+    root = 2  # fallback teorico, non dovrebbe mai accadere per p primo
     for g in range(2, p):
         if all(pow(g, phi // f, p) != 1 for f in factors):
-            return g
-    return 2  # fallback teorico, non dovrebbe mai accadere per p primo
+            root = g
+            break
+    _COSTAS_PRIMITIVE_ROOTS[p] = root
+    return root
+
 
-def generate_costas_array(min_order):
+def _gf_tables(q):
+    """
+    Tabelle di GF(q), q = p^k: potenze dell'elemento primitivo alfa come
+    codici interi (cifre in base p = coefficienti del polinomio) e tabella
+    dei logaritmi. Per k = 1 alfa e' la radice primitiva di p; per k > 1 e'
+    la classe di x modulo il primo polinomio monico primitivo di grado k.
+    Restituisce (p, k, alfa, potenze, log), in cache.
     """
-    Genera una matrice/sequenza di Costas tramite la costruzione di Welch:
-    per un primo p con radice primitiva g, la permutazione
+    if q in _GF_TABLES:
+        return _GF_TABLES[q]
+    p, k = _costas_prime_power(q)
+    if k == 1:
+        alpha = _costas_primitive_root(p)
+        powers = np.empty(q - 1, dtype=np.int64)
+        value = 1
+        for i in range(q - 1):
+            powers[i] = value
+            value = value * alpha % p
+    else:
+        alpha = p  # il polinomio x
+        place = p ** np.arange(k)
+        for tail_code in range(1, p ** k):
+            tail = (tail_code // place) % p  # coefficienti di grado 0..k-1 del polinomio (x^k + tail)
+            if tail[0] == 0:
+                continue
+            powers = np.empty(q - 1, dtype=np.int64)
+            digits = np.zeros(k, dtype=np.int64)
+            digits[0] = 1
+            for i in range(q - 1):
+                powers[i] = int(digits @ place)
+                if i > 0 and powers[i] == 1:
+                    break
+                carry = digits[-1]
+                digits = np.concatenate([[0], digits[:-1]])
+                digits = (digits - carry * tail) % p
+            else:
+                if int(digits @ place) == 1:
+                    break  # x ha ordine q-1: polinomio primitivo
+    log = np.full(q, -1, dtype=np.int64)
+    log[powers] = np.arange(q - 1)
+    _GF_TABLES[q] = (p, k, alpha, powers, log)
+    return _GF_TABLES[q]
+
+
+def _gf_one_minus(codes, p, k):
+    """1 - a in GF(p^k) per un array di codici: sottrazione cifra per cifra mod p."""
+    place = p ** np.arange(k)
+    digits = (codes[:, None] // place) % p
+    one = np.zeros(k, dtype=np.int64)
+    one[0] = 1
+    return ((one - digits) % p) @ place
+
+
+def _costas_order_candidates(min_order, construction):
+    """
+    (costruzione, q) con l'ordine minimo >= min_order: Welch ha ordine p-1
+    (p primo), Lempel e Golomb q-2 (q potenza di un primo); "Auto" sceglie
+    la costruzione con l'ordine piu' vicino.
+    """
+    min_order = max(1, int(min_order))
+    if construction == "Welch":
+        return "Welch", _costas_find_prime(min_order)
+    q = max(4, min_order + 2)
+    while _costas_prime_power(q) is None:
+        q += 1
+    if construction in ("Lempel", "Golomb"):
+        return construction, q
+    p = _costas_find_prime(min_order)
+    return ("Welch", p) if p - 1 <= q - 2 else ("Golomb", q)
+
+
+def _costas_permutation(construction, q):
+    """Permutazione (array in sola lettura) della costruzione su q, memoizzata."""
+    key = (construction, q)
+    if key in _COSTAS_PERMUTATIONS:
+        return _COSTAS_PERMUTATIONS[key]
+    if construction == "Welch":
+        _, _, generator, powers, _ = _gf_tables(q)
+        perm = np.roll(powers, -1) - 1  # g^(i+1) mod p - 1, con g^(p-1) = 1
+    else:
+        p, k, alpha, powers, log = _gf_tables(q)
+        s = 1
+        if construction == "Golomb":
+            # beta = alfa^s con s coprimo con q-1: il primo esponente > 1 valido
+            s = next((e for e in range(2, q - 1) if math.gcd(e, q - 1) == 1), 1)
+        j = log[_gf_one_minus(powers[1:q - 1], p, k)] * pow(s, -1, q - 1) % (q - 1) if q > 3 else np.ones(1, dtype=np.int64)
+        perm = j - 1
+        generator = alpha
+    perm = np.asarray(perm, dtype=np.int64)
+    perm.flags.writeable = False
+    _COSTAS_PERMUTATIONS[key] = (perm, generator)
+    return _COSTAS_PERMUTATIONS[key]
+
+
+def generate_costas_array(min_order, construction="Welch"):
+    """
+    Genera una matrice/sequenza di Costas. Costruzione di Welch: per un primo
+    p con radice primitiva g, la permutazione
         perm[i] = (g^(i+1) mod p) - 1   per i = 0..p-2
     e' una permutazione di {0,...,p-2} = {0,...,n-1} con la proprieta' di Costas
     (tutti i vettori differenza tra coppie di punti sono distinti).
+    Lempel/Golomb: per q potenza di un primo, perm[i-1] = j-1 con
+    alfa^i + beta^j = 1 in GF(q), i, j = 1..q-2 (ordine n = q-2).
 
     Ritorna: (perm, n, p, g)
       perm: lista di lunghezza n, permutazione di 0..n-1 (perm[riga] = colonna)
-      n:    ordine effettivo della matrice (n = p-1, >= min_order richiesto)
-      p:    primo usato
-      g:    radice primitiva usata
+      n:    ordine effettivo della matrice (>= min_order richiesto)
+      p:    primo (Welch) o potenza di primo q (Lempel/Golomb) usato
+      g:    radice primitiva / elemento primitivo usato (codice in base p)
     """
-    min_order = max(1, int(min_order))
-    p = _costas_find_prime(min_order)
-    g = _costas_primitive_root(p)
-    n = p - 1
-    perm = [(pow(g, i + 1, p) - 1) for i in range(n)]
-    return perm, n, p, g
+    construction, q = _costas_order_candidates(min_order, construction)
+    perm, g = _costas_permutation(construction, q)
+    return perm.tolist(), len(perm), q, g
 
 
 def midi_costas_pitch_permutation(original_midi, transpose_octave=0):
@@ -213,22 +1620,21 @@ def midi_costas_pitch_permutation(original_midi, transpose_octave=0):
         if hasattr(original_track, 'name') and original_track.name:
             new_track.name = original_track.name
 
-        for msg in original_track:
-            if msg.type in ('note_on', 'note_off') and hasattr(msg, 'note'):
-                pitch_class = msg.note % 12
-                octave = msg.note // 12
-                new_pitch_class = perm[pitch_class % n]
-                new_pitch = (octave * 12) + new_pitch_class + (transpose_octave * 12)
-                new_pitch = max(0, min(127, new_pitch))
-                new_track.append(msg.copy(note=new_pitch))
-            else:
-                new_track.append(msg)
+        table = message_table(original_track)
+        _, _, _, keys = _track_note_columns(original_track)
+        note = table['data1']
+        new_pitch = np.clip((note // 12) * 12 + np.asarray(perm)[note % 12 % n] + transpose_octave * 12, 0, 127)
+        _message_table_to_track(new_track, table, data1=np.where(keys >= 0, new_pitch, note))
 
         new_midi.tracks.append(new_track)
     return new_midi, (n, p, g)
 
 
-def midi_costas_rhythmic_grid(original_midi, min_order, block_notes=None):
+COSTAS_GRID_MODES = ["Solo onset", "Onset + pitch (2D)"]
+
+
+def midi_costas_rhythmic_grid(original_midi, min_order, block_notes=None, construction="Welch",
+                              grid_mode="Solo onset"):
     """
     Modalita' 2: Griglia Ritmica Costas.
     Raggruppa le note (per traccia, in ordine di apertura) in blocchi di n note
@@ -236,59 +1642,56 @@ def midi_costas_rhythmic_grid(original_midi, min_order, block_notes=None):
     di ciascun blocco secondo la permutazione di Costas su una griglia di n slot
     che copre l'estensione temporale originale del blocco. Pitch e durate
     restano quelli originali: cambia solo *dove* cade ogni nota — uno shuffle
-    algoritmico non ripetitivo, non casuale.
+    algoritmico non ripetitivo, non casuale. construction sceglie la
+    costruzione della matrice (COSTAS_CONSTRUCTIONS). Con grid_mode
+    "Onset + pitch (2D)" anche le altezze del blocco vengono permutate: la
+    nota che cade nello slot s prende l'altezza di rango perm[s] tra quelle
+    del blocco, cosi' le note di un blocco pieno stanno esattamente sui punti
+    della matrice nel piano tempo x altezza.
+    Blocchi e slot sono calcolati con aritmetica sugli indici (blocco =
+    rango // n) e riduzioni per blocco (reduceat), senza loop sulle note.
     """
-    perm, n, p, g = generate_costas_array(min_order)
+    perm, n, p, g = generate_costas_array(min_order, construction)
+    perm = np.asarray(perm, dtype=np.int64)
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
 
     for original_track in original_midi.tracks:
         _name = original_track.name if hasattr(original_track, 'name') else ''
         _header = _extract_instrument_header(original_track)
-        notes = extract_notes(original_track, original_midi.ticks_per_beat)
+        notes = extract_note_table(original_track, original_midi.ticks_per_beat)
 
-        if not notes:
+        if not len(notes['start']):
             new_midi.tracks.append(original_track)
             continue
 
-        notes_sorted = sorted(notes, key=lambda x: x['start'])
-        final_events = []
-
-        for block_start in range(0, len(notes_sorted), n):
-            block = notes_sorted[block_start: block_start + n]
-            if not block:
-                continue
-            block_begin_tick = block[0]['start']
-            block_end_tick = max(nd['end'] for nd in block)
-            block_span = max(1, block_end_tick - block_begin_tick)
-            slot_size = block_span / n
-
-            for idx, note_data in enumerate(block):
-                slot = perm[idx % n]
-                new_start = block_begin_tick + int(round(slot * slot_size))
-                duration = max(1, note_data['end'] - note_data['start'])
-                new_end = new_start + duration
-
-                final_events.append({'msg': mido.Message('note_on', note=note_data['pitch'], velocity=note_data['velocity'], channel=note_data['channel'], time=0), 'abs_time': new_start})
-                final_events.append({'msg': mido.Message('note_off', note=note_data['pitch'], velocity=0, channel=note_data['channel'], time=0), 'abs_time': new_end})
-
-        final_events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
+        start, end, pitch = notes['start'], notes['end'], notes['pitch']
+        rank = np.arange(len(start))
+        block = rank // n
+        block_first = np.arange(0, len(start), n)
+        block_begin = np.minimum.reduceat(start, block_first)
+        block_span = np.maximum(1, np.maximum.reduceat(end, block_first) - block_begin)
+        slot = perm[rank % n]
+        new_start = block_begin[block] + np.rint(slot * (block_span[block] / n)).astype(np.int64)
+        new_end = new_start + np.maximum(1, end - start)
+
+        if grid_mode == "Onset + pitch (2D)":
+            block_size = np.diff(np.append(block_first, len(start)))
+            sorted_pitch = pitch[np.lexsort((pitch, block))]
+            pitch = sorted_pitch[block_first[block] + perm[slot] * block_size[block] // n]
 
         new_track = mido.MidiTrack()
         if _name:
             new_track.name = _name
         for _h in _header:
             new_track.append(_h)
-        last_abs_time = 0
-        for event_data in final_events:
-            delta = max(0, event_data['abs_time'] - last_abs_time)
-            new_track.append(event_data['msg'].copy(time=delta))
-            last_abs_time = event_data['abs_time']
+        _note_arrays_to_track(new_track, new_start, new_end, pitch, notes['velocity'], notes['channel'])
 
         new_midi.tracks.append(new_track)
     return new_midi, (n, p, g)
 
 
-def midi_costas_generator(original_midi, min_order, base_pitch, pitch_range_semitones, step_beats, channel=0):
+def midi_costas_generator(original_midi, min_order, base_pitch, pitch_range_semitones, step_beats, channel=0,
+                          streaming=False, construction="Welch"):
     """
     Modalita' 3: Generatore Costas (nuova melodia) — nello spirito della
     "canzone piu' irritante" di Scott Rickard. Genera una traccia MIDI
@@ -299,48 +1702,33 @@ def midi_costas_generator(original_midi, min_order, base_pitch, pitch_range_semi
     all'interno di ciascun ciclo (proprieta' di Costas), quindi la melodia
     non presenta alcun pattern memorizzabile.
     Le tracce originali vengono mantenute; questa si aggiunge come nuova traccia.
+    Con streaming=True la traccia e' una LazyTrack: le note vengono generate
+    passo per passo durante la scrittura (save_midi_file).
     """
-    perm, n, p, g = generate_costas_array(min_order)
+    perm, n, p, g = generate_costas_array(min_order, construction)
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
     for track in original_midi.tracks:
         new_midi.tracks.append(track)
 
-    total_ticks = 0
-    for track in original_midi.tracks:
-        current_time = 0
-        for msg in track:
-            current_time += msg.time
-        total_ticks = max(total_ticks, current_time)
+    total_ticks = build_time_index(original_midi)['end_tick']
 
     if total_ticks == 0:
         st.warning("Il brano originale non contiene eventi validi. Il generatore Costas non verra' aggiunto.")
         return new_midi, (n, p, g)
 
     step_ticks = max(1, int(round(step_beats * original_midi.ticks_per_beat)))
-    costas_track = mido.MidiTrack()
-    costas_track.name = f"Costas Generator (n={n}, p={p}, g={g})"
-    costas_track.append(mido.Message('program_change', program=0, channel=channel, time=0))  # Acoustic Grand Piano di default
+    note_len = max(1, int(step_ticks * 0.9))
+    denom = max(1, n - 1)
+    step_pitches = [max(0, min(127, base_pitch + int(round(slot * pitch_range_semitones / denom)))) for slot in perm[:n]]
 
-    events = []
-    t = 0
-    i = 0
-    while t < total_ticks:
-        slot = perm[i % n]
-        denom = max(1, n - 1)
-        pitch = base_pitch + int(round(slot * pitch_range_semitones / denom))
-        pitch = max(0, min(127, pitch))
-        note_len = max(1, int(step_ticks * 0.9))
-        events.append({'msg': mido.Message('note_on', note=pitch, velocity=95, channel=channel, time=0), 'abs_time': t})
-        events.append({'msg': mido.Message('note_off', note=pitch, velocity=0, channel=channel, time=0), 'abs_time': t + note_len})
-        t += step_ticks
-        i += 1
-
-    events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-    last_abs_time = 0
-    for event_data in events:
-        delta = max(0, event_data['abs_time'] - last_abs_time)
-        costas_track.append(event_data['msg'].copy(time=delta))
-        last_abs_time = event_data['abs_time']
+    def _costas_notes():
+        for i, t in enumerate(range(0, total_ticks, step_ticks)):
+            yield t, t + note_len, step_pitches[i % n], 95, channel
+
+    costas_track = _generated_track(
+        f"Costas Generator (n={n}, p={p}, g={g})",
+        [mido.Message('program_change', program=0, channel=channel, time=0)],  # Acoustic Grand Piano di default
+        _costas_notes, streaming)
 
     new_midi.tracks.append(costas_track)
     return new_midi, (n, p, g)
@@ -671,7 +2059,7 @@ def _xenakis_snap_to_sieve(value, sieve):
 
 def midi_xenakis_stochastic(original_midi, sieve_moduli, mean_events_per_beat, pitch_center,
                              pitch_spread_semitones, duration_mean_beats, velocity_mean,
-                             velocity_spread, seed=None):
+                             velocity_spread, seed=None, streaming=False):
     """
     Genera una "nuvola di suoni" stocastica (Pithoprakta/Achorripsis):
       - Tempi di attacco: processo di Poisson (intertempi con distribuzione
@@ -681,9 +2069,11 @@ def midi_xenakis_stochastic(original_midi, sieve_moduli, mean_events_per_beat, p
       - Durata: distribuzione esponenziale attorno a duration_mean_beats.
       - Dinamica: distribuzione Gaussiana attorno a velocity_mean.
     Copre l'intera durata del brano originale; le tracce originali restano
-    intatte, la nuvola si aggiunge come nuova traccia.
+    intatte, la nuvola si aggiunge come nuova traccia. Con streaming=True la
+    nuvola e' una LazyTrack generata evento per evento durante la scrittura.
     """
-    rng = np.random.default_rng(seed)
+    # ogni iterazione della traccia ricrea lo stesso RNG (anche senza seed)
+    seed_seq = np.random.SeedSequence(seed)
     sieve = generate_sieve(sieve_moduli, universe=(0, 128))
     if not sieve:
         sieve = list(range(128))
@@ -693,51 +2083,37 @@ def midi_xenakis_stochastic(original_midi, sieve_moduli, mean_events_per_beat, p
     for track in original_midi.tracks:
         new_midi.tracks.append(track)
 
-    total_ticks = 0
-    for track in original_midi.tracks:
-        current_time = 0
-        for msg in track:
-            current_time += msg.time
-        total_ticks = max(total_ticks, current_time)
+    total_ticks = build_time_index(original_midi)['end_tick']
 
     if total_ticks == 0:
         st.warning("Il brano originale non contiene eventi validi. La nuvola stocastica non verra' aggiunta.")
         return new_midi, sieve
 
-    xenakis_track = mido.MidiTrack()
-    xenakis_track.name = f"Xenakis Stochastic Cloud (sieve n={len(sieve)})"
-    xenakis_track.append(mido.Message('program_change', program=0, channel=0, time=0))  # Acoustic Grand Piano di default
-
     total_beats = total_ticks / ticks_per_beat
     lam = max(0.05, mean_events_per_beat)
 
-    events = []
-    t = 0.0
-    while t < total_beats:
-        inter_arrival = rng.exponential(1.0 / lam)  # processo di Poisson
-        t += inter_arrival
-        if t >= total_beats:
-            break
+    def _xenakis_notes():
+        rng = np.random.default_rng(seed_seq)
+        t = 0.0
+        while t < total_beats:
+            inter_arrival = rng.exponential(1.0 / lam)  # processo di Poisson
+            t += inter_arrival
+            if t >= total_beats:
+                break
 
-        raw_pitch = rng.normal(pitch_center, pitch_spread_semitones)
-        pitch = int(round(_xenakis_snap_to_sieve(raw_pitch, sieve)))
-        pitch = max(0, min(127, pitch))
+            raw_pitch = rng.normal(pitch_center, pitch_spread_semitones)
+            pitch = int(round(_xenakis_snap_to_sieve(raw_pitch, sieve)))
+            pitch = max(0, min(127, pitch))
 
-        dur_beats = max(0.05, rng.exponential(duration_mean_beats))
-        velocity = int(round(np.clip(rng.normal(velocity_mean, velocity_spread), 1, 127)))
+            dur_beats = max(0.05, rng.exponential(duration_mean_beats))
+            velocity = int(round(np.clip(rng.normal(velocity_mean, velocity_spread), 1, 127)))
 
-        start_tick = int(round(t * ticks_per_beat))
-        end_tick = int(round((t + dur_beats) * ticks_per_beat))
+            yield int(round(t * ticks_per_beat)), int(round((t + dur_beats) * ticks_per_beat)), pitch, velocity, 0
 
-        events.append({'msg': mido.Message('note_on', note=pitch, velocity=velocity, channel=0, time=0), 'abs_time': start_tick})
-        events.append({'msg': mido.Message('note_off', note=pitch, velocity=0, channel=0, time=0), 'abs_time': end_tick})
-
-    events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-    last_abs_time = 0
-    for event_data in events:
-        delta = max(0, event_data['abs_time'] - last_abs_time)
-        xenakis_track.append(event_data['msg'].copy(time=delta))
-        last_abs_time = event_data['abs_time']
+    xenakis_track = _generated_track(
+        f"Xenakis Stochastic Cloud (sieve n={len(sieve)})",
+        [mido.Message('program_change', program=0, channel=0, time=0)],  # Acoustic Grand Piano di default
+        _xenakis_notes, streaming)
 
     new_midi.tracks.append(xenakis_track)
     return new_midi, sieve
@@ -880,9 +2256,43 @@ def _eno_prime_sequence(count, start_from=11):
     return primes
 
 
+def eno_loop_onsets(loop_len_ticks, phase, total_ticks):
+    """Attacchi di un loop in forma chiusa: np.arange(fase, totale, periodo)."""
+    return np.arange(phase, total_ticks, loop_len_ticks, dtype=np.int64)
+
+
+def eno_system_period(loop_lengths, phases):
+    """
+    Analisi esatta della periodicita' del sistema. Restituisce (periodo,
+    riallineamento): il periodo e' il MCM delle lunghezze dei loop (dopo il
+    quale l'intero sistema si ripete identico); il riallineamento e' il primo
+    tick in cui due loop suonano insieme, come (tick, i, j), oppure None se
+    nessuna coppia coincide mai. Per ogni coppia il tick e' la soluzione del
+    teorema cinese del resto t = fase_i (mod L_i), t = fase_j (mod L_j),
+    risolubile solo se fase_j - fase_i e' multiplo di MCD(L_i, L_j).
+    """
+    lengths = [int(length) for length in loop_lengths]
+    phases = [int(phase) for phase in phases]
+    period = math.lcm(*lengths) if lengths else 0
+    realign = None
+    for i in range(len(lengths)):
+        for j in range(i + 1, len(lengths)):
+            g = math.gcd(lengths[i], lengths[j])
+            diff = phases[j] - phases[i]
+            if diff % g:
+                continue
+            mod_j = lengths[j] // g
+            k = (diff // g) * pow(lengths[i] // g, -1, mod_j) % mod_j if mod_j > 1 else 0
+            # fase_i < L_i e fase_j < L_j: la soluzione minima e' gia' >= entrambe le fasi
+            tick = phases[i] + lengths[i] * k
+            if realign is None or tick < realign[0]:
+                realign = (tick, i, j)
+    return period, realign
+
+
 def midi_eno_generative(original_midi, num_loops=6, min_loop_beats=8, max_loop_beats=32,
                          note_length_ratio=0.35, duration_multiplier=4, velocity_base=55,
-                         seed=None):
+                         seed=None, streaming=False, merge_loops=False):
     """
     Genera un sistema di loop asincroni in stile Music for Airports/Discreet
     Music: ogni loop ripete una singola nota (derivata dal materiale del
@@ -893,9 +2303,18 @@ def midi_eno_generative(original_midi, num_loops=6, min_loop_beats=8, max_loop_b
     loop, sfasandosi continuamente l'uno rispetto all'altro.
     Le tracce originali restano intatte; il sistema generativo si aggiunge
     come nuove tracce indipendenti (una per loop), per poter regolare in DAW
-    volume/timbro di ciascun loop separatamente.
+    volume/timbro di ciascun loop separatamente, oppure (merge_loops=True)
+    come un'unica traccia con tutti i loop fusi da un solo lexsort.
+    Gli attacchi di ogni loop sono in forma chiusa (np.arange dalla fase di
+    entrata, a finestre di STREAM_CHUNK_NOTES periodi) e le velocity sono
+    estratte finestra per finestra dall'RNG figlio del seed per loop (la
+    stessa sequenza di un unico batch), quindi ogni loop si rigenera
+    identico: con streaming=True le tracce sono LazyTrack scritte durante il
+    salvataggio, e la traccia fusa unisce i loop con heapq.merge.
+    Restituisce (new_midi, loops_info, system_info): loops_info ha una tupla
+    (pitch, ciclo, primo, fase) per loop; system_info contiene periodo
+    esatto del sistema, primo riallineamento e durata generata in tick.
     """
-    rng = np.random.default_rng(seed)
     ticks_per_beat = original_midi.ticks_per_beat
 
     pitches_found = []
@@ -905,60 +2324,86 @@ def midi_eno_generative(original_midi, num_loops=6, min_loop_beats=8, max_loop_b
                 pitches_found.append(msg.note)
     if not pitches_found:
         st.warning("Nessuna nota trovata nel brano. Il sistema generativo non verra' aggiunto.")
-        return original_midi, []
+        return original_midi, [], None
     pitches_found.sort()
 
     new_midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
     for track in original_midi.tracks:
         new_midi.tracks.append(track)
 
-    total_ticks = 0
-    for track in original_midi.tracks:
-        current_time = 0
-        for msg in track:
-            current_time += msg.time
-        total_ticks = max(total_ticks, current_time)
+    total_ticks = build_time_index(original_midi)['end_tick']
     if total_ticks == 0:
         total_ticks = ticks_per_beat * 4 * 8
+    base_ticks = total_ticks
     total_ticks = int(total_ticks * max(1, duration_multiplier))
 
     primes = _eno_prime_sequence(num_loops, start_from=11)
     min_ticks = int(min_loop_beats * ticks_per_beat)
     max_ticks = max(min_ticks + ticks_per_beat, int(max_loop_beats * ticks_per_beat))
 
+    # un RNG figlio per loop: ogni traccia si rigenera identica e indipendente dalle altre
+    loop_seeds = np.random.SeedSequence(seed).spawn(num_loops)
+
     loops_info = []
     for i in range(num_loops):
         p = primes[i]
         scale = min_ticks + (p % max(1, (max_ticks - min_ticks)))
         loop_len_ticks = max(ticks_per_beat, scale)
-
         pitch = pitches_found[i % len(pitches_found)]
+        # entrata sfalsata del loop: prima estrazione dell'RNG del loop
+        phase = int(np.random.default_rng(loop_seeds[i]).uniform(0, loop_len_ticks))
+        loops_info.append((pitch, loop_len_ticks, p, phase))
+
+    def _loop_chunks(i):
+        """Blocchi (start, end, pitch, velocity) del loop i, rigenerati dal suo seed a finestre di tick."""
+        pitch, loop_len_ticks, _, _ = loops_info[i]
+        loop_rng = np.random.default_rng(loop_seeds[i])
+        phase = int(loop_rng.uniform(0, loop_len_ticks))
         note_len = max(1, int(loop_len_ticks * note_length_ratio))
-        phase_offset = int(rng.uniform(0, loop_len_ticks))  # entrata sfalsata del loop
-
-        loop_track = mido.MidiTrack()
-        loop_track.name = f"Eno Loop {i + 1} (pitch={pitch}, ciclo={loop_len_ticks}t, primo={p})"
-        loop_track.append(mido.Message('program_change', program=0, channel=0, time=0))
-
-        events = []
-        t = phase_offset
-        while t < total_ticks:
-            vel = int(np.clip(velocity_base + rng.normal(0, 6), 15, 90))
-            events.append({'msg': mido.Message('note_on', note=pitch, velocity=vel, channel=0, time=0), 'abs_time': t})
-            events.append({'msg': mido.Message('note_off', note=pitch, velocity=0, channel=0, time=0), 'abs_time': t + note_len})
-            t += loop_len_ticks
-
-        events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-        last_abs_time = 0
-        for event_data in events:
-            delta = max(0, event_data['abs_time'] - last_abs_time)
-            loop_track.append(event_data['msg'].copy(time=delta))
-            last_abs_time = event_data['abs_time']
-
-        new_midi.tracks.append(loop_track)
-        loops_info.append((pitch, loop_len_ticks, p))
+        window = loop_len_ticks * STREAM_CHUNK_NOTES
+        for window_start in range(phase, total_ticks, window):
+            start = eno_loop_onsets(loop_len_ticks, window_start, min(total_ticks, window_start + window))
+            velocity = np.clip(velocity_base + loop_rng.normal(0, 6, size=len(start)), 15, 90).astype(np.int64)
+            yield start, start + note_len, np.full(len(start), pitch, dtype=np.int64), velocity
+
+    def _loop_notes(i):
+        return lambda: _note_chunks_to_stream(_loop_chunks(i), 0)
+
+    def _system_notes():
+        """Tutti i loop fusi in ordine di attacco (a parita' di tick, per indice di loop: heapq.merge e' stabile)."""
+        return heapq.merge(*(_loop_notes(i)() for i in range(num_loops)), key=lambda note: note[0])
+
+    def _system_arrays():
+        """Come _system_notes, ma materializzato in colonne con un solo lexsort."""
+        chunks = [(i, chunk) for i in range(num_loops) for chunk in _loop_chunks(i)]
+        if not chunks:
+            return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+        loop_idx = np.concatenate([np.full(len(chunk[0]), i) for i, chunk in chunks])
+        start, end, pitch, velocity = (np.concatenate(col) for col in zip(*(chunk for _, chunk in chunks)))
+        order = np.lexsort((loop_idx, start))
+        return start[order], end[order], pitch[order], velocity[order]
+
+    def _header():
+        return [mido.Message('program_change', program=0, channel=0, time=0)]
+
+    if merge_loops:
+        name = f"Eno System ({num_loops} loop)"
+        if streaming:
+            new_midi.tracks.append(LazyTrack(name, _header(), _system_notes))
+        else:
+            track = mido.MidiTrack([mido.MetaMessage('track_name', name=name, time=0)] + _header())
+            start, end, pitch, velocity = _system_arrays()
+            new_midi.tracks.append(_note_arrays_to_track(track, start, end, pitch, velocity, np.zeros(len(start), dtype=np.int64)))
+    else:
+        for i, (pitch, loop_len_ticks, p, _) in enumerate(loops_info):
+            new_midi.tracks.append(_generated_track(
+                f"Eno Loop {i + 1} (pitch={pitch}, ciclo={loop_len_ticks}t, primo={p})",
+                _header(), _loop_notes(i), streaming))
 
-    return new_midi, loops_info
+    period, realign = eno_system_period([info[1] for info in loops_info], [info[3] for info in loops_info])
+    system_info = {'period_ticks': period, 'realign': realign,
+                   'total_ticks': total_ticks, 'base_ticks': base_ticks}
+    return new_midi, loops_info, system_info
 
 
 # --- Compositori: Johann Sebastian Bach — Canone Rigoroso (Contrappunto Matematico) ---
@@ -970,78 +2415,142 @@ def midi_eno_generative(original_midi, num_loops=6, min_loop_beats=8, max_loop_b
 # costruzione e' interamente deterministica: nessun elemento stocastico, la
 # coerenza nasce dalla trasformazione esatta di un'unica linea generatrice.
 
-def derive_bach_subject(original_midi, max_notes=24):
-    """Estrae il soggetto (dux): le prime max_notes note della prima traccia
-    con contenuto melodico, in ordine cronologico."""
+BACH_FORMS = ["Canone", "Esposizione di fuga"]
+BACH_TRANSFORMATIONS = ["Nessuna (canone rigoroso)", "Inversione (canone al rovescio)",
+                        "Retrogrado (canone cancrizzante)", "Aumentazione ritmica (comes raddoppiato)"]
+
+
+def derive_bach_subject(original_midi, max_notes=None):
+    """Estrae il soggetto (dux) come colonne NumPy 'start', 'end', 'pitch',
+    'velocity' in ordine cronologico: l'intera prima traccia con contenuto
+    melodico, oppure solo le prime max_notes note."""
     for track in original_midi.tracks:
-        notes = extract_notes(track, original_midi.ticks_per_beat)
-        if notes:
-            notes.sort(key=lambda n: n['start'])
-            return notes[:max_notes]
-    return []
+        table = extract_note_table(track, original_midi.ticks_per_beat)
+        if len(table['start']):
+            return {col: table[col][:max_notes] for col in ('start', 'end', 'pitch', 'velocity')}
+    return None
+
+
+def _bach_voice_notes(subject, entry_start, entry_transpose, entry_invert, entry_aug, axis_pitch):
+    """
+    Applica in broadcasting (ingressi x note) le trasformazioni del soggetto:
+    trasposizione, inversione attorno ad axis_pitch e aumentazione ritmica,
+    ciascuna con il proprio tick d'ingresso. Le colonne del soggetto sono
+    1-D (stesso soggetto per tutti gli ingressi) oppure ingressi x note (una
+    forma per ingresso, es. diritta o retrograda). Restituisce le colonne
+    appiattite (start, end, pitch, velocity) di tutti gli ingressi.
+    """
+    subject_pitch = np.atleast_2d(subject['pitch'])
+    pitch = np.where(entry_invert[:, None], 2 * axis_pitch - subject_pitch, subject_pitch)
+    pitch = np.clip(pitch + entry_transpose[:, None], 0, 127)
+    start = (np.atleast_2d(subject['start']) * entry_aug[:, None]).astype(np.int64) + entry_start[:, None]
+    end = (np.atleast_2d(subject['end']) * entry_aug[:, None]).astype(np.int64) + entry_start[:, None]
+    velocity = np.broadcast_to(np.atleast_2d(subject['velocity']), pitch.shape)
+    return start.ravel(), np.maximum(start + 1, end).ravel(), pitch.ravel(), velocity.ravel()
 
 
 def midi_bach_canon(original_midi, num_voices=2, interval_semitones=7,
                      delay_beats=2, transformation="Nessuna (canone rigoroso)",
-                     augmentation_factor=2):
+                     augmentation_factor=2, form="Canone", max_subject_notes=None):
     """
-    Costruisce un canone rigoroso: il soggetto (dux) e' estratto dal brano,
-    poi ogni voce successiva (comes) lo ripropone a distanza di delay_beats,
+    Costruisce un canone rigoroso: il soggetto (dux) e' estratto dal brano
+    (l'intera prima linea melodica, o le prime max_subject_notes note), poi
+    ogni voce successiva (comes) lo ripropone a distanza di delay_beats,
     trasposta di interval_semitones * indice-voce, ed eventualmente
     trasformata (inversione, retrogrado, aumentazione ritmica) — le tecniche
-    classiche del contrappunto rigoroso bachiano. Ogni voce e' una traccia
-    MIDI indipendente; le tracce originali restano intatte.
+    classiche del contrappunto rigoroso bachiano.
+    Con form "Esposizione di fuga" gli ingressi cadono a ogni frase (lunghezza
+    rilevata da detect_meter) per tutta la durata del brano, ruotando tra le
+    voci: le voci dispari rispondono a interval_semitones (risposta reale),
+    ogni coppia di voci sta un'ottava sotto la precedente. Ogni ingresso
+    suona num_voices frasi della linea (soggetto + seguito come
+    controsoggetto), cosi' dopo l'esposizione tutte le voci restano attive;
+    la trasformazione (retrogrado compreso) si applica ai soli rientri dopo
+    l'esposizione, che enuncia sempre il soggetto diritto. Nel canone il
+    retrogrado riguarda tutte le voci (canone cancrizzante), inversione e
+    aumentazione i soli comes.
+    Le voci sono calcolate in blocco sugli array del soggetto; ogni voce e'
+    una traccia MIDI indipendente e le tracce originali restano intatte.
     """
-    subject = derive_bach_subject(original_midi, max_notes=24)
-    if not subject:
+    subject = derive_bach_subject(original_midi, max_notes=max_subject_notes)
+    if subject is None:
         st.warning("Nessun soggetto melodico trovato. Il canone non verra' generato.")
         return original_midi, []
 
     ticks_per_beat = original_midi.ticks_per_beat
-    t0 = subject[0]['start']
-    norm_subject = [{'pitch': n['pitch'], 'start': n['start'] - t0, 'end': n['end'] - t0, 'velocity': n['velocity']} for n in subject]
-    axis_pitch = norm_subject[0]['pitch']  # asse di inversione = prima nota del soggetto (dux)
-
+    fugue = form == "Esposizione di fuga"
+    t0 = int(subject['start'][0])
+    piece_end = max((int(message_table(track)['abs_tick'][-1]) for track in original_midi.tracks
+                     if len(message_table(track)['abs_tick'])), default=0)
+    if fugue:
+        meter = detect_meter(original_midi)
+        entry_span = max(ticks_per_beat, int(meter['phrase_bars'] * meter['bar_ticks']))
+        entry_len = entry_span * num_voices
+        subject = {col: values[subject['start'] < t0 + entry_len] for col, values in subject.items()}
+    subject = {'start': subject['start'] - t0, 'end': subject['end'] - t0,
+               'pitch': subject['pitch'].astype(np.int64), 'velocity': subject['velocity'].astype(np.int64)}
+    axis_pitch = int(subject['pitch'][0])  # asse di inversione = prima nota del soggetto (dux)
+
+    retrograde = None
     if transformation == "Retrogrado (canone cancrizzante)":
-        total_dur = max(n['end'] for n in norm_subject)
-        norm_subject = [{'pitch': n['pitch'], 'start': total_dur - n['end'], 'end': total_dur - n['start'], 'velocity': n['velocity']} for n in norm_subject]
-        norm_subject.sort(key=lambda n: n['start'])
+        total_dur = subject['end'].max()
+        order = np.argsort(total_dur - subject['end'], kind='stable')
+        retrograde = {'start': (total_dur - subject['end'])[order], 'end': (total_dur - subject['start'])[order],
+                      'pitch': subject['pitch'][order], 'velocity': subject['velocity'][order]}
 
     new_midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
     for track in original_midi.tracks:
         new_midi.tracks.append(track)
 
-    delay_ticks = int(delay_beats * ticks_per_beat)
+    voice_idx = np.arange(num_voices)
+    if fugue:
+        # un ingresso a ogni frase fino alla fine del brano, almeno uno per voce
+        num_entries = max(num_voices, -(-max(0, piece_end - t0) // entry_span))
+        entry = np.arange(num_entries)
+        entry_voice = entry % num_voices
+        entry_start = t0 + entry * entry_span
+        entry_transpose = interval_semitones * (entry_voice % 2) - 12 * (entry_voice // 2)
+        transformed = entry >= num_voices
+    else:
+        entry_voice = voice_idx
+        entry_start = voice_idx * int(delay_beats * ticks_per_beat)
+        entry_transpose = interval_semitones * voice_idx
+        transformed = voice_idx > 0
+    entry_invert = transformed & (transformation == "Inversione (canone al rovescio)")
+    aug_on = transformed & (transformation == "Aumentazione ritmica (comes raddoppiato)")
+    entry_aug = np.where(aug_on, augmentation_factor, 1)
+    if retrograde is not None:
+        # fuga: retrogrado per i soli rientri trasformati; canone: tutte le voci
+        entry_retro = transformed if fugue else np.ones(entry_voice.size, dtype=bool)
+        subject = {col: np.where(entry_retro[:, None], retrograde[col][None, :], subject[col][None, :]) for col in subject}
+
+    start, end, pitch, velocity = _bach_voice_notes(subject, entry_start, entry_transpose, entry_invert, entry_aug, axis_pitch)
+    n_notes = subject['start'].shape[-1]
+    note_voice = np.repeat(entry_voice, n_notes)
+    if fugue:
+        # un rientro aumentato si ferma dove inizia il successivo della stessa voce
+        keep = start - np.repeat(entry_start, n_notes) < entry_len
+        end = np.minimum(end, np.repeat(entry_start, n_notes) + entry_len)
+        start, end, pitch, velocity, note_voice = start[keep], np.maximum(start + 1, end)[keep], pitch[keep], velocity[keep], note_voice[keep]
     voices_info = []
     for v in range(num_voices):
-        voice_track = mido.MidiTrack()
-        transpose = interval_semitones * v
-        aug = augmentation_factor if (v > 0 and transformation == "Aumentazione ritmica (comes raddoppiato)") else 1
         channel = min(v, 15)
-        voice_track.name = f"Bach Canone Voce {v + 1} ({'dux' if v == 0 else 'comes'}, +{transpose}st, delay={v * delay_beats}beat, aug x{aug})"
+        sel = note_voice == v
+        first = np.flatnonzero(entry_voice == v)[0]
+        transpose = int(entry_transpose[first])
+        aug = int(entry_aug[entry_voice == v].max())
+        voice_delay_beats = (int(entry_start[first]) - t0) / ticks_per_beat if fugue else v * delay_beats
+        if fugue:
+            role = 'soggetto' if v % 2 == 0 else 'risposta'
+            name = f"Bach Fuga Voce {v + 1} ({role}, {transpose:+d}st, ingresso={voice_delay_beats:g}beat, ingressi={int(np.sum(entry_voice == v))})"
+        else:
+            name = f"Bach Canone Voce {v + 1} ({'dux' if v == 0 else 'comes'}, +{transpose}st, delay={v * delay_beats}beat, aug x{aug})"
+        voice_track = mido.MidiTrack()
+        voice_track.name = name
         voice_track.append(mido.Message('program_change', program=0, channel=channel, time=0))
-
-        events = []
-        voice_delay = delay_ticks * v
-        for n in norm_subject:
-            pitch = n['pitch'] + transpose
-            if v > 0 and transformation == "Inversione (canone al rovescio)":
-                pitch = (2 * axis_pitch - n['pitch']) + transpose
-            pitch = max(0, min(127, pitch))
-            start = int(n['start'] * aug) + voice_delay
-            end = int(n['end'] * aug) + voice_delay
-            events.append({'msg': mido.Message('note_on', note=pitch, velocity=n['velocity'], channel=channel, time=0), 'abs_time': start})
-            events.append({'msg': mido.Message('note_off', note=pitch, velocity=0, channel=channel, time=0), 'abs_time': max(start + 1, end)})
-
-        events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-        last_abs_time = 0
-        for event_data in events:
-            delta = max(0, event_data['abs_time'] - last_abs_time)
-            voice_track.append(event_data['msg'].copy(time=delta))
-            last_abs_time = event_data['abs_time']
-
+        _note_arrays_to_track(voice_track, start[sel], end[sel], pitch[sel], velocity[sel], np.full(int(sel.sum()), channel))
         new_midi.tracks.append(voice_track)
-        voices_info.append((transpose, v * delay_beats, aug))
+        voices_info.append((transpose, voice_delay_beats, aug))
 
     return new_midi, voices_info
 
@@ -1055,66 +2564,109 @@ def midi_bach_canon(original_midi, num_voices=2, interval_semitones=7,
 # aritmetico esplicito applicato alla LUNGHEZZA della cellula, non alla sua
 # sostanza melodica, che resta sempre quella derivata dal brano originale.
 
-def derive_glass_cell(original_midi, cell_length=8):
-    for track in original_midi.tracks:
-        notes = extract_notes(track, original_midi.ticks_per_beat)
-        if notes:
-            notes.sort(key=lambda n: n['start'])
-            return notes[:cell_length]
-    return []
+GLASS_DIRECTIONS = ["Additivo (solo crescita)", "Additivo-sottrattivo (cresce poi decresce)",
+                    "1+1 (combinazioni di due cellule)"]
+GLASS_DEFAULT_FORMULA = "ab, aab, aaab, aaaab"
+
+
+def derive_glass_cell(original_midi, cell_length=8):
+    """Prime cell_length note della prima traccia con note, come colonne
+    NumPy 'start', 'end', 'pitch', 'velocity' (start relativi alla prima)."""
+    for track in original_midi.tracks:
+        table = extract_note_table(track, original_midi.ticks_per_beat)
+        if len(table['start']):
+            t0 = table['start'][0]
+            return {'start': table['start'][:cell_length] - t0, 'end': table['end'][:cell_length] - t0,
+                    'pitch': table['pitch'][:cell_length], 'velocity': table['velocity'][:cell_length]}
+    return None
+
+
+def parse_glass_formula(s):
+    """
+    Parsa una formula "1+1" tipo 'ab, aab, a+a+a+b' in una lista di stadi,
+    ciascuno una stringa di cellule 'a'/'b' ('+' e spazi ignorati).
+    """
+    stages = []
+    for chunk in s.replace(';', ',').split(','):
+        stage = ''.join(c for c in chunk.lower() if c in 'ab')
+        if stage:
+            stages.append(stage)
+    return stages
+
+
+def _glass_process_notes(cells, seg_cell, seg_len):
+    """
+    Srotola una sequenza di segmenti (cellula, numero di note iniziali) in
+    colonne di note: la durata di ogni segmento e' il massimo cumulato delle
+    fini della cellula (prefix max) fino a quella nota, gli offset dei
+    segmenti sono la somma cumulata delle durate e le note di ogni segmento
+    sono la parte triangolare inferiore degli indici (0..len-1), raccolta
+    con _ragged_arange.
+    """
+    base = np.cumsum([0] + [len(c['start']) for c in cells[:-1]])
+    cat = {col: np.concatenate([c[col] for c in cells]) for col in ('start', 'end', 'pitch', 'velocity')}
+    prefix_end = np.concatenate([np.maximum.accumulate(c['end']) for c in cells])
+    seg_first = base[seg_cell]
+    seg_dur = prefix_end[seg_first + seg_len - 1]
+    seg_offset = np.cumsum(seg_dur) - seg_dur
+    note_pos = np.repeat(seg_first, seg_len) + _ragged_arange(seg_len)
+    offset = np.repeat(seg_offset, seg_len)
+    start = offset + cat['start'][note_pos]
+    end = np.maximum(start + 1, offset + cat['end'][note_pos])
+    return start, end, cat['pitch'][note_pos], cat['velocity'][note_pos]
 
 
 def midi_glass_additive(original_midi, cell_length_notes=8, direction="Additivo (solo crescita)",
-                         repeats_per_stage=2):
+                         repeats_per_stage=2, formula=GLASS_DEFAULT_FORMULA):
     """
     Estrae una cellula di cell_length_notes note dal brano e la sottopone al
     processo additivo di Glass: ad ogni stadio la cellula viene troncata a
     1, 2, 3... note (fino alla lunghezza piena), ciascuno stadio ripetuto
     repeats_per_stage volte prima di passare allo stadio successivo. Se
     direction e' "additivo-sottrattivo", dopo aver raggiunto la lunghezza
-    piena il processo si inverte, tornando a 1 nota. Il risultato si
-    aggiunge come nuova traccia; le tracce originali restano intatte.
+    piena il processo si inverte, tornando a 1 nota. Con direction "1+1"
+    le note estratte (2 x cell_length_notes) formano due cellule a e b,
+    concatenate stadio per stadio secondo formula ('ab, aab, aaab...'),
+    come in "1+1". Tutto il processo e' calcolato in blocco sugli array
+    della cellula; il risultato si aggiunge come nuova traccia e le tracce
+    originali restano intatte.
     """
-    cell = derive_glass_cell(original_midi, cell_length_notes)
-    if len(cell) < 2:
+    one_plus_one = direction == "1+1 (combinazioni di due cellule)"
+    material = derive_glass_cell(original_midi, cell_length_notes * (2 if one_plus_one else 1))
+    if material is None or len(material['start']) < (4 if one_plus_one else 2):
         st.warning("Materiale insufficiente per costruire la cellula. Il processo additivo non verra' generato.")
         return original_midi, []
 
     ticks_per_beat = original_midi.ticks_per_beat
-    t0 = cell[0]['start']
-    norm_cell = [{'pitch': n['pitch'], 'start': n['start'] - t0, 'end': n['end'] - t0, 'velocity': n['velocity']} for n in cell]
-
-    stages = list(range(1, len(norm_cell) + 1))
-    if direction == "Additivo-sottrattivo (cresce poi decresce)":
-        stages = stages + list(range(len(norm_cell) - 1, 0, -1))
+    repeats = max(1, repeats_per_stage)
+    if one_plus_one:
+        half = len(material['start']) // 2
+        cells = [{col: values[:half] for col, values in material.items()},
+                 {col: values[half:] - (material['start'][half] if col in ('start', 'end') else 0)
+                  for col, values in material.items()}]
+        stages = parse_glass_formula(formula) or parse_glass_formula(GLASS_DEFAULT_FORMULA)
+        tokens = np.array([ord(c) - ord('a') for stage in stages for _ in range(repeats) for c in stage])
+        seg_cell = tokens
+        seg_len = np.array([len(c['start']) for c in cells])[tokens]
+        cell_desc = f"cellule a={half}, b={len(cells[1]['start'])} note"
+    else:
+        cells = [material]
+        stages = list(range(1, len(material['start']) + 1))
+        if direction == "Additivo-sottrattivo (cresce poi decresce)":
+            stages = stages + list(range(len(material['start']) - 1, 0, -1))
+        seg_len = np.repeat(stages, repeats)
+        seg_cell = np.zeros(len(seg_len), dtype=np.int64)
+        cell_desc = f"cellula={len(material['start'])} note"
 
     new_midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
     for track in original_midi.tracks:
         new_midi.tracks.append(track)
 
     glass_track = mido.MidiTrack()
-    glass_track.name = f"Glass Additive Process (cellula={len(norm_cell)} note, {len(stages)} stadi)"
+    glass_track.name = f"Glass Additive Process ({cell_desc}, {len(stages)} stadi)"
     glass_track.append(mido.Message('program_change', program=0, channel=0, time=0))
-
-    events = []
-    cursor = 0
-    for stage_len in stages:
-        sub_cell = norm_cell[:stage_len]
-        stage_dur = max(n['end'] for n in sub_cell)
-        for _ in range(max(1, repeats_per_stage)):
-            for n in sub_cell:
-                start = cursor + n['start']
-                end = cursor + n['end']
-                events.append({'msg': mido.Message('note_on', note=n['pitch'], velocity=n['velocity'], channel=0, time=0), 'abs_time': start})
-                events.append({'msg': mido.Message('note_off', note=n['pitch'], velocity=0, channel=0, time=0), 'abs_time': max(start + 1, end)})
-            cursor += stage_dur
-
-    events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-    last_abs_time = 0
-    for event_data in events:
-        delta = max(0, event_data['abs_time'] - last_abs_time)
-        glass_track.append(event_data['msg'].copy(time=delta))
-        last_abs_time = event_data['abs_time']
+    start, end, pitch, velocity = _glass_process_notes(cells, seg_cell, seg_len)
+    _note_arrays_to_track(glass_track, start, end, pitch, velocity, np.zeros(len(start), dtype=np.int64))
 
     new_midi.tracks.append(glass_track)
     return new_midi, stages
@@ -1138,37 +2690,93 @@ MESSIAEN_MODES = {
 }
 
 
-def _messiaen_snap_to_mode(pitch, mode_intervals, transposition=0):
-    pc = (pitch - transposition) % 12
-    nearest = min(mode_intervals, key=lambda m: min(abs(m - pc), 12 - abs(m - pc)))
-    delta = nearest - pc
-    if delta > 6:
-        delta -= 12
-    if delta < -6:
-        delta += 12
-    return pitch + delta
+def _build_messiaen_snap_lut():
+    """
+    Tabelle a 12 voci per ogni (modo, trasposizione): per ogni classe di
+    altezza assoluta, lo spostamento in semitoni (-6..6) verso la classe del
+    modo piu' vicina in distanza circolare (a parita', l'intervallo piu' basso
+    del modo).
+    """
+    lut = {}
+    for mode_number, intervals in MESSIAEN_MODES.items():
+        intervals = np.asarray(intervals)
+        for transposition in range(12):
+            pc = (np.arange(12) - transposition) % 12
+            dist = np.abs(intervals[None, :] - pc[:, None])
+            nearest = intervals[np.argmin(np.minimum(dist, 12 - dist), axis=1)]
+            delta = nearest - pc
+            lut[(mode_number, transposition)] = np.where(delta > 6, delta - 12, np.where(delta < -6, delta + 12, delta))
+    return lut
+
+
+MESSIAEN_SNAP_LUT = _build_messiaen_snap_lut()
+
+
+def _build_non_retrogradable_catalog(min_len=3, max_len=15, values=(1, 2, 3)):
+    """
+    Catalogo precalcolato di tutti i ritmi non retrogradabili (palindromi)
+    di lunghezza min_len..max_len sui valori dati (in unita' di base):
+    {lunghezza: matrice (ritmi x lunghezza)}.
+    """
+    catalog = {}
+    for length in range(min_len, max_len + 1):
+        half = np.array(list(itertools.product(values, repeat=length // 2)), dtype=np.int64).reshape(-1, length // 2)
+        if length % 2:
+            center = np.repeat(np.asarray(values, dtype=np.int64), len(half))[:, None]
+            half = np.tile(half, (len(values), 1))
+            catalog[length] = np.hstack([half, center, half[:, ::-1]])
+        else:
+            catalog[length] = np.hstack([half, half[:, ::-1]])
+    return catalog
+
+
+MESSIAEN_NRR_CATALOG = _build_non_retrogradable_catalog()
+
+# Tala indiani del sistema suladi (sapta tala), la sistematizzazione
+# carnatica della tradizione dei deci-tala da cui Messiaen attingeva:
+# anga in unita' di base (anudrutam = 1, drutam = 2, laghu chatusra = 4).
+TALA_ANGA_UNITS = {'U': 1, 'O': 2, 'I': 4}
+TALA_CATALOG = {
+    "Dhruva (I O I I)": "IOII",
+    "Matya (I O I)": "IOI",
+    "Rupaka (O I)": "OI",
+    "Jhampa (I U O)": "IUO",
+    "Triputa (I O O)": "IOO",
+    "Ata (I I O O)": "IIOO",
+    "Eka (I)": "I",
+}
+MESSIAEN_RHYTHM_SOURCES = ["Ritmo non retrogradabile (catalogo)"] + [f"Tala: {name}" for name in TALA_CATALOG]
 
 
 def build_non_retrogradable_rhythm(cell_length, base_unit_ticks, rng):
-    """Costruisce una sequenza di durate palindroma (ritmo non retrogradabile):
-    identica letta avanti o indietro, per costruzione simmetrica attorno a un
-    valore centrale libero."""
-    half = cell_length // 2
-    half_values = [base_unit_ticks * int(rng.integers(1, 4)) for _ in range(half)]
-    center = [base_unit_ticks * int(rng.integers(1, 4))] if cell_length % 2 == 1 else []
-    return half_values + center + list(reversed(half_values))
+    """Estrae dal catalogo precalcolato una sequenza di durate palindroma
+    (ritmo non retrogradabile) di cell_length valori, in tick."""
+    cells = MESSIAEN_NRR_CATALOG[max(3, min(cell_length, max(MESSIAEN_NRR_CATALOG)))]
+    return cells[rng.integers(len(cells))] * base_unit_ticks
+
+
+def build_tala_rhythm(tala_name, base_unit_ticks):
+    """Durate in tick degli anga di un tala del catalogo."""
+    return np.array([TALA_ANGA_UNITS[a] for a in TALA_CATALOG[tala_name]], dtype=np.int64) * base_unit_ticks
 
 
 def midi_messiaen_modes(original_midi, mode_number=2, transposition=0,
-                         non_retrogradable_rhythm=True, rhythm_cell_notes=7, seed=None):
+                         non_retrogradable_rhythm=True, rhythm_cell_notes=7, seed=None,
+                         rhythm_source="Ritmo non retrogradabile (catalogo)"):
     """
     Riquantizza ogni altezza del brano sulla classe piu' vicina del modo a
-    trasposizione limitata scelto, e (se attivo) sostituisce il ritmo
-    originale con una sequenza di durate non retrogradabile (palindroma),
-    riapplicata ciclicamente. Struttura a piu' tracce sempre preservata.
+    trasposizione limitata scelto (tabella a 12 voci per modo e
+    trasposizione), e (se attivo) sostituisce il ritmo originale con una
+    cellula di durate riapplicata ciclicamente: un ritmo non retrogradabile
+    (palindromo) estratto dal catalogo, oppure uno dei tala di TALA_CATALOG
+    (rhythm_source "Tala: ..."). Gli attacchi sono la somma cumulata delle
+    durate. Struttura a piu' tracce sempre preservata.
     """
     rng = np.random.default_rng(seed)
-    mode_intervals = MESSIAEN_MODES.get(mode_number, MESSIAEN_MODES[2])
+    if mode_number not in MESSIAEN_MODES:
+        mode_number = 2
+    mode_intervals = MESSIAEN_MODES[mode_number]
+    snap = MESSIAEN_SNAP_LUT[(mode_number, transposition % 12)]
     ticks_per_beat = original_midi.ticks_per_beat
     base_unit = max(1, ticks_per_beat // 4)
 
@@ -1178,45 +2786,34 @@ def midi_messiaen_modes(original_midi, mode_number=2, transposition=0,
         for i, t in enumerate(original_midi.tracks)
     ]
 
-    rhythm_cell = build_non_retrogradable_rhythm(rhythm_cell_notes, base_unit, rng) if non_retrogradable_rhythm else None
+    rhythm_cell = None
+    if non_retrogradable_rhythm:
+        if rhythm_source.startswith("Tala: ") and rhythm_source[len("Tala: "):] in TALA_CATALOG:
+            rhythm_cell = build_tala_rhythm(rhythm_source[len("Tala: "):], base_unit)
+        else:
+            rhythm_cell = build_non_retrogradable_rhythm(rhythm_cell_notes, base_unit, rng)
 
     new_midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
     any_notes = False
     for track_idx, track in enumerate(original_midi.tracks):
-        notes = extract_notes(track, ticks_per_beat)
+        notes = extract_note_table(track, ticks_per_beat)
         new_track = mido.MidiTrack()
         new_track.name = track_names[track_idx]
         for h in track_headers[track_idx]:
             new_track.append(h)
 
-        if not notes:
+        if not len(notes['start']):
             new_midi.tracks.append(new_track)
             continue
         any_notes = True
-        notes.sort(key=lambda n: n['start'])
 
-        events = []
-        cursor = notes[0]['start']
-        rhythm_idx = 0
-        for n in notes:
-            pitch = max(0, min(127, _messiaen_snap_to_mode(n['pitch'], mode_intervals, transposition)))
-            if non_retrogradable_rhythm:
-                dur = rhythm_cell[rhythm_idx % len(rhythm_cell)]
-                rhythm_idx += 1
-            else:
-                dur = max(1, n['end'] - n['start'])
-            start = cursor
-            end = cursor + dur
-            events.append({'msg': mido.Message('note_on', note=pitch, velocity=n['velocity'], channel=n['channel'], time=0), 'abs_time': start})
-            events.append({'msg': mido.Message('note_off', note=pitch, velocity=0, channel=n['channel'], time=0), 'abs_time': end})
-            cursor = end
-
-        events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-        last_abs_time = 0
-        for event_data in events:
-            delta = max(0, event_data['abs_time'] - last_abs_time)
-            new_track.append(event_data['msg'].copy(time=delta))
-            last_abs_time = event_data['abs_time']
+        pitch = np.clip(notes['pitch'] + snap[notes['pitch'] % 12], 0, 127)
+        if rhythm_cell is not None:
+            dur = np.resize(rhythm_cell, len(pitch))
+        else:
+            dur = np.maximum(1, notes['end'] - notes['start'])
+        end = notes['start'][0] + np.cumsum(dur)
+        _note_arrays_to_track(new_track, end - dur, end, pitch, notes['velocity'], notes['channel'])
 
         new_midi.tracks.append(new_track)
 
@@ -1255,15 +2852,27 @@ def _part_nearest_triad_tone(pitch, triad_pcs, position="T-1 (piu' vicina sotto)
     return pool[-1] if pool else pitch
 
 
+def _part_free_triad_tone(pitch, triad_pcs, sounding):
+    """T-1 che evita i raddoppi: la nota della triade piu' vicina sotto (o
+    uguale a) `pitch` che non sta gia' suonando (sounding: maschera a 128
+    voci); se suonano tutte, la piu' vicina sotto."""
+    candidates = [c for c in range(pitch, -1, -1) if c % 12 in triad_pcs]
+    return next((c for c in candidates if not sounding[c]), candidates[0] if candidates else pitch)
+
+
 def midi_part_tintinnabuli(original_midi, tonic_key="C", triad_type="Minore",
                             t_voice_position="T-1 (piu' vicina sotto)"):
     """
     Trasforma ogni traccia in una coppia di voci: la voce M mantiene
     l'altezza originale, la voce T viene calcolata deterministicamente come
     la nota della triade di tonica piu' vicina alla nota M, nella posizione
-    scelta. Struttura a piu' tracce raddoppiata (M + T per ogni traccia
-    originale con contenuto melodico).
+    scelta. Con "T-1 (evita le note gia' suonanti)" la voce T scende alla nota
+    della triade successiva se quella piu' vicina sta gia' suonando (nella
+    voce M o in un'altra traccia) all'attacco, interrogando l'indice degli
+    intervalli di nota. Struttura a piu' tracce raddoppiata (M + T per ogni
+    traccia originale con contenuto melodico).
     """
+    avoid_sounding = t_voice_position == "T-1 (evita le note gia' suonanti)"
     key_offset = get_key_offset(tonic_key)
     triad_intervals = [0, 3, 7] if triad_type == "Minore" else [0, 4, 7]
     triad_pcs = [(key_offset + iv) % 12 for iv in triad_intervals]
@@ -1297,12 +2906,23 @@ def midi_part_tintinnabuli(original_midi, tonic_key="C", triad_type="Minore",
         any_notes = True
         notes.sort(key=lambda n: n['start'])
 
+        if avoid_sounding:
+            # note che suonano su tutte le tracce a ciascun attacco: (attacco x pitch)
+            onsets = np.array([n['start'] for n in notes], dtype=np.int64)
+            sounding = np.zeros((len(notes), 128), dtype=bool)
+            for other_idx in range(len(original_midi.tracks)):
+                query, rows = notes_active_at_ticks(original_midi, other_idx, onsets)
+                sounding[query, build_note_interval_index(original_midi)[other_idx]['pitch'][rows]] = True
+
         m_events, t_events = [], []
-        for n in notes:
+        for i, n in enumerate(notes):
             m_events.append({'msg': mido.Message('note_on', note=n['pitch'], velocity=n['velocity'], channel=n['channel'], time=0), 'abs_time': n['start']})
             m_events.append({'msg': mido.Message('note_off', note=n['pitch'], velocity=0, channel=n['channel'], time=0), 'abs_time': max(n['start'] + 1, n['end'])})
 
-            t_pitch = max(0, min(127, _part_nearest_triad_tone(n['pitch'], triad_pcs, t_voice_position)))
+            if avoid_sounding:
+                t_pitch = _part_free_triad_tone(n['pitch'], triad_pcs, sounding[i])
+            else:
+                t_pitch = max(0, min(127, _part_nearest_triad_tone(n['pitch'], triad_pcs, t_voice_position)))
             t_events.append({'msg': mido.Message('note_on', note=t_pitch, velocity=max(10, n['velocity'] - 15), channel=t_channel, time=0), 'abs_time': n['start']})
             t_events.append({'msg': mido.Message('note_off', note=t_pitch, velocity=0, channel=t_channel, time=0), 'abs_time': max(n['start'] + 1, n['end'])})
 
@@ -1342,14 +2962,59 @@ def derive_reich_cell(original_midi, cell_length=8):
     return []
 
 
+REICH_PHASE_MODES = ["A gradini (Clapping Music)", "Continuo (Piano Phase)"]
+REICH_VOICE_LETTERS = "ABCDEFGH"
+
+
+def parse_reich_shift_rates(s, num_phased):
+    """
+    Parsa i moltiplicatori di sfasamento delle voci mobili tipo '1, 2, 3'
+    (la voce B si sfasa di 1x, la C di 2x...). Valori mancanti o non validi:
+    la k-esima voce mobile usa k.
+    """
+    rates = []
+    for chunk in s.split(','):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        try:
+            rates.append(max(0.0, float(chunk)))
+        except ValueError:
+            continue
+    return [rates[k] if k < len(rates) else float(k + 1) for k in range(num_phased)]
+
+
+def reich_phase_schedule(num_cycles, shift_ticks, shift_every_n_cycles, continuous=False):
+    """
+    Sfasamento di ogni ciclo come array. A gradini: +shift_ticks ogni
+    shift_every_n_cycles cicli (np.repeat dei gradini cumulati). Continuo:
+    deriva di shift_ticks / shift_every_n_cycles tick (frazionari) per ciclo,
+    cioe' la stessa velocita' media di sfasamento senza gradini.
+    """
+    if shift_every_n_cycles <= 0:
+        return np.zeros(num_cycles)
+    if continuous:
+        return np.arange(num_cycles) * (shift_ticks / shift_every_n_cycles)
+    steps = np.cumsum(np.full(num_cycles // shift_every_n_cycles + 1, shift_ticks, dtype=float)) - shift_ticks
+    return np.repeat(steps, shift_every_n_cycles)[:num_cycles]
+
+
 def midi_reich_phasing(original_midi, cell_length_notes=8, num_cycles=32,
-                        phase_shift_units=1, shift_every_n_cycles=4):
+                        phase_shift_units=1, shift_every_n_cycles=4, streaming=False,
+                        num_voices=2, shift_rates=None, phase_mode="A gradini (Clapping Music)"):
     """
     Estrae una cellula di cell_length_notes note e la fa suonare in loop su
-    due voci identiche: la voce A resta fissa, la voce B si sposta di
+    num_voices voci identiche: la voce A resta fissa, le altre si spostano di
     phase_shift_units "unita' di sfasamento" (in frazioni della durata media
-    di una nota della cellula) ogni shift_every_n_cycles cicli, in stile
-    Piano Phase/Clapping Music. Le tracce originali restano intatte.
+    di una nota della cellula) ogni shift_every_n_cycles cicli, moltiplicate
+    per il proprio shift_rates (default 1, 2, 3...), in stile Piano
+    Phase/Clapping Music. Con phase_mode "Continuo (Piano Phase)" le voci
+    mobili non saltano a gradini ma derivano di una frazione di tick a ogni
+    nota, come un esecutore leggermente piu' lento. La cellula e' replicata
+    per broadcasting (cicli x note) sullo sfasamento di ogni ciclo, a blocchi
+    di circa STREAM_CHUNK_NOTES note; le tracce originali restano intatte.
+    Con streaming=True le voci sono LazyTrack.
+    Restituisce (new_midi, sfasamento finale della voce B in tick).
     """
     cell = derive_reich_cell(original_midi, cell_length_notes)
     if len(cell) < 2:
@@ -1358,135 +3023,196 @@ def midi_reich_phasing(original_midi, cell_length_notes=8, num_cycles=32,
 
     ticks_per_beat = original_midi.ticks_per_beat
     t0 = cell[0]['start']
-    norm_cell = [{'pitch': n['pitch'], 'start': n['start'] - t0, 'end': n['end'] - t0, 'velocity': n['velocity']} for n in cell]
-    cell_span = max(n['end'] for n in norm_cell)
-    unit = cell_span / max(1, len(norm_cell))  # granularita' dello sfasamento
+    cell_start = np.array([n['start'] - t0 for n in cell], dtype=np.int64)
+    cell_end = np.array([n['end'] - t0 for n in cell], dtype=np.int64)
+    cell_pitch = np.array([n['pitch'] for n in cell], dtype=np.int64)
+    cell_velocity = np.array([n['velocity'] for n in cell], dtype=np.int64)
+    cell_span = int(cell_end.max())
+    unit = cell_span / max(1, len(cell))  # granularita' dello sfasamento
 
     new_midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
     for track in original_midi.tracks:
         new_midi.tracks.append(track)
 
-    voice_a = mido.MidiTrack()
-    voice_a.name = f"Reich Phasing Voce A (fissa, cellula={len(norm_cell)} note)"
-    voice_a.append(mido.Message('program_change', program=0, channel=0, time=0))
-
-    voice_b = mido.MidiTrack()
-    voice_b.name = f"Reich Phasing Voce B (sfasa +{phase_shift_units} ogni {shift_every_n_cycles} cicli)"
-    voice_b.append(mido.Message('program_change', program=0, channel=1, time=0))
-
-    events_a, events_b = [], []
-    current_phase_ticks = 0
-    for cyc in range(max(1, num_cycles)):
-        base_a = cyc * cell_span
-        base_b = cyc * cell_span + current_phase_ticks
-        for n in norm_cell:
-            sa, ea = base_a + n['start'], base_a + n['end']
-            events_a.append({'msg': mido.Message('note_on', note=n['pitch'], velocity=n['velocity'], channel=0, time=0), 'abs_time': sa})
-            events_a.append({'msg': mido.Message('note_off', note=n['pitch'], velocity=0, channel=0, time=0), 'abs_time': max(sa + 1, ea)})
-
-            sb, eb = base_b + n['start'], base_b + n['end']
-            events_b.append({'msg': mido.Message('note_on', note=n['pitch'], velocity=n['velocity'], channel=1, time=0), 'abs_time': sb})
-            events_b.append({'msg': mido.Message('note_off', note=n['pitch'], velocity=0, channel=1, time=0), 'abs_time': max(sb + 1, eb)})
-
-        if shift_every_n_cycles > 0 and (cyc + 1) % shift_every_n_cycles == 0:
-            current_phase_ticks += int(unit * phase_shift_units)
-
-    for evs, trk in ((events_a, voice_a), (events_b, voice_b)):
-        evs.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
-        last_abs_time = 0
-        for event_data in evs:
-            delta = max(0, event_data['abs_time'] - last_abs_time)
-            trk.append(event_data['msg'].copy(time=delta))
-            last_abs_time = event_data['abs_time']
+    # sfasamento mai negativo: ogni ciclo attacca dopo tutte le note del precedente
+    shift_ticks = max(0, int(unit * phase_shift_units))
+    cycles = max(1, num_cycles)
+    continuous = phase_mode == "Continuo (Piano Phase)"
+    num_voices = max(2, min(len(REICH_VOICE_LETTERS), num_voices))
+    rates = list(shift_rates) if shift_rates is not None else []
+    rates = [rates[k] if k < len(rates) else float(k + 1) for k in range(num_voices - 1)]
+    cycle_base = np.arange(cycles, dtype=np.int64) * cell_span
+
+    block_cycles = max(1, STREAM_CHUNK_NOTES // len(cell))
+
+    def _voice_offsets(schedule, rate):
+        """Sfasamento (cicli x note) di un blocco di cicli: a gradini costante nel ciclo, continuo anche dentro il ciclo."""
+        if continuous and shift_every_n_cycles > 0:
+            drift = shift_ticks * rate / shift_every_n_cycles
+            return np.rint(schedule[:, None] + drift * cell_start[None, :] / cell_span).astype(np.int64)
+        return np.broadcast_to(np.rint(schedule).astype(np.int64)[:, None], (len(schedule), len(cell)))
+
+    def _voice_chunks(rate):
+        """Blocchi (start, end, pitch, velocity) di block_cycles cicli, ciascuno in ordine di attacco."""
+        schedule = reich_phase_schedule(cycles, shift_ticks * rate, shift_every_n_cycles, continuous)
+        for first in range(0, cycles, block_cycles):
+            block = schedule[first:first + block_cycles]
+            base = cycle_base[first:first + block_cycles, None] + _voice_offsets(block, rate)
+            start = (base + cell_start[None, :]).ravel()
+            end = np.maximum(start + 1, (base + cell_end[None, :]).ravel())
+            order = np.argsort(start, kind='stable')
+            yield (start[order], end[order],
+                   np.tile(cell_pitch, len(block))[order], np.tile(cell_velocity, len(block))[order])
+
+    def _voice_notes(channel, rate):
+        return lambda: _note_chunks_to_stream(_voice_chunks(rate), channel)
+
+    new_midi.tracks.append(_generated_track(
+        f"Reich Phasing Voce A (fissa, cellula={len(cell)} note)",
+        [mido.Message('program_change', program=0, channel=0, time=0)],
+        _voice_notes(0, 0), streaming))
+    for k, rate in enumerate(rates, start=1):
+        units = f"{phase_shift_units * rate:g}"
+        if continuous:
+            desc = f"deriva continua +{shift_ticks * rate / max(1, shift_every_n_cycles):.3g} tick/ciclo"
+        else:
+            desc = f"sfasa +{units} ogni {shift_every_n_cycles} cicli"
+        new_midi.tracks.append(_generated_track(
+            f"Reich Phasing Voce {REICH_VOICE_LETTERS[k]} ({desc})",
+            [mido.Message('program_change', program=0, channel=k, time=0)],
+            _voice_notes(k, rate), streaming))
 
-    new_midi.tracks.append(voice_a)
-    new_midi.tracks.append(voice_b)
-    return new_midi, current_phase_ticks
+    # fase della voce B al termine dell'ultimo ciclo (indice `cycles` della stessa schedule)
+    final_phase = int(np.rint(reich_phase_schedule(cycles + 1, shift_ticks * rates[0], shift_every_n_cycles, continuous)[-1]))
+    return new_midi, final_phase
 
 
 # --- Funzioni di Decomposizione ---
 
-def midi_note_remapper(original_midi, target_scale_name, target_key_name, pitch_shift_range, velocity_randomization):
+def _scale_snap_table(scale_intervals):
+    """Tabella a 12 voci: per ogni classe di altezza relativa alla tonica, l'intervallo di scala piu' vicino."""
+    intervals = np.asarray(scale_intervals)
+    return intervals[np.argmin(np.abs(np.arange(12)[:, None] - intervals[None, :]), axis=1)]
+
+
+def midi_note_remapper(original_midi, target_scale_name, target_key_name, pitch_shift_range, velocity_randomization,
+                       seed=None):
     """
     Rimodella le note MIDI in base a una scala, tonalità e randomizzazione di pitch/velocity.
+    Con target_key_name "Auto (tonalità globale)" la tonica e' quella rilevata
+    sull'intero brano (global_key), con "Auto (segue le modulazioni)" quella
+    locale attorno a ogni nota (local_keys_at); con target_scale_name
+    "Auto (modo rilevato)" la scala e' la maggiore o minore naturale della
+    tonalita' (rilevata, o 'm' finale nel nome). Ogni note_off riceve lo
+    stesso pitch del note_on che chiude, cosi' nessuna nota resta appesa.
     """
+    rng = np.random.default_rng(seed)
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
-    
-    target_scale_intervals = get_scale_notes(target_scale_name)
-    key_offset = get_key_offset(target_key_name)
+
+    auto_scale = target_scale_name == "Auto (modo rilevato)"
+    snap_major = _scale_snap_table(get_scale_notes("Maggiore"))
+    snap_minor = _scale_snap_table(get_scale_notes("Minore Naturale"))
+    snap_target = _scale_snap_table(get_scale_notes(target_scale_name))
+    if target_key_name == "Auto (tonalità globale)":
+        fixed_key = global_key(original_midi)
+    elif target_key_name == "Auto (segue le modulazioni)":
+        fixed_key = None
+    else:
+        fixed_key = get_key_offset(target_key_name) + (12 if target_key_name.endswith('m') else 0)
 
     for i, track in enumerate(original_midi.tracks):
         new_track = mido.MidiTrack()
         if hasattr(track, 'name') and track.name:
             new_track.name = track.name
-        for msg in track:
-            if msg.type == 'note_on' or msg.type == 'note_off':
-                original_note = msg.note
-                shifted_note = original_note
-                if pitch_shift_range > 0:
-                    shifted_note += random.randint(-pitch_shift_range, pitch_shift_range)
-                shifted_note = max(0, min(127, shifted_note))
-
-                note_in_octave = (shifted_note - key_offset) % 12
-                if note_in_octave < 0:
-                    note_in_octave += 12 
-                
-                closest_scale_interval = min(target_scale_intervals, key=lambda x: abs(note_in_octave - x))
-                
-                octave = (shifted_note - key_offset) // 12 
-                new_note_pitch = octave * 12 + closest_scale_interval + key_offset
-                new_note_pitch = max(0, min(127, new_note_pitch))
-                
-                new_velocity = msg.velocity
-                if msg.type == 'note_on' and velocity_randomization > 0:
-                    new_velocity_float = float(new_velocity) * (1 + random.uniform(-velocity_randomization/100, velocity_randomization/100))
-                    new_velocity = int(round(new_velocity_float))
-                    new_velocity = max(1, min(127, new_velocity))
-
-                new_msg = msg.copy(note=new_note_pitch, velocity=new_velocity)
-                new_track.append(new_msg)
-            else:
-                new_track.append(msg.copy())
+        table = message_table(track)
+        abs_ticks, is_on, is_off, keys = _track_note_columns(track)
+        note_rows = np.flatnonzero(keys >= 0)
+        if note_rows.size == 0:
+            _message_table_to_track(new_track, table)
+            new_midi.tracks.append(new_track)
+            continue
+
+        shifted = keys[note_rows] % 128
+        if pitch_shift_range > 0:
+            shifted = shifted + rng.integers(-pitch_shift_range, pitch_shift_range + 1, note_rows.size)
+        shifted = np.clip(shifted, 0, 127)
+
+        if fixed_key is None:
+            key_idx = local_keys_at(original_midi, abs_ticks[note_rows])
+        else:
+            key_idx = np.full(note_rows.size, fixed_key)
+        key_offset = key_idx % 12
+        note_in_octave = (shifted - key_offset) % 12
+        if auto_scale:
+            closest_scale_interval = np.where(key_idx >= 12, snap_minor[note_in_octave], snap_major[note_in_octave])
+        else:
+            closest_scale_interval = snap_target[note_in_octave]
+        octave = (shifted - key_offset) // 12
+        new_pitch = table['data1'].copy()
+        new_pitch[note_rows] = np.clip(octave * 12 + closest_scale_interval + key_offset, 0, 127)
+
+        # note_off -> stesso pitch del note_on abbinato
+        on_pos, off_pos = _pair_note_events(keys, is_on, is_off)
+        paired = off_pos >= 0
+        new_pitch[off_pos[paired]] = new_pitch[on_pos[paired]]
+
+        velocity = table['data2'].copy()
+        if velocity_randomization > 0:
+            on_rows = np.flatnonzero(is_on)
+            factor = 1 + rng.uniform(-velocity_randomization / 100, velocity_randomization / 100, on_rows.size)
+            velocity[on_rows] = np.clip(np.rint(velocity[on_rows] * factor), 1, 127)
+
+        _message_table_to_track(new_track, table, data1=new_pitch, data2=velocity)
         new_midi.tracks.append(new_track)
     return new_midi
 
-def midi_phrase_reconstructor(original_midi, phrase_length_beats, reassembly_style):
-    """Riorganizza le frasi MIDI."""
+def midi_phrase_reconstructor(original_midi, phrase_length_beats, reassembly_style,
+                              segmentation="Beat fissi", boundary_notes="Spezza"):
+    """
+    Riorganizza le frasi MIDI.
+    Le frasi sono finestre consecutive della timeline: phrase_length_beats beat
+    ("Beat fissi") oppure phrase_length_beats battute sulla griglia ricavata dai
+    time_signature del file ("Griglia di battuta (dal file)") o dalla metrica
+    rilevata con detect_meter ("Griglia di battuta (rilevata)", fase inclusa).
+    Con phrase_length_beats="auto" la frase dura detect_meter()['phrase_bars']
+    battute (in "Beat fissi": battute della metrica rilevata, a partire da 0). L'assegnazione
+    evento -> frase e' un np.searchsorted sui tick assoluti e il riordino e'
+    una permutazione di intervalli di indici. Le note a cavallo di un confine
+    vengono spezzate (chiuse al confine e riaperte all'inizio della frase
+    successiva) oppure, con boundary_notes="Chiudi al confine", troncate.
+    """
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
-    ticks_per_phrase = original_midi.ticks_per_beat * phrase_length_beats
+    if phrase_length_beats == "auto":
+        meter = detect_meter(original_midi)
+        phrase_length_beats = meter['phrase_bars']
+        ticks_per_phrase = meter['bar_ticks'] * phrase_length_beats
+    else:
+        ticks_per_phrase = original_midi.ticks_per_beat * phrase_length_beats
 
     if ticks_per_phrase == 0:
         st.warning("La lunghezza della frase è zero. Nessuna riorganizzazione applicata.")
         return original_midi
 
+    bar_grid = None
+    if segmentation in ("Griglia di battuta (dal file)", "Griglia di battuta (rilevata)"):
+        file_end = build_time_index(original_midi)['end_tick']
+        if segmentation == "Griglia di battuta (rilevata)":
+            bar_grid = _detected_meter_grid(original_midi, file_end)[0]
+            bar_grid = np.concatenate([[0], bar_grid[bar_grid > 0]])
+        else:
+            bar_grid = _bar_grid_ticks(original_midi, file_end)
+
     for original_track in original_midi.tracks:
-        phrases = []
-        current_phrase_events = []
         _track_name = original_track.name if hasattr(original_track, 'name') else ''
         _header = _extract_instrument_header(original_track)
-        current_phrase_start_tick = 0
-
-        events_with_abs_time = []
-        time_since_last_event = 0
-        for msg in original_track:
-            time_since_last_event += msg.time
-            if msg.type == 'program_change' or (msg.type == 'control_change' and msg.control in (0, 32)):
-                continue  # gia' catturati in _header, verranno fissati all'inizio
-            events_with_abs_time.append({'msg': msg, 'abs_time': time_since_last_event})
-
-        for event_data in events_with_abs_time:
-            msg = event_data['msg']
-            abs_time = event_data['abs_time']
-            while abs_time >= current_phrase_start_tick + ticks_per_phrase:
-                if current_phrase_events:
-                    phrases.append(current_phrase_events)
-                current_phrase_events = []
-                current_phrase_start_tick += ticks_per_phrase
-            current_phrase_events.append(msg)
-        if current_phrase_events:
-            phrases.append(current_phrase_events)
-
-        if not phrases:
+
+        abs_all, is_on_all, is_off_all, keys_all = _track_note_columns(original_track)
+        # program_change / bank select gia' catturati in _header, verranno fissati all'inizio
+        messages = message_table(original_track)
+        keep = ~((messages['type'] == MESSAGE_TYPE_CODES['program_change'])
+                 | ((messages['type'] == MESSAGE_TYPE_CODES['control_change']) & np.isin(messages['data1'], (0, 32))))
+
+        if not keep.any():
             _empty_track = mido.MidiTrack()
             if _track_name:
                 _empty_track.name = _track_name
@@ -1495,255 +3221,546 @@ def midi_phrase_reconstructor(original_midi, phrase_length_beats, reassembly_sty
             new_midi.tracks.append(_empty_track)
             continue
 
-        reorganized_phrases = []
+        msgs = messages['msg'][keep]
+        abs_t, is_on, is_off, keys = abs_all[keep], is_on_all[keep], is_off_all[keep], keys_all[keep]
+        end_tick = int(abs_t[-1])
+
+        # Confini: bounds[k] = inizio della frase k; l'ultimo confine e' sempre > end_tick
+        if bar_grid is not None:
+            bounds = bar_grid[::max(1, int(phrase_length_beats))]
+            if bounds[-1] <= end_tick:
+                bounds = np.append(bounds, bar_grid[-1])
+        else:
+            bounds = np.arange(0, end_tick + ticks_per_phrase + 1, ticks_per_phrase, dtype=np.int64)
+        phrase_len = np.diff(bounds)
+
+        phrase = np.searchsorted(bounds, abs_t, side='right') - 1
+        on_pos, off_pos = _pair_note_events(keys, is_on, is_off)
+        paired = off_pos >= 0
+        off_p = off_pos[paired]
+        # Un note_off che cade esattamente su un confine chiude la nota nella frase precedente
+        phrase[off_p] = np.maximum(np.searchsorted(bounds, abs_t[off_p], side='left') - 1, phrase[on_pos[paired]])
+        offset = abs_t - bounds[phrase]
+        prio = np.where(is_off, 0, 1)
+        # note di durata zero: il loro note_off resta dopo il note_on
+        prio[off_p[offset[off_p] == offset[on_pos[paired]]]] = 2
+
+        # Note a cavallo dei confini (o senza note_off): chiusura a fine frase,
+        # e con "Spezza" riapertura all'inizio di ogni frase successiva coperta
+        on_msgs = msgs[on_pos]
+        on_phrase = phrase[on_pos]
+        last_phrase = np.where(paired, phrase[np.where(paired, off_pos, on_pos)], on_phrase)
+        crossing = paired & (last_phrase > on_phrase)
+        n_cuts = np.where(paired, last_phrase - on_phrase, 1)
+        if boundary_notes == "Spezza":
+            reopen_mask_src = crossing
+        else:
+            n_cuts = np.minimum(n_cuts, 1)
+            reopen_mask_src = np.zeros(on_pos.size, dtype=bool)
+            keep_ev = np.ones(msgs.size, dtype=bool)
+            keep_ev[off_pos[crossing]] = False
+            msgs, phrase, offset, prio = msgs[keep_ev], phrase[keep_ev], offset[keep_ev], prio[keep_ev]
+        cut_note = np.repeat(np.arange(on_pos.size), n_cuts)
+        cut_phrase = on_phrase[cut_note] + _ragged_arange(n_cuts)
+        reopen = reopen_mask_src[cut_note] & (cut_phrase < last_phrase[cut_note])
+
+        cut_msgs = np.empty(cut_note.size, dtype=object)
+        cut_msgs[:] = [mido.Message('note_off', note=m.note, velocity=0, channel=m.channel, time=0) for m in on_msgs[cut_note]]
+        reopen_msgs = np.empty(int(reopen.sum()), dtype=object)
+        reopen_msgs[:] = [m.copy(time=0) for m in on_msgs[cut_note[reopen]]]
+
+        ev_msgs = np.concatenate([msgs, cut_msgs, reopen_msgs])
+        ev_phrase = np.concatenate([phrase, cut_phrase, cut_phrase[reopen] + 1])
+        ev_offset = np.concatenate([offset, phrase_len[cut_phrase], np.zeros(reopen_msgs.size, dtype=np.int64)])
+        ev_prio = np.concatenate([prio, np.zeros(cut_msgs.size, dtype=np.int64), np.ones(reopen_msgs.size, dtype=np.int64)])
+
+        # Ordina per frase, poi tick, note_off prima di note_on allo stesso tick
+        order = np.lexsort((ev_prio, ev_offset, ev_phrase))
+        ev_msgs, ev_phrase, ev_offset = ev_msgs[order], ev_phrase[order], ev_offset[order]
+        phrase_start = np.flatnonzero(np.r_[True, ev_phrase[1:] != ev_phrase[:-1]])
+        phrase_ids = ev_phrase[phrase_start]
+        phrase_count = np.diff(np.r_[phrase_start, ev_phrase.size])
+        num_phrases = phrase_ids.size
+
         if reassembly_style == "Casuale":
-            reorganized_phrases = list(phrases)
-            random.shuffle(reorganized_phrases)
+            reorganized = list(range(num_phrases))
+            random.shuffle(reorganized)
         elif reassembly_style == "Inversione":
-            reorganized_phrases = list(reversed(phrases))
+            reorganized = list(range(num_phrases - 1, -1, -1))
         elif reassembly_style == "Ciclico A-B-A":
-            if len(phrases) >= 3:
-                a_phrase, b_phrase, c_phrase = phrases[0], phrases[1], (phrases[2] if len(phrases) > 2 else phrases[1])
-                num_repetitions = max(1, len(phrases) // 3)
-                for _ in range(num_repetitions):
-                    reorganized_phrases.extend([a_phrase, b_phrase, a_phrase, c_phrase])
+            if num_phrases >= 3:
+                reorganized = [0, 1, 0, 2] * max(1, num_phrases // 3)
             else:
-                st.warning(f"Troppo poche frasi ({len(phrases)}) per lo stile 'Ciclico A-B-A'. Verrà usata la riorganizzazione casuale.")
-                reorganized_phrases = list(phrases)
-                random.shuffle(reorganized_phrases)
+                st.warning(f"Troppo poche frasi ({num_phrases}) per lo stile 'Ciclico A-B-A'. Verrà usata la riorganizzazione casuale.")
+                reorganized = list(range(num_phrases))
+                random.shuffle(reorganized)
         elif reassembly_style == "Dal Più Corto al Più Lungo":
-            def get_phrase_duration_in_ticks(phrase_events_list):
-                if not phrase_events_list: return 0
-                return sum(msg.time for msg in phrase_events_list)
-            reorganized_phrases = sorted(phrases, key=get_phrase_duration_in_ticks)
+            span = np.maximum.reduceat(ev_offset, phrase_start) - np.minimum.reduceat(ev_offset, phrase_start)
+            reorganized = np.argsort(span, kind='stable')
         else:
-            reorganized_phrases = list(phrases)
+            reorganized = list(range(num_phrases))
+        reorganized = np.asarray(reorganized, dtype=np.int64)
+
+        # Permutazione degli intervalli di indici: ogni slot riceve la sua frase intera
+        slot_len = phrase_len[phrase_ids[reorganized]]
+        slot_start = np.cumsum(slot_len) - slot_len
+        slot_count = phrase_count[reorganized]
+        gather = np.repeat(phrase_start[reorganized], slot_count) + _ragged_arange(slot_count)
+        new_abs = np.repeat(slot_start, slot_count) + ev_offset[gather]
+        deltas = np.diff(new_abs, prepend=0)
 
         new_track = mido.MidiTrack()
         if _track_name:
             new_track.name = _track_name
         for _h in _header:
             new_track.append(_h)
-        flat_events_for_reconstruction = []
-        absolute_time_in_reorganized_seq = 0
-
-        for phrase_block in reorganized_phrases:
-            # Traccia note aperte in questa frase — chiudi quelle senza note_off
-            open_notes = {}  # (pitch, channel) -> abs_time di apertura
-            phrase_abs = absolute_time_in_reorganized_seq
-
-            for msg_in_phrase in phrase_block:
-                phrase_abs += msg_in_phrase.time
-                if msg_in_phrase.type == 'note_on' and msg_in_phrase.velocity > 0:
-                    open_notes[(msg_in_phrase.note, msg_in_phrase.channel)] = phrase_abs
-                elif msg_in_phrase.type == 'note_off' or (msg_in_phrase.type == 'note_on' and msg_in_phrase.velocity == 0):
-                    open_notes.pop((msg_in_phrase.note, msg_in_phrase.channel), None)
-                flat_events_for_reconstruction.append({'msg': msg_in_phrase.copy(), 'abs_time': phrase_abs})
-
-            # Chiudi note rimaste aperte alla fine della frase
-            phrase_end = phrase_abs
-            for (pitch, ch) in list(open_notes.keys()):
-                flat_events_for_reconstruction.append({
-                    'msg': mido.Message('note_off', note=pitch, velocity=0, channel=ch, time=0),
-                    'abs_time': phrase_end
-                })
-
-            absolute_time_in_reorganized_seq = phrase_end
+        new_track.extend(msg.copy(time=int(d)) for msg, d in zip(ev_msgs[gather], deltas))
 
-        # Ordina: note_off prima di note_on allo stesso tick
-        flat_events_for_reconstruction.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
+        new_midi.tracks.append(new_track)
+    return new_midi
 
-        last_abs_time = 0
-        for event_data in flat_events_for_reconstruction:
-            msg = event_data['msg']
-            abs_time = event_data['abs_time']
-            delta_time = max(0, abs_time - last_abs_time)
-            new_msg = msg.copy(time=delta_time)
-            new_track.append(new_msg)
-            last_abs_time = abs_time
+# Griglie di quantizzazione: suddivisioni per beat
+TIME_GRIDS = {
+    "1/8": 2,
+    "1/16": 4,
+    "1/32": 8,
+    "1/8 Terzina": 3,
+    "1/16 Terzina": 6,
+    "1/16 Quintina": 5,
+}
 
+
+def parse_swing_curve(s):
+    """Parsa una curva di swing per beat tipo '50, 70, 50, 90' (percentuali 0-100)."""
+    values = []
+    for chunk in s.split(','):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        try:
+            values.append(max(0.0, min(100.0, float(chunk))))
+        except ValueError:
+            continue
+    return values
+
+
+def extract_groove_template(groove_midi, grid="1/16"):
+    """
+    Estrae un groove template da un altro file MIDI: per ogni posizione di
+    griglia all'interno di una battuta (metrica dal primo time_signature del
+    file, 4/4 se assente), lo scostamento medio degli attacchi dal punto di
+    griglia, in frazioni di suddivisione (-0.5..0.5). Essendo relativo alla
+    griglia, il template e' indipendente dai ticks_per_beat dei due file.
+    """
+    subdiv = TIME_GRIDS.get(grid, 4)
+    num, den = 4, 4
+    for track in groove_midi.tracks:
+        ts = next((msg for msg in track if msg.type == 'time_signature'), None)
+        if ts is not None:
+            num, den = ts.numerator, ts.denominator
+            break
+    slots_per_bar = max(1, int(round(subdiv * num * 4 / den)))
+    grid_ticks = groove_midi.ticks_per_beat / subdiv
+
+    onsets = [np.zeros(0)]
+    for track in groove_midi.tracks:
+        abs_ticks, is_on, _is_off, _keys = _track_note_columns(track)
+        onsets.append(abs_ticks[is_on].astype(float))
+    onsets = np.concatenate(onsets)
+    if onsets.size == 0:
+        return np.zeros(slots_per_bar)
+
+    slot = np.rint(onsets / grid_ticks)
+    deviation = (onsets - slot * grid_ticks) / grid_ticks
+    position = slot.astype(np.int64) % slots_per_bar
+    counts = np.bincount(position, minlength=slots_per_bar)
+    sums = np.bincount(position, weights=deviation, minlength=slots_per_bar)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0.0)
+
+
+def _quantize_ticks(abs_ticks, ticks_per_beat, grid, strength, swing_curve=None, groove_template=None):
+    """
+    Quantizza un array di tick assoluti su una griglia di TIME_GRIDS.
+    Snap, swing (sulle suddivisioni dispari di ogni beat, ampiezza letta
+    ciclicamente dalla curva per beat), groove template (scostamento per
+    posizione nella battuta) e interpolazione della forza sono espressioni
+    su array.
+    """
+    subdiv = TIME_GRIDS.get(grid, 4)
+    grid_ticks = ticks_per_beat / subdiv
+    slot = np.rint(abs_ticks / grid_ticks).astype(np.int64)
+    target = slot * grid_ticks
+    if swing_curve is not None and len(swing_curve) > 0:
+        curve = np.asarray(swing_curve, dtype=float) / 100.0
+        beat = slot // subdiv
+        target = target + ((slot % subdiv) % 2 == 1) * (grid_ticks / 2) * curve[beat % curve.size]
+    if groove_template is not None and len(groove_template) > 0:
+        template = np.asarray(groove_template, dtype=float)
+        target = target + template[slot % template.size] * grid_ticks
+    q = strength / 100.0
+    return np.maximum(0, np.rint(abs_ticks * (1 - q) + target * q)).astype(np.int64)
+
+
+MIDI_MAX_TEMPO = 0xFFFFFF  # set_tempo e' un intero a 24 bit (microsecondi per beat)
+
+
+def _stretch_tempo_map(original_midi, stretch_factor):
+    """
+    Stretch temporale ottenuto scalando i set_tempo invece dei delta: i tick
+    (e quindi i byte delle note) restano identici, cambiano solo i
+    microsecondi per beat. I set_tempo vengono scalati in qualunque traccia
+    si trovino (come li legge build_time_index); le tracce senza set_tempo
+    vengono condivise per riferimento. Se nessuna traccia ha un set_tempo a
+    tick 0 ne inserisce uno (120 BPM di default MIDI, scalato) nella prima;
+    nei file tipo 2 ogni traccia e' una sequenza a se' e il controllo e'
+    fatto traccia per traccia.
+    """
+    new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat, type=original_midi.type)
+
+    def _scaled(tempo):
+        return max(1, min(MIDI_MAX_TEMPO, int(round(tempo * stretch_factor))))
+
+    tempo_at_zero = []
+    for track in original_midi.tracks:
+        table = message_table(track)
+        at_zero = [row for row in np.flatnonzero((table['type'] < 0) & (table['abs_tick'] == 0)).tolist()
+                   if table['msg'][row].type == 'set_tempo']
+        tempo_at_zero.append(bool(at_zero))
+    any_tempo_at_zero = any(tempo_at_zero)
+
+    for track_idx, track in enumerate(original_midi.tracks):
+        needs_default = not tempo_at_zero[track_idx] if original_midi.type == 2 else (track_idx == 0 and not any_tempo_at_zero)
+        has_tempo = any(msg.type == 'set_tempo' for msg in track)
+        if not has_tempo and not needs_default:
+            new_midi.tracks.append(track)
+            continue
+        new_track = writable_track(track)
+        for i, msg in enumerate(track):
+            if msg.type == 'set_tempo':
+                new_track[i] = msg.copy(tempo=_scaled(msg.tempo))
+        if needs_default:
+            new_track.insert(0, mido.MetaMessage('set_tempo', tempo=_scaled(500000), time=0))
         new_midi.tracks.append(new_track)
+
+    if not original_midi.tracks:
+        new_midi.tracks.append(mido.MidiTrack([mido.MetaMessage('set_tempo', tempo=_scaled(500000), time=0)]))
     return new_midi
 
-def midi_time_scrambler(original_midi, stretch_factor, quantization_strength, swing_amount):
+
+def midi_time_scrambler(original_midi, stretch_factor, quantization_strength, swing_amount,
+                        grid="1/16", swing_curve=None, groove_template=None,
+                        stretch_mode="Automatico (tempo map)"):
     """
     Modifica il timing e la durata delle note MIDI.
+    Lavora sull'array dei tick assoluti di ogni traccia: stretch dei delta,
+    poi quantizzazione degli eventi nota su una griglia arbitraria (TIME_GRIDS)
+    con swing uniforme (swing_amount) o per beat (swing_curve) ed eventuale
+    groove template estratto da un altro file (extract_groove_template).
+    Gli eventi non-nota mantengono il loro ordine relativo (sort stabile).
+    Con stretch_mode "Automatico (tempo map)" e nessuna quantizzazione lo
+    stretch e' applicato ai soli set_tempo (_stretch_tempo_map); la
+    riscrittura dei tick resta il fallback quando serve quantizzare.
     """
+    if stretch_mode == "Automatico (tempo map)" and quantization_strength <= 0:
+        if stretch_factor == 1.0:
+            return original_midi
+        if stretch_factor > 0:
+            return _stretch_tempo_map(original_midi, stretch_factor)
+
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
-    ticks_per_subdivision = original_midi.ticks_per_beat / 4
+    ticks_per_subdivision = original_midi.ticks_per_beat / TIME_GRIDS.get(grid, 4)
     if ticks_per_subdivision == 0:
         st.warning("Ticks per beat è zero o troppo basso. Restituito il MIDI originale.")
         return original_midi
 
+    if swing_curve is None or len(swing_curve) == 0:
+        swing_curve = [swing_amount] if swing_amount > 0 else None
+
     for original_track in original_midi.tracks:
         new_track = mido.MidiTrack()
         if hasattr(original_track, 'name') and original_track.name:
             new_track.name = original_track.name
-        events_with_abs_time = []
-        current_abs_time_stretched = 0
+        if len(original_track) == 0:
+            new_midi.tracks.append(new_track)
+            continue
 
-        for msg in original_track:
-            stretched_delta_time = int(round(msg.time * stretch_factor))
-            current_abs_time_stretched += stretched_delta_time
-            events_with_abs_time.append({'msg': msg.copy(), 'abs_time_mod': current_abs_time_stretched})
+        abs_ticks, is_on, is_off, keys = _track_note_columns(original_track)
+        deltas = np.diff(abs_ticks, prepend=0)
+        new_abs = np.cumsum(np.rint(deltas * stretch_factor).astype(np.int64))
 
         if quantization_strength > 0:
-            for event_data in events_with_abs_time:
-                msg = event_data['msg']
-                abs_time_before_quant = event_data['abs_time_mod']
-
-                if msg.type in ['note_on', 'note_off']:
-                    snapped_abs_time = round(abs_time_before_quant / ticks_per_subdivision) * ticks_per_subdivision
-                    if swing_amount > 0 and int(round((snapped_abs_time % original_midi.ticks_per_beat) / ticks_per_subdivision)) % 2 == 1:
-                        swing_shift_ticks = (ticks_per_subdivision / 2) * (swing_amount / 100.0)
-                        snapped_abs_time += swing_shift_ticks
-                    
-                    quant_factor = quantization_strength / 100.0
-                    event_data['abs_time_mod'] = int(round(abs_time_before_quant * (1 - quant_factor) + snapped_abs_time * quant_factor))
-                    event_data['abs_time_mod'] = max(0, event_data['abs_time_mod'])
-        
-        events_with_abs_time.sort(key=lambda x: x['abs_time_mod'])
+            is_note = is_on | is_off
+            new_abs[is_note] = _quantize_ticks(new_abs[is_note], original_midi.ticks_per_beat, grid,
+                                               quantization_strength, swing_curve, groove_template)
+            # swing e groove non devono mai far precedere un note_off al suo note_on
+            on_pos, off_pos = _pair_note_events(keys, is_on, is_off)
+            paired = off_pos >= 0
+            new_abs[off_pos[paired]] = np.maximum(new_abs[off_pos[paired]], new_abs[on_pos[paired]])
 
-        last_abs_time_mod = 0
-        for event_data in events_with_abs_time:
-            msg = event_data['msg']
-            abs_time_mod = event_data['abs_time_mod']
-            delta_time = max(0, abs_time_mod - last_abs_time_mod)
-            new_msg = msg.copy(time=delta_time)
-            new_track.append(new_msg)
-            last_abs_time_mod = abs_time_mod
+        order = np.argsort(new_abs, kind='stable')
+        _message_table_to_track(new_track, message_table(original_track), order=order, abs_tick=new_abs)
 
         new_midi.tracks.append(new_track)
     return new_midi
 
-def midi_density_transformer(original_midi, add_note_probability, remove_note_probability, polyphony_mode):
+def midi_density_transformer(original_midi, add_note_probability, remove_note_probability, polyphony_mode,
+                             key_aware=True, seed=None):
     """
     Aggiunge o rimuove note per alterare la densita' MIDI.
     Fix: tracce senza note vengono passate intatte.
     Fix: note aggiunte hanno durata esplicita uguale alla nota originale.
     Fix: note_off sempre dopo note_on — abs_time note_off = start + durata originale.
+    Rimozione e aggiunta sono maschere booleane estratte in un unico batch;
+    le voci aggiunte nascono da una matrice di intervalli (note x voci) che,
+    con key_aware=True, viene agganciata alla tonalita' locale rilevata
+    (local_keys_at) tramite KEY_SNAP_LUT: triadi e contro-melodia restano
+    diatoniche invece di essere sempre +4/+7 cromatici.
     """
-    new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
+    rng = np.random.default_rng(seed)
+    ticks_per_beat = original_midi.ticks_per_beat
+    new_midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
 
     for original_track in original_midi.tracks:
         _dens_name = original_track.name if hasattr(original_track, 'name') else ''
         _dens_header = _extract_instrument_header(original_track)
-        notes = extract_notes(original_track, original_midi.ticks_per_beat)
+        table = extract_note_table(original_track, ticks_per_beat)
+        n = table['start'].size
 
         # Se la traccia non ha note (metadati, controller, ecc.) — passa intatta
-        if not notes:
+        if n == 0:
             new_midi.tracks.append(original_track)
             continue
 
-        modified_notes = [note for note in notes if random.randint(0, 100) >= remove_note_probability]
-
-        # Durata minima garantita: almeno 1 tick
-        def safe_duration(note):
-            return max(1, note['end'] - note['start'])
+        keep = rng.integers(0, 101, n) >= remove_note_probability
+        add = keep & (rng.integers(0, 101, n) < add_note_probability)
 
-        final_events = []
-        track_end_time = max(n['end'] for n in notes)
+        # Durata minima garantita: almeno 1 tick; durata esplicita, non dipende da note_off originale
+        start = table['start'][keep]
+        end = start + np.maximum(1, table['end'] - table['start'])[keep]
+        pitch, velocity, channel = table['pitch'][keep], table['velocity'][keep], table['channel'][keep]
+        cols = [[start], [end], [pitch], [velocity], [channel]]
 
-        if polyphony_mode == "Droni" and add_note_probability > 0 and random.randint(0, 100) < add_note_probability:
+        src = np.flatnonzero(add[keep])
+        if polyphony_mode == "Riempi Accordo (Triadi)":
+            intervals = np.broadcast_to(np.array([4, 7]), (src.size, 2))
+        elif polyphony_mode == "Aggiungi Contro-Melodia":
+            intervals = rng.choice(np.array([-5, -3, -2, 2, 3, 5]), size=(src.size, 1))
+        else:
+            intervals = np.zeros((src.size, 0), dtype=np.int64)
+
+        if intervals.size:
+            base = pitch[src]
+            added = base[:, None] + intervals
+            in_range = (added >= 0) & (added <= 127)
+            if key_aware:
+                local_key = local_keys_at(original_midi, start[src])
+                added = KEY_SNAP_LUT[local_key[:, None], np.clip(added, 0, 127)]
+                in_range &= added != base[:, None]
+            rows = np.nonzero(in_range)[0]
+            cols[0].append(start[src][rows])
+            cols[1].append(end[src][rows])
+            cols[2].append(added[in_range])
+            cols[3].append(velocity[src][rows])
+            cols[4].append(channel[src][rows])
+
+        if polyphony_mode == "Droni" and add_note_probability > 0 and rng.integers(0, 101) < add_note_probability:
             drone_pitch = 36
+            if key_aware:
+                drone_pitch += global_key(original_midi) % 12
             drone_velocity = 64
-            final_events.append({'msg': mido.Message('note_on', note=drone_pitch, velocity=drone_velocity, channel=0, time=0), 'abs_time': 0})
-            final_events.append({'msg': mido.Message('note_off', note=drone_pitch, velocity=0, channel=0, time=0), 'abs_time': track_end_time + original_midi.ticks_per_beat * 4})
-
-        for note_data in modified_notes:
-            dur = safe_duration(note_data)
-            note_start = note_data['start']
-            note_end   = note_start + dur  # durata esplicita, non dipende da note_off originale
-
-            final_events.append({'msg': mido.Message('note_on',  note=note_data['pitch'], velocity=note_data['velocity'], channel=note_data['channel'], time=0), 'abs_time': note_start})
-            final_events.append({'msg': mido.Message('note_off', note=note_data['pitch'], velocity=0,                    channel=note_data['channel'], time=0), 'abs_time': note_end})
-
-            if random.randint(0, 100) < add_note_probability:
-                if polyphony_mode == "Riempi Accordo (Triadi)":
-                    intervals = [4, 7]
-                elif polyphony_mode == "Aggiungi Contro-Melodia":
-                    intervals = [random.choice([-5, -3, -2, 2, 3, 5])]
-                else:
-                    intervals = []
-
-                for interval in intervals:
-                    new_pitch = note_data['pitch'] + interval
-                    if 0 <= new_pitch <= 127:
-                        # Nota aggiunta: stessa durata della nota originale, note_off esplicito
-                        final_events.append({'msg': mido.Message('note_on',  note=new_pitch, velocity=note_data['velocity'], channel=note_data['channel'], time=0), 'abs_time': note_start})
-                        final_events.append({'msg': mido.Message('note_off', note=new_pitch, velocity=0,                    channel=note_data['channel'], time=0), 'abs_time': note_end})
-
-        # Ordina per abs_time, note_off prima di note_on allo stesso tick (evita sovrapposizioni)
-        final_events.sort(key=lambda x: (x['abs_time'], 0 if x['msg'].type == 'note_off' else 1))
+            track_end_time = int(table['end'].max())
+            cols[0].append(np.array([0]))
+            cols[1].append(np.array([track_end_time + ticks_per_beat * 4]))
+            cols[2].append(np.array([drone_pitch]))
+            cols[3].append(np.array([drone_velocity]))
+            cols[4].append(np.array([0]))
 
         new_track = mido.MidiTrack()
         if _dens_name:
             new_track.name = _dens_name
         for _h in _dens_header:
             new_track.append(_h)
-        last_abs_time = 0
-        for event_data in final_events:
-            msg      = event_data['msg']
-            abs_time = event_data['abs_time']
-            delta    = max(0, abs_time - last_abs_time)
-            new_track.append(msg.copy(time=delta))
-            last_abs_time = abs_time
+        _note_arrays_to_track(new_track, *(np.concatenate(c) for c in cols))
 
         new_midi.tracks.append(new_track)
     return new_midi
 
-def midi_random_pitch_transformer(original_midi, random_pitch_strength):
+RANDOM_PITCH_DISTRIBUTIONS = [
+    "Uniforme (0-127)", "Istogramma del brano", "Gaussiana attorno all'originale", "Range della traccia",
+]
+
+
+def midi_random_pitch_transformer(original_midi, random_pitch_strength, distribution="Uniforme (0-127)",
+                                  gaussian_sigma=7, seed=None):
     """
     Randomizes the pitch of notes based on a given strength (probability).
-    Usa (pitch, channel) come chiave e un contatore per gestire note duplicate
-    sullo stesso pitch/canale — nessuna nota resta aperta nel DAW.
+    Lavora sulla tabella note (extract_note_table, abbinamento LIFO come il
+    vecchio stack per (pitch, channel)): ogni note_off riceve il pitch del suo
+    note_on, quindi nessuna nota resta aperta nel DAW. I nuovi pitch sono
+    estratti in blocco secondo distribution (vedi RANDOM_PITCH_DISTRIBUTIONS):
+    uniforme, istogramma dei pitch di tutto il brano, gaussiana di
+    deviazione gaussian_sigma semitoni attorno all'originale, o uniforme
+    nel range [min, max] della traccia.
     """
+    rng = np.random.default_rng(seed)
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
+    tables = [extract_note_table(t, original_midi.ticks_per_beat, policy="LIFO") for t in original_midi.tracks]
 
-    for original_track in original_midi.tracks:
+    if distribution == "Istogramma del brano":
+        histogram = np.bincount(np.concatenate([t['pitch'] for t in tables] + [np.zeros(0, dtype=np.int64)]),
+                                minlength=128).astype(float)
+        if histogram.sum() == 0:
+            histogram[:] = 1
+        histogram /= histogram.sum()
+
+    for original_track, table in zip(original_midi.tracks, tables):
         new_track = mido.MidiTrack()
         if hasattr(original_track, 'name') and original_track.name:
             new_track.name = original_track.name
 
-        # pitch_map: (pitch_orig, channel) -> lista di pitch nuovi (stack LIFO)
-        # gestisce piu' note_on sullo stesso pitch prima del note_off
-        from collections import defaultdict
-        pitch_map = defaultdict(list)
-
-        for msg in original_track:
-            if msg.type == 'note_on' and msg.velocity > 0:
-                key = (msg.note, msg.channel)
-                if random.randint(0, 100) < random_pitch_strength:
-                    new_pitch = random.randint(0, 127)
-                else:
-                    new_pitch = msg.note
-                pitch_map[key].append(new_pitch)
-                new_track.append(msg.copy(note=new_pitch))
-
-            elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                key = (msg.note, msg.channel)
-                if pitch_map[key]:
-                    # LIFO: chiude l'ultima nota aperta su questo pitch/canale
-                    mapped_pitch = pitch_map[key].pop()
-                else:
-                    mapped_pitch = msg.note
-                new_track.append(msg.copy(note=mapped_pitch))
+        pitch = table['pitch']
+        n = pitch.size
+        if distribution == "Istogramma del brano":
+            drawn = rng.choice(128, size=n, p=histogram)
+        elif distribution == "Gaussiana attorno all'originale":
+            drawn = np.clip(np.rint(pitch + rng.normal(0, gaussian_sigma, n)), 0, 127).astype(np.int64)
+        elif distribution == "Range della traccia" and n:
+            drawn = rng.integers(pitch.min(), pitch.max() + 1, n)
+        else:
+            drawn = rng.integers(0, 128, n)
+        new_pitch = np.where(rng.integers(0, 101, n) < random_pitch_strength, drawn, pitch)
 
-            else:
-                new_track.append(msg)
+        # note_off orfani e messaggi non-nota restano invariati
+        messages = message_table(original_track)
+        row_pitch = messages['data1'].copy()
+        row_pitch[table['on_row']] = new_pitch
+        closed = table['off_row'] >= 0
+        row_pitch[table['off_row'][closed]] = new_pitch[closed]
+        _message_table_to_track(new_track, messages, data1=row_pitch)
 
         # Chiudi eventuali note rimaste aperte (note_on senza note_off)
-        for (orig_pitch, ch), pitches in pitch_map.items():
-            for p in pitches:
-                new_track.append(mido.Message('note_off', note=p, velocity=0, channel=ch, time=0))
+        for p, ch in zip(new_pitch[~closed].tolist(), table['channel'][~closed].tolist()):
+            new_track.append(mido.Message('note_off', note=p, velocity=0, channel=ch, time=0))
 
         new_midi.tracks.append(new_track)
     return new_midi
 
 
-def midi_add_rhythmic_base(original_midi, kick, snare, hihat, time_signature, rhythmic_pattern_style):
+# Libreria di pattern euclidei: strumento -> (colpi, passi, rotazione).
+# I passi dividono la battuta corrente, quindi il pattern segue la metrica.
+EUCLIDEAN_DRUM_PATTERNS = {
+    "Tresillo E(3,8)":    {"kick": (3, 8, 0), "snare": (2, 8, 2), "hihat_closed": (8, 8, 0)},
+    "Cinquillo E(5,8)":   {"kick": (5, 8, 0), "snare": (2, 8, 2), "hihat_closed": (4, 8, 1)},
+    "Bossa E(5,16)":      {"kick": (5, 16, 0), "snare": (3, 8, 2), "hihat_closed": (16, 16, 0)},
+    "Aksak E(7,12)":      {"kick": (7, 12, 0), "snare": (2, 12, 3), "hihat_closed": (12, 12, 0)},
+}
+
+# Libreria poliritmica: strumento -> (ciclo in sedicesimi, colpi nel ciclo).
+# I cicli scorrono dall'inizio del brano indipendentemente dalla battuta.
+POLYMETRIC_DRUM_PATTERNS = {
+    "3 contro 4":   {"kick": (6, [0]), "snare": (16, [4, 12]), "hihat_closed": (4, [0, 2])},
+    "5 contro 4":   {"kick": (5, [0]), "snare": (16, [4, 12]), "hihat_closed": (2, [0])},
+    "7 contro 4":   {"kick": (7, [0, 3]), "snare": (16, [4, 12]), "hihat_closed": (3, [0])},
+}
+
+RHYTHMIC_PATTERN_STYLES = (
+    ["Pattern Adattivo", "Pattern Fisso (Pop/Rock)", "Pattern Casuale"]
+    + [f"Euclideo: {name}" for name in EUCLIDEAN_DRUM_PATTERNS]
+    + [f"Poliritmo: {name}" for name in POLYMETRIC_DRUM_PATTERNS]
+)
+
+
+def euclidean_rhythm(hits, steps, rotation=0):
+    """Ritmo euclideo E(hits, steps) come maschera booleana (distribuzione di Bjorklund), ruotato di rotation passi."""
+    i = np.arange(steps)
+    return np.roll((i * hits) % steps < hits, rotation)
+
+
+def _drum_bar_patterns(style, enabled, beats_per_measure, ticks_per_beat, ticks_per_measure, rng, note_on_counts):
+    """
+    Pattern di una battuta per ogni strumento abilitato: strumento ->
+    (offset, durate, velocity) come array NumPy. note_on_counts e' l'istogramma
+    delle posizioni nella battuta (in sedicesimi) usato dal Pattern Adattivo.
+    """
+    patterns = {name: [] for name in enabled}
+
+    if style.startswith("Euclideo: "):
+        for name in enabled:
+            hits, steps, rotation = EUCLIDEAN_DRUM_PATTERNS[style[len("Euclideo: "):]][name]
+            step_ticks = ticks_per_measure / steps
+            velocity = 100 if name != "hihat_closed" else 80
+            for step in np.flatnonzero(euclidean_rhythm(hits, steps, rotation)):
+                patterns[name].append((int(step * step_ticks), max(1, int(step_ticks // 2)), velocity))
+
+    elif style == "Pattern Fisso (Pop/Rock)":
+        if "kick" in patterns:
+            patterns["kick"].append((0, ticks_per_beat // 8, 100))
+            if beats_per_measure >= 3:
+                patterns["kick"].append((ticks_per_beat * 2, ticks_per_beat // 8, 100))
+        if "snare" in patterns:
+            if beats_per_measure >= 2:
+                patterns["snare"].append((ticks_per_beat, ticks_per_beat // 8, 100))
+            if beats_per_measure >= 4:
+                patterns["snare"].append((ticks_per_beat * 3, ticks_per_beat // 8, 100))
+        if "hihat_closed" in patterns:
+            for i in range(beats_per_measure * 2):
+                patterns["hihat_closed"].append((i * ticks_per_beat // 2, ticks_per_beat // 8, 80))
+
+    elif style == "Pattern Casuale":
+        probabilities = {"kick": (0.2, 80, 110), "snare": (0.1, 80, 110), "hihat_closed": (0.4, 60, 90)}
+        ticks_per_subdivision = ticks_per_beat // 4
+        starts = np.arange(beats_per_measure * 4) * ticks_per_subdivision
+        for name in patterns:
+            prob, v_lo, v_hi = probabilities[name]
+            hit_starts = starts[rng.random(starts.size) < prob]
+            velocities = rng.integers(v_lo, v_hi + 1, hit_starts.size)
+            patterns[name] = [(int(s), ticks_per_subdivision // 2, int(v)) for s, v in zip(hit_starts, velocities)]
+
+    elif style == "Pattern Adattivo":
+        if note_on_counts:
+            most_common_ticks = sorted(note_on_counts, key=note_on_counts.get, reverse=True)
+
+            kick_ticks = []
+            if "kick" in patterns:
+                for tick in most_common_ticks:
+                    if len(kick_ticks) >= 3: break
+                    if (beats_per_measure == 4 and (tick == 0 or tick == ticks_per_beat * 2)) or (len(kick_ticks) < 2 and note_on_counts[tick] > 1):
+                        kick_ticks.append(tick)
+                if not kick_ticks: kick_ticks.extend([0, ticks_per_beat*2] if beats_per_measure >= 4 else [0])
+                patterns["kick"] = [(tick, ticks_per_beat // 8, 100) for tick in kick_ticks]
+
+            if "snare" in patterns:
+                snare_ticks = []
+                for tick in most_common_ticks:
+                    is_kick_tick = any(abs(tick - kt) < ticks_per_beat / 4 for kt in kick_ticks)
+                    if not is_kick_tick and len(snare_ticks) < 2: snare_ticks.append(tick)
+                if not snare_ticks: snare_ticks.extend([ticks_per_beat, ticks_per_beat*3] if beats_per_measure >= 4 else [ticks_per_beat])
+                patterns["snare"] = [(tick, ticks_per_beat // 8, 100) for tick in snare_ticks]
+
+            if "hihat_closed" in patterns:
+                ticks_per_eighth = max(1, ticks_per_beat // 2)
+                n_eighths = int(ticks_per_measure / ticks_per_eighth)
+                velocities = rng.integers(60, 91, n_eighths)
+                patterns["hihat_closed"] = [(i * ticks_per_eighth, ticks_per_eighth // 2, int(v)) for i, v in enumerate(velocities)]
+        else:
+            if "kick" in patterns: patterns["kick"].append((0, ticks_per_beat // 8, 100))
+            if "snare" in patterns: patterns["snare"].append((ticks_per_beat, ticks_per_beat // 8, 100))
+            if "hihat_closed" in patterns: patterns["hihat_closed"].append((0, ticks_per_beat // 2, 80))
+
+    return {name: tuple(np.array(col, dtype=np.int64) for col in zip(*events)) if events else None
+            for name, events in patterns.items()}
+
+
+def midi_add_rhythmic_base(original_midi, kick, snare, hihat, time_signature, rhythmic_pattern_style,
+                           follow_time_signature=True, seed=None):
     """
     Aggiunge una o più tracce con una base ritmica che dura esattamente quanto il brano originale.
+    Ogni pattern e' una battuta ad array, replicata su tutte le battute con
+    offset in broadcast e tagliata a fine battuta e a fine brano. Con
+    follow_time_signature i cambi di time_signature del file sono seguiti
+    (time_signature vale solo dove il file non ne dichiara); con
+    time_signature "auto" metrica e fase delle battute vengono da detect_meter. Gli stili
+    "Poliritmo: ..." scorrono cicli indipendenti dalla battuta.
     """
     new_midi = mido.MidiFile(ticks_per_beat=original_midi.ticks_per_beat)
     for track in original_midi.tracks:
@@ -1755,8 +3772,12 @@ def midi_add_rhythmic_base(original_midi, kick, snare, hihat, time_signature, rh
         "hihat_closed": 42,
     }
     
+    auto_meter = time_signature.strip().lower() == "auto"
     try:
-        beats_per_measure, note_value = map(int, time_signature.split('/'))
+        if auto_meter:
+            beats_per_measure, note_value = 4, 4
+        else:
+            beats_per_measure, note_value = map(int, time_signature.split('/'))
         if beats_per_measure <= 0 or note_value <= 0:
             raise ValueError
     except (ValueError, IndexError):
@@ -1764,134 +3785,88 @@ def midi_add_rhythmic_base(original_midi, kick, snare, hihat, time_signature, rh
         beats_per_measure, note_value = 4, 4
     
     ticks_per_beat = new_midi.ticks_per_beat
-    ticks_per_measure = int(ticks_per_beat * beats_per_measure * 4 / note_value)
-
-    if ticks_per_measure == 0:
+    if int(ticks_per_beat * beats_per_measure * 4 / note_value) == 0:
         st.warning("Ticks per misura è zero. Non è possibile aggiungere la base ritmica.")
         return new_midi
 
     # Calcolo della durata totale del brano originale in ticks
-    total_ticks = 0
-    for track in original_midi.tracks:
-        current_time = 0
-        for msg in track:
-            current_time += msg.time
-        total_ticks = max(total_ticks, current_time)
+    total_ticks = build_time_index(original_midi)['end_tick']
 
     if total_ticks == 0:
         st.warning("Il brano originale non contiene eventi validi per calcolare la lunghezza. La base ritmica non verrà aggiunta.")
         return new_midi
 
-    rhythmic_patterns_in_measure = {
-        "kick": [],
-        "snare": [],
-        "hihat_closed": []
-    }
-    
-    if rhythmic_pattern_style == "Pattern Fisso (Pop/Rock)":
-        if kick:
-            rhythmic_patterns_in_measure["kick"].append({'start_tick': 0, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-            if beats_per_measure >= 3:
-                rhythmic_patterns_in_measure["kick"].append({'start_tick': ticks_per_beat * 2, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-        if snare:
-            if beats_per_measure >= 2:
-                rhythmic_patterns_in_measure["snare"].append({'start_tick': ticks_per_beat, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-            if beats_per_measure >= 4:
-                rhythmic_patterns_in_measure["snare"].append({'start_tick': ticks_per_beat * 3, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-        if hihat:
-            for i in range(beats_per_measure * 2):
-                rhythmic_patterns_in_measure["hihat_closed"].append({'start_tick': i * ticks_per_beat // 2, 'duration_ticks': ticks_per_beat // 8, 'velocity': 80})
-
-    elif rhythmic_pattern_style == "Pattern Casuale":
-        kick_prob, snare_prob, hihat_prob = 0.2, 0.1, 0.4
-        ticks_per_subdivision = ticks_per_beat // 4
-        total_subdivisions_in_measure = beats_per_measure * 4
-        
-        for i in range(total_subdivisions_in_measure):
-            start_tick = i * ticks_per_subdivision
-            duration = ticks_per_subdivision // 2 
-            if kick and random.random() < kick_prob: rhythmic_patterns_in_measure["kick"].append({'start_tick': start_tick, 'duration_ticks': duration, 'velocity': random.randint(80, 110)})
-            if snare and random.random() < snare_prob: rhythmic_patterns_in_measure["snare"].append({'start_tick': start_tick, 'duration_ticks': duration, 'velocity': random.randint(80, 110)})
-            if hihat and random.random() < hihat_prob: rhythmic_patterns_in_measure["hihat_closed"].append({'start_tick': start_tick, 'duration_ticks': duration, 'velocity': random.randint(60, 90)})
-
-    elif rhythmic_pattern_style == "Pattern Adattivo":
-        note_on_counts = defaultdict(int)
-        for track in original_midi.tracks:
-            abs_time = 0
-            for msg in track:
-                abs_time += msg.time
-                if msg.type == 'note_on' and msg.velocity > 0 and msg.channel != 9:
-                    tick_in_measure = abs_time % ticks_per_measure
-                    subdivision_ticks = ticks_per_beat // 4
-                    snapped_tick = round(tick_in_measure / subdivision_ticks) * subdivision_ticks
-                    note_on_counts[snapped_tick] += 1
-        
-        if note_on_counts:
-            most_common_ticks = sorted(note_on_counts, key=note_on_counts.get, reverse=True)
-            
-            kick_ticks = []
-            if kick:
-                for tick in most_common_ticks:
-                    if len(kick_ticks) >= 3: break
-                    if (beats_per_measure == 4 and (tick == 0 or tick == ticks_per_beat * 2)) or (len(kick_ticks) < 2 and note_on_counts[tick] > 1):
-                         kick_ticks.append(tick)
-                if not kick_ticks: kick_ticks.extend([0, ticks_per_beat*2] if beats_per_measure >= 4 else [0])
-                for tick in kick_ticks: rhythmic_patterns_in_measure["kick"].append({'start_tick': tick, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-            
-            snare_ticks = []
-            if snare:
-                for tick in most_common_ticks:
-                    is_kick_tick = any(abs(tick - kt) < ticks_per_beat / 4 for kt in kick_ticks)
-                    if not is_kick_tick and len(snare_ticks) < 2: snare_ticks.append(tick)
-                if not snare_ticks: snare_ticks.extend([ticks_per_beat, ticks_per_beat*3] if beats_per_measure >= 4 else [ticks_per_beat])
-                for tick in snare_ticks: rhythmic_patterns_in_measure["snare"].append({'start_tick': tick, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-
-            if hihat:
-                ticks_per_eighth = ticks_per_beat // 2
-                for i in range(int(ticks_per_measure / ticks_per_eighth)):
-                    rhythmic_patterns_in_measure["hihat_closed"].append({'start_tick': i * ticks_per_eighth, 'duration_ticks': ticks_per_eighth // 2, 'velocity': random.randint(60, 90)})
+    enabled = [name for name, on in (("kick", kick), ("snare", snare), ("hihat_closed", hihat)) if on]
+    rng = np.random.default_rng(seed)
+    tiled = {name: [] for name in enabled}
+
+    if rhythmic_pattern_style.startswith("Poliritmo: "):
+        sixteenth = max(1, ticks_per_beat // 4)
+        for name in enabled:
+            cycle_steps, hit_steps = POLYMETRIC_DRUM_PATTERNS[rhythmic_pattern_style[len("Poliritmo: "):]][name]
+            cycle_starts = np.arange(0, total_ticks, cycle_steps * sixteenth, dtype=np.int64)
+            onsets = (cycle_starts[:, None] + np.asarray(hit_steps)[None, :] * sixteenth).ravel()
+            onsets = onsets[onsets < total_ticks]
+            velocity = 100 if name != "hihat_closed" else 80
+            tiled[name].append((onsets, np.full(onsets.size, sixteenth // 2), np.full(onsets.size, velocity)))
+    else:
+        if auto_meter:
+            bar_starts, numerators, denominators = _detected_meter_grid(original_midi, total_ticks)
         else:
-            st.warning("Nessuna nota trovata per un pattern adattivo. Verrà usato un pattern fisso.")
-            if kick: rhythmic_patterns_in_measure["kick"].append({'start_tick': 0, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-            if snare: rhythmic_patterns_in_measure["snare"].append({'start_tick': ticks_per_beat, 'duration_ticks': ticks_per_beat // 8, 'velocity': 100})
-            if hihat: rhythmic_patterns_in_measure["hihat_closed"].append({'start_tick': 0, 'duration_ticks': ticks_per_beat // 2, 'velocity': 80})
+            bar_starts, numerators, denominators = _meter_grid(
+                original_midi, total_ticks, (beats_per_measure, note_value), follow_time_signature)
+        bar_ends = np.append(bar_starts[1:], bar_starts[-1])
+        in_piece = bar_starts < total_ticks
+        bar_starts, bar_ends = bar_starts[in_piece], np.minimum(bar_ends[in_piece], total_ticks)
+        numerators, denominators = numerators[in_piece], denominators[in_piece]
+
+        # Istogramma delle posizioni nella battuta (per metrica) per il Pattern Adattivo
+        counts_per_meter = defaultdict(lambda: defaultdict(int))
+        if rhythmic_pattern_style == "Pattern Adattivo":
+            subdivision_ticks = max(1, ticks_per_beat // 4)
+            columns = [_track_note_columns(tr) for tr in original_midi.tracks]
+            onset_ticks = np.concatenate([abs_t[is_on & (keys // 128 != 9)] for abs_t, is_on, _, keys in columns])
+            bar_idx = np.searchsorted(bar_starts, onset_ticks, side='right') - 1
+            snapped = np.round((onset_ticks - bar_starts[bar_idx]) / subdivision_ticks).astype(np.int64) * subdivision_ticks
+            for num, den, tick in zip(numerators[bar_idx].tolist(), denominators[bar_idx].tolist(), snapped.tolist()):
+                counts_per_meter[(num, den)][tick] += 1
+            if onset_ticks.size == 0:
+                st.warning("Nessuna nota trovata per un pattern adattivo. Verrà usato un pattern fisso.")
+
+        meter_codes = numerators * 1000 + denominators
+        for code in np.unique(meter_codes):
+            num, den = int(code // 1000), int(code % 1000)
+            ticks_per_measure = int(ticks_per_beat * num * 4 / den)
+            patterns = _drum_bar_patterns(rhythmic_pattern_style, enabled, num, ticks_per_beat,
+                                          ticks_per_measure, rng, counts_per_meter[(num, den)])
+            sel = meter_codes == code
+            starts, ends = bar_starts[sel], bar_ends[sel]
+            for name, pattern in patterns.items():
+                if pattern is None:
+                    continue
+                offsets, durations, velocities = pattern
+                onsets = starts[:, None] + offsets[None, :]
+                keep = (onsets < ends[:, None]) & (onsets >= 0)
+                hit_idx = np.broadcast_to(np.arange(offsets.size), onsets.shape)[keep]
+                tiled[name].append((onsets[keep], durations[hit_idx], velocities[hit_idx]))
 
     instrument_names = {"kick": "Cassa", "snare": "Rullante", "hihat_closed": "Hi-hat"}
 
-    # Calcola il numero di misure necessarie per coprire l'intera durata del brano
-    num_measures = int(np.ceil(total_ticks / ticks_per_measure))
-    
-    for drum_note_name, patterns_in_measure in rhythmic_patterns_in_measure.items():
-        if not patterns_in_measure: continue
-        
+    for drum_note_name, parts in tiled.items():
+        if not parts:
+            continue
+        onsets = np.concatenate([p[0] for p in parts])
+        if onsets.size == 0:
+            continue
+        durations = np.concatenate([p[1] for p in parts])
+        velocities = np.concatenate([p[2] for p in parts])
+        ends = np.minimum(onsets + np.maximum(durations, 1), total_ticks)
+
         new_drum_track = mido.MidiTrack()
         new_drum_track.name = f"Ritmica: {instrument_names[drum_note_name]}"
         new_drum_track.append(mido.Message('program_change', program=0, channel=9, time=0))
-        
-        all_drum_events = []
-        for i in range(num_measures):
-            current_measure_start_tick = i * ticks_per_measure
-            for event in patterns_in_measure:
-                start_abs_time = current_measure_start_tick + event['start_tick']
-                end_abs_time = start_abs_time + event['duration_ticks']
-                
-                # Aggiungi solo eventi che rientrano nella durata totale del brano
-                if start_abs_time < total_ticks:
-                    all_drum_events.append({'msg': mido.Message('note_on', note=DRUM_MAP[drum_note_name], velocity=event['velocity'], channel=9), 'abs_time': start_abs_time})
-                    if end_abs_time < total_ticks:
-                        all_drum_events.append({'msg': mido.Message('note_off', note=DRUM_MAP[drum_note_name], velocity=0, channel=9), 'abs_time': end_abs_time})
-
-        all_drum_events.sort(key=lambda x: x['abs_time'])
-        last_abs_time = 0
-        for event in all_drum_events:
-            delta_time = max(0, event['abs_time'] - last_abs_time)
-            new_msg = event['msg'].copy(time=delta_time)
-            new_drum_track.append(new_msg)
-            last_abs_time = event['abs_time']
-        
-        # Aggiungi un messaggio finale per garantire che la traccia abbia la lunghezza corretta
-        new_drum_track.append(mido.Message('note_off', note=DRUM_MAP[drum_note_name], velocity=0, channel=9, time=max(0, total_ticks - last_abs_time)))
-        
+        _note_arrays_to_track(new_drum_track, onsets, ends, np.full(onsets.size, DRUM_MAP[drum_note_name]),
+                              np.clip(velocities, 1, 127), np.full(onsets.size, 9))
         new_midi.tracks.append(new_drum_track)
 
     return new_midi
@@ -1914,63 +3889,69 @@ def _gm_track_name(program, channel):
     return family
 
 
+def _is_type0_like(midi):
+    """True per file tipo 0 o con un'unica traccia che usa piu' canali."""
+    if midi.type == 0:
+        return True
+    if len(midi.tracks) != 1:
+        return False
+    return len({m.channel for m in midi.tracks[0] if hasattr(m, 'channel')}) > 1
+
+
 def _split_type0_to_tracks(midi):
     """
     Converte un MIDI tipo 0 (1 traccia, N canali) in un MIDI tipo 1
     con una traccia per canale attivo (canali senza note vengono ignorati).
     Nomina ogni traccia con il nome GM reale (Bass, Drums, Guitar, ecc.)
     preservando il canale originale.
+    La traccia sorgente e' gia' in ordine di tempo: la separazione e' un
+    unico argsort stabile per partizione (-1 = meta, altrimenti canale) e
+    i delta di ogni partizione sono un np.diff dei tick assoluti.
     """
-    from collections import defaultdict
     tpb = midi.ticks_per_beat
-    src_track = midi.tracks[0]
+    msgs = list(midi.tracks[0])
+    new_midi = mido.MidiFile(ticks_per_beat=tpb, type=1)
 
-    # Tempo assoluto per ogni messaggio
-    events = []
-    abs_time = 0
-    for msg in src_track:
-        abs_time += msg.time
-        events.append((abs_time, msg))
+    abs_ticks = np.cumsum(np.fromiter((msg.time for msg in msgs), dtype=np.int64, count=len(msgs)))
+    channel = np.fromiter((getattr(msg, 'channel', -1) if not msg.is_meta else -1 for msg in msgs),
+                          dtype=np.int64, count=len(msgs))
+    is_program = np.fromiter((msg.type == 'program_change' for msg in msgs), dtype=bool, count=len(msgs))
+    is_note = np.fromiter((msg.type == 'note_on' and msg.velocity > 0 for msg in msgs), dtype=bool, count=len(msgs))
 
     # Leggi program_change per canale (primo trovato vince)
-    ch_program = {}
-    for _, msg in events:
-        if msg.type == 'program_change' and msg.channel not in ch_program:
-            ch_program[msg.channel] = msg.program
-
-    # Separa meta e messaggi per canale
-    meta_events = []
-    ch_events = defaultdict(list)
-    for abs_t, msg in events:
-        if msg.is_meta:
-            meta_events.append((abs_t, msg))
-        elif hasattr(msg, 'channel'):
-            ch_events[msg.channel].append((abs_t, msg))
-        else:
-            meta_events.append((abs_t, msg))
-
-    # Tieni solo canali che hanno almeno una nota
-    active_channels = {
-        ch for ch, evs in ch_events.items()
-        if any(m.type == 'note_on' and m.velocity > 0 for _, m in evs)
-    }
-
-    new_midi = mido.MidiFile(ticks_per_beat=tpb, type=1)
+    prog_rows = np.flatnonzero(is_program)
+    prog_channels, first = np.unique(channel[prog_rows], return_index=True)
+    ch_program = {int(ch): msgs[prog_rows[i]].program for ch, i in zip(prog_channels, first)}
+
+    # Tieni solo canali che hanno almeno una nota (piu' la partizione meta)
+    active_channels = np.unique(channel[is_note]).tolist()
+    keep = (channel == -1) | np.isin(channel, active_channels)
+    rows = np.flatnonzero(keep)
+    order = rows[np.argsort(channel[rows], kind='stable')]
+    part = channel[order]
+    part_ticks = abs_ticks[order]
+    deltas = np.diff(part_ticks, prepend=0)
+    part_starts = np.flatnonzero(np.diff(part, prepend=-2))
+    deltas[part_starts] = part_ticks[part_starts]
+    bounds = dict(zip(part[part_starts].tolist(), zip(part_starts.tolist(), np.append(part_starts[1:], order.size).tolist())))
+
+    def _partition_track(ch):
+        track = mido.MidiTrack()
+        lo, hi = bounds.get(ch, (0, 0))
+        # i delta vengono da np.diff di tick validi: niente ricontrollo dei messaggi di canale
+        track.extend(thaw_message(msgs[i]).copy(time=d) if msgs[i].is_meta else msgs[i].copy(skip_checks=True, time=d)
+                     for i, d in zip(order[lo:hi].tolist(), deltas[lo:hi].tolist()))
+        return track
 
     # Traccia 0: solo meta
-    meta_track = mido.MidiTrack()
+    meta_track = _partition_track(-1)
     meta_track.name = "Meta"
-    last_t = 0
-    for abs_t, msg in sorted(meta_events, key=lambda x: x[0]):
-        delta = abs_t - last_t
-        meta_track.append(msg.copy(time=delta))
-        last_t = abs_t
     new_midi.tracks.append(meta_track)
 
     # Conta quante volte compare ogni nome GM (per disambiguare duplicati)
     name_count = defaultdict(int)
     ch_names = {}
-    for ch in sorted(active_channels):
+    for ch in active_channels:
         prog = ch_program.get(ch, 0)
         base_name = _gm_track_name(prog, ch)
         name_count[base_name] += 1
@@ -1979,7 +3960,7 @@ def _split_type0_to_tracks(midi):
     # Se un nome compare più volte, aggiungi suffisso numerico
     seen = defaultdict(int)
     final_names = {}
-    for ch in sorted(active_channels):
+    for ch in active_channels:
         base_name, prog = ch_names[ch]
         if name_count[base_name] > 1:
             seen[base_name] += 1
@@ -1988,15 +3969,9 @@ def _split_type0_to_tracks(midi):
             final_names[ch] = base_name
 
     # Una traccia per canale attivo
-    for ch in sorted(active_channels):
-        ch_track = mido.MidiTrack()
+    for ch in active_channels:
+        ch_track = _partition_track(ch)
         ch_track.name = final_names[ch]
-        last_t = 0
-        evs = sorted(ch_events[ch], key=lambda x: x[0])
-        for abs_t, msg in evs:
-            delta = abs_t - last_t
-            ch_track.append(msg.copy(time=delta))
-            last_t = abs_t
         new_midi.tracks.append(ch_track)
 
     return new_midi
@@ -2016,17 +3991,13 @@ def midi_recomposer(original_midi, style):
     from collections import Counter
 
     # File tipo 0: esplodi canali in tracce separate prima di ricomporre
-    if original_midi.type == 0 or (len(original_midi.tracks) == 1 and
-            len({m.channel for t in original_midi.tracks for m in t if hasattr(m,'channel')}) > 1):
+    if _is_type0_like(original_midi):
         original_midi = _split_type0_to_tracks(original_midi)
 
     tpb = original_midi.ticks_per_beat
 
     # Durata totale originale in ticks
-    total_ticks = 0
-    for track in original_midi.tracks:
-        t = sum(msg.time for msg in track)
-        total_ticks = max(total_ticks, t)
+    total_ticks = build_time_index(original_midi)['end_tick']
     if total_ticks == 0:
         total_ticks = tpb * 4 * 32  # fallback 32 battute
 
@@ -2216,7 +4187,7 @@ if 'midi_filename' not in st.session_state: st.session_state.midi_filename = ""
 def build_report(original_file, original_midi, output_midi, selected_methods, parameters, midi_methods, stile=None):
     n_tracks_in  = len(original_midi.tracks)
     n_tracks_out = len(output_midi.tracks)
-    duration     = round(original_midi.length, 2)
+    duration     = round(build_time_index(original_midi)['duration'], 2)
     tpb          = original_midi.ticks_per_beat
 
     method_lines = []
@@ -2230,16 +4201,28 @@ def build_report(original_file, original_midi, output_midi, selected_methods, pa
             method_lines.append(f"   * Pitch Shift: +/-{params[2]} semitoni | Velocity: {params[3]}%")
 
         elif method_key == "MIDI Phrase Reconstructor":
-            method_lines.append(f"   * Lunghezza frase: {params[0]} battute | Stile: {params[1]}")
+            phrase_len_label = "automatica" if params[0] == "auto" else params[0]
+            method_lines.append(f"   * Lunghezza frase: {phrase_len_label} battute | Stile: {params[1]}")
+            if len(params) > 3:
+                method_lines.append(f"   * Segmentazione: {params[2]} | Note a cavallo: {params[3]}")
 
         elif method_key == "MIDI Time Scrambler":
             method_lines.append(f"   * Stretch: {params[0]}x | Quantizzazione: {params[1]}% | Swing: {params[2]}%")
+            if len(params) > 5:
+                method_lines.append(f"   * Griglia: {params[3]} | Curva swing: {params[4] if params[4] else 'uniforme'} | Groove template: {'Sì' if params[5] is not None else 'No'}")
+            if len(params) > 6:
+                tempo_map_used = params[6] == "Automatico (tempo map)" and params[1] <= 0
+                method_lines.append(f"   * Stretch: {'tempo map (set_tempo scalati, tick invariati)' if tempo_map_used else 'riscrittura tick'}")
 
         elif method_key == "MIDI Density Transformer":
             method_lines.append(f"   * Aggiungi note: {params[0]}% | Rimuovi note: {params[1]}% | Polifonia: {params[2]}")
+            if len(params) > 3:
+                method_lines.append(f"   * Armonizzazione: {'tonalità locale rilevata' if params[3] else 'intervalli cromatici fissi'}")
 
         elif method_key == "MIDI Random Pitch Transformer":
             method_lines.append(f"   * Forza randomizzazione: {params[0]}%")
+            if len(params) > 2:
+                method_lines.append(f"   * Distribuzione: {params[1]} | Sigma: {params[2]} semitoni")
 
         elif method_key == "MIDI Rhythmic Base":
             drums = []
@@ -2248,6 +4231,8 @@ def build_report(original_file, original_midi, output_midi, selected_methods, pa
             if params[2]: drums.append("Hi-hat")
             method_lines.append(f"   * Elementi: {', '.join(drums) if drums else 'Nessuno'}")
             method_lines.append(f"   * Metrica: {params[3]} | Pattern: {params[4]}")
+            if len(params) > 5:
+                method_lines.append(f"   * Cambi di metrica del file: {'seguiti' if params[5] else 'ignorati'}")
 
         elif method_key == "MIDI Costas Sequencer":
             costas_mode = params[0]
@@ -2255,9 +4240,14 @@ def build_report(original_file, original_midi, output_midi, selected_methods, pa
             if costas_mode == "Permutazione Pitch (Cromatica)":
                 method_lines.append(f"   * Trasposizione: {params[2]} ottave | Costruzione di Welch, n=12, p=13")
             elif costas_mode == "Griglia Ritmica Costas":
-                method_lines.append("   * Costruzione di Welch (Scott Rickard / J.P. Costas)")
+                construction_r = params[5] if len(params) > 5 else "Welch"
+                method_lines.append(f"   * Costruzione: {construction_r} (Welch: Scott Rickard / J.P. Costas; Lempel/Golomb su GF(q))")
+                if isinstance(params[2], str):
+                    method_lines.append(f"   * Permutazione: {params[2]}")
             else:
                 method_lines.append(f"   * Pitch base: {params[2]} | Estensione: {params[3]} semitoni | Passo: {params[4]} beat")
+                if len(params) > 5:
+                    method_lines.append(f"   * Costruzione: {params[5]}")
 
         elif method_key == "MIDI Stockhausen Punktuelle":
             dur_on, dyn_on, timbre_on, iso_on, row_used = params
@@ -2288,26 +4278,51 @@ def build_report(original_file, original_midi, output_midi, selected_methods, pa
             method_lines.append("   * Operazioni di caso via I Ching, metodo delle tre monete (Cage, 'Music of Changes', 1951)")
 
         elif method_key == "MIDI Eno Generative":
-            num_loops_r, min_lb, max_lb, nlr, dm, vb = params
+            num_loops_r, min_lb, max_lb, nlr, dm, vb = params[:6]
             method_lines.append(f"   * Numero loop: {num_loops_r} | Lunghezza: {min_lb}-{max_lb} beat | Estensione durata: ×{dm}")
             method_lines.append(f"   * Rapporto durata nota/loop: {nlr} | Velocity base: {vb}")
+            if len(params) > 6 and params[6]:
+                eno_system_r = params[6]
+                method_lines.append(f"   * Periodo esatto del sistema (MCM dei cicli): {eno_system_r['period_ticks']} tick ({eno_system_r['period_ticks'] / tpb:g} beat)")
+                if eno_system_r['realign'] is None:
+                    method_lines.append("   * Primo riallineamento tra due loop: mai (fasi incompatibili per ogni coppia)")
+                else:
+                    realign_tick, loop_a, loop_b = eno_system_r['realign']
+                    method_lines.append(f"   * Primo riallineamento tra due loop: tick {realign_tick} ({realign_tick / tpb:g} beat, loop {loop_a + 1} e {loop_b + 1}) "
+                                        f"| Durata generata: {eno_system_r['total_ticks']} tick "
+                                        f"({float(ticks_to_seconds(original_midi, eno_system_r['total_ticks'])):.1f} s)")
             method_lines.append("   * Loop asincroni a lunghezze incommensurabili (Eno, 'Music for Airports'/'Discreet Music')")
 
         elif method_key == "MIDI Bach Canon":
-            num_voices_r, interval_r, delay_r, transf_r = params
-            method_lines.append(f"   * Voci: {num_voices_r} | Intervallo tra voci: {interval_r} semitoni | Ritardo (comes): {delay_r} beat")
-            method_lines.append(f"   * Trasformazione: {transf_r}")
+            num_voices_r, interval_r, delay_r, transf_r = params[:4]
+            if len(params) > 4 and params[4] == "Esposizione di fuga":
+                method_lines.append(f"   * Voci: {num_voices_r} | Risposta a {interval_r} semitoni | Ingressi a ogni frase rilevata")
+            else:
+                method_lines.append(f"   * Voci: {num_voices_r} | Intervallo tra voci: {interval_r} semitoni | Ritardo (comes): {delay_r} beat")
+            if len(params) > 4 and params[4] == "Esposizione di fuga":
+                method_lines.append(f"   * Trasformazione: {transf_r} (solo rientri dopo l'esposizione)")
+            elif transf_r == "Retrogrado (canone cancrizzante)":
+                method_lines.append(f"   * Trasformazione: {transf_r} (tutte le voci)")
+            else:
+                method_lines.append(f"   * Trasformazione: {transf_r}")
+            if len(params) > 4:
+                method_lines.append(f"   * Forma: {params[4]} | Soggetto: intera linea melodica")
             method_lines.append("   * Canone rigoroso (Bach, Arte della Fuga / Offerta Musicale)")
 
         elif method_key == "MIDI Glass Additive":
-            cell_len_r, direction_r, repeats_r = params
+            cell_len_r, direction_r, repeats_r = params[:3]
             method_lines.append(f"   * Lunghezza cellula: {cell_len_r} note | Direzione: {direction_r} | Ripetizioni per stadio: {repeats_r}")
+            if len(params) > 3 and direction_r == "1+1 (combinazioni di due cellule)":
+                method_lines.append(f"   * Formula 1+1: {', '.join(parse_glass_formula(params[3])) or GLASS_DEFAULT_FORMULA}")
             method_lines.append("   * Processo additivo (Glass, 'Two Pages'/'1+1'/'Music in Twelve Parts')")
 
         elif method_key == "MIDI Messiaen Modes":
-            mode_r, transp_r, nrr_r, cell_notes_r = params
+            mode_r, transp_r, nrr_r, cell_notes_r = params[:4]
             method_lines.append(f"   * Modo a trasposizione limitata: Modo {mode_r} | Trasposizione: +{transp_r} semitoni")
-            method_lines.append(f"   * Ritmo non retrogradabile: {'Sì' if nrr_r else 'No'} (cellula: {cell_notes_r} valori)")
+            if len(params) > 4 and nrr_r and params[4].startswith("Tala: "):
+                method_lines.append(f"   * Ritmo: {params[4]}")
+            else:
+                method_lines.append(f"   * Ritmo non retrogradabile: {'Sì' if nrr_r else 'No'} (cellula: {cell_notes_r} valori)")
             method_lines.append("   * Modi a trasposizione limitata (Messiaen, 'Technique de mon langage musical', 1944)")
 
         elif method_key == "MIDI Part Tintinnabuli":
@@ -2316,9 +4331,12 @@ def build_report(original_file, original_midi, output_midi, selected_methods, pa
             method_lines.append("   * Tintinnabuli (Pärt, dal 1976: 'Spiegel im Spiegel', 'Für Alina')")
 
         elif method_key == "MIDI Reich Phasing":
-            cell_len_r, cycles_r, shift_units_r, shift_every_r = params
+            cell_len_r, cycles_r, shift_units_r, shift_every_r = params[:4]
             method_lines.append(f"   * Lunghezza cellula: {cell_len_r} note | Cicli: {cycles_r}")
             method_lines.append(f"   * Sfasamento: +{shift_units_r} unità ogni {shift_every_r} cicli")
+            if len(params) > 6:
+                rates_desc = ", ".join(f"{REICH_VOICE_LETTERS[k + 1]}×{rate:g}" for k, rate in enumerate(params[6]))
+                method_lines.append(f"   * Voci: {params[4]} | Modalità: {params[5]} | Moltiplicatori: {rates_desc}")
             method_lines.append("   * Phasing processuale (Reich, 'Piano Phase'/'Clapping Music')")
 
     report = "[MIDI_DECOMPOSER] // VOL_01 // MIDI // STRUCTURAL_DECOMPOSITION\n"
@@ -2326,7 +4344,8 @@ def build_report(original_file, original_midi, output_midi, selected_methods, pa
     report += f":: FILE: {original_file}\n"
     if stile:
         report += f":: STILE: {stile}\n"
-    report += f":: TRACCE: {n_tracks_in} | DURATA: {duration} sec | TICKS/BEAT: {tpb}\n"
+    report += f":: TRACCE: {n_tracks_in} | DURATA: {duration} sec | TICKS/BEAT: {tpb}"
+    report += f" (esportato a {output_midi.ticks_per_beat})\n" if output_midi.ticks_per_beat != tpb else "\n"
     report += "\n"
     report += "\"Il file e' entrato come partitura. E' uscito come esperimento.\"\n"
     report += "\n"
@@ -2372,6 +4391,38 @@ def render_midi_player(midi_bytes, label, key_suffix=""):
     """
     components.html(html_code, height=260, scrolling=False)
 
+@st.cache_resource(show_spinner=False, max_entries=4)
+def load_midi_file(file_bytes, ticks_per_beat=None, coalesce=False, thin_tolerance=None):
+    """
+    Legge il file MIDI caricato, esplode i file tipo 0 in una traccia per
+    canale (_split_type0_to_tracks, una volta sola per tutte le
+    trasformazioni), lo ricampiona a ticks_per_beat se indicato
+    (resample_midi, con coalesce degli eventi duplicati), sfoltisce le
+    curve di controller con thin_tolerance se indicata
+    (thin_controller_curves) e precalcola le MessageTable delle tracce
+    (message_table), l'indice tonale (build_key_index), l'indice degli
+    intervalli di nota (build_note_interval_index), l'indice temporale
+    (build_time_index) e la metrica rilevata (detect_meter), cosi' i rerun di Streamlit e le trasformazioni
+    non li ricalcolano. Il file in cache e' condiviso per riferimento tra i
+    rerun: le sue tracce sono SharedTrack (share_tracks), quindi nessuna
+    trasformazione puo' alterarlo.
+    """
+    midi = mido.MidiFile(file=io.BytesIO(file_bytes))
+    if _is_type0_like(midi):
+        midi = _split_type0_to_tracks(midi)
+    midi = resample_midi(midi, ticks_per_beat, coalesce)
+    if thin_tolerance is not None:
+        midi = thin_controller_curves(midi, thin_tolerance)
+    share_tracks(midi)
+    for track in midi.tracks:
+        message_table(track)
+    build_key_index(midi)
+    build_note_interval_index(midi)
+    build_time_index(midi)
+    detect_meter(midi)
+    return midi
+
+
 # --- Sezione Upload File MIDI ---
 st.subheader("🎵 Carica il tuo file MIDI (.mid o .midi)")
 uploaded_midi_file = st.file_uploader(
@@ -2385,11 +4436,32 @@ if uploaded_midi_file is not None:
     st.success("File MIDI caricato con successo!")
 
     try:
-        midi_data = mido.MidiFile(file=uploaded_midi_file)
+        with st.expander("📐 Risoluzione (PPQ) ed esportazione"):
+            st.caption("Ricampiona i tick del file a una risoluzione piu' bassa: le trasformazioni lavorano con numeri piu' piccoli e i file esportati sono piu' leggeri.")
+            col_ppq1, col_ppq2 = st.columns(2)
+            with col_ppq1:
+                load_ppq = st.selectbox("PPQ al caricamento", ["Originale"] + list(RESAMPLE_PPQ_CHOICES), key="load_ppq")
+                load_coalesce = st.checkbox("Unisci eventi duplicati (controller allo stesso tick)", value=False, key="load_coalesce")
+                load_thin = st.checkbox(
+                    "Sfoltisci CC, pitch bend e aftertouch", value=False, key="load_thin",
+                    help="Elimina i valori ripetuti e riduce le curve di controller entro la tolleranza prima delle trasformazioni."
+                )
+                thin_tolerance = st.slider("Tolleranza sfoltimento (valori a 7 bit)", 0, 16, 2, key="thin_tolerance", disabled=not load_thin)
+            with col_ppq2:
+                export_ppq = st.selectbox("PPQ all'esportazione", ["Originale"] + list(RESAMPLE_PPQ_CHOICES), key="export_ppq")
+                export_optimize = st.checkbox(
+                    "Ottimizza l'output", value=False, key="export_optimize",
+                    help="Fonde le note sovrapposte sulla stessa nota, elimina note di durata nulla ed eventi duplicati, "
+                         "riporta i valori nei range MIDI e scrive i note_off come note_on a velocity 0 (running status)."
+                )
+        load_ppq = None if load_ppq == "Originale" else load_ppq
+        export_ppq = None if export_ppq == "Originale" else export_ppq
+        midi_data = load_midi_file(uploaded_midi_file.getvalue(), load_ppq, load_coalesce,
+                                   thin_tolerance if load_thin else None)
         st.subheader("File MIDI Caricato: Panoramica")
         st.write(f"Nome file: **{uploaded_midi_file.name}**")
         st.write(f"Numero di tracce: **{len(midi_data.tracks)}**")
-        st.write(f"Durata (stimata): **{midi_data.length:.2f} secondi**")
+        st.write(f"Durata (stimata): **{build_time_index(midi_data)['duration']:.2f} secondi**")
 
         with st.expander("🎧 Ascolta il MIDI originale"):
             _orig_bytes_io = io.BytesIO()
@@ -2523,9 +4595,9 @@ if uploaded_midi_file is not None:
 
             if st.button("🔁 Ricomponi", type="primary", use_container_width=True, key="btn_recomponi"):
                 with st.spinner("Ricomponendo traccia per traccia..."):
-                    recomposed = midi_recomposer(midi_data, style_key)
+                    recomposed = prepare_export(midi_recomposer(midi_data, style_key), export_ppq, export_optimize)
                     midi_out_bytes = io.BytesIO()
-                    recomposed.save(file=midi_out_bytes)
+                    save_midi_file(recomposed, midi_out_bytes, note_off_as_note_on=export_optimize)
                     midi_out_bytes.seek(0)
                     st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                     st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Recomposed.mid"
@@ -2571,8 +4643,9 @@ if uploaded_midi_file is not None:
                         result_midi, row_used = midi_stockhausen_punktuelle(
                             midi_data, serialize_duration, serialize_dynamics, serialize_timbre, isolamento_punti
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Stockhausen.mid"
@@ -2611,8 +4684,9 @@ if uploaded_midi_file is not None:
                     with st.spinner("Moltiplicando gli insiemi di classi di altezza..."):
                         result_midi, sets_info = midi_boulez_multiplication(midi_data, set_size, chord_density, register_spread)
                         set_a, set_b, multiplied = sets_info
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Boulez.mid"
@@ -2659,10 +4733,12 @@ if uploaded_midi_file is not None:
                     with st.spinner("Generando la nuvola stocastica (Poisson + Gauss + crivello)..."):
                         result_midi, sieve_used = midi_xenakis_stochastic(
                             midi_data, sieve_pairs, mean_events_per_beat, pitch_center, pitch_spread,
-                            duration_mean, velocity_mean, velocity_spread, seed=xenakis_seed
+                            duration_mean, velocity_mean, velocity_spread, seed=xenakis_seed,
+                            streaming=True
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Xenakis.mid"
@@ -2696,8 +4772,9 @@ if uploaded_midi_file is not None:
                         result_midi, hexagram_log = midi_cage_chance_operations(
                             midi_data, silence_probability, duration_variety, seed=cage_seed
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Cage.mid"
@@ -2730,66 +4807,85 @@ if uploaded_midi_file is not None:
                     note_length_ratio = st.slider("Durata nota (frazione del loop):", 0.05, 0.9, 0.35, 0.05, key="eno_note_ratio")
                     duration_multiplier = st.slider("Estensione durata brano (×):", 1, 12, 4, key="eno_dur_mult")
                     velocity_base = st.slider("Velocity base:", 15, 90, 55, key="eno_vel_base")
+                eno_merge_loops = st.checkbox("Tutti i loop in un'unica traccia", value=False, key="eno_merge_loops")
                 eno_seed_input = st.text_input("Seed (opzionale, per riproducibilità):", value="", key="eno_seed")
                 eno_seed = int(eno_seed_input) if eno_seed_input.strip().isdigit() else None
 
                 if st.button("🌫️ Applica Musica Generativa", type="primary", use_container_width=True, key="btn_eno"):
                     with st.spinner("Costruendo i cicli asincroni (lunghezze basate su numeri primi)..."):
-                        result_midi, loops_info = midi_eno_generative(
+                        result_midi, loops_info, eno_system = midi_eno_generative(
                             midi_data, num_loops, min_loop_beats, max_loop_beats,
-                            note_length_ratio, duration_multiplier, velocity_base, seed=eno_seed
+                            note_length_ratio, duration_multiplier, velocity_base, seed=eno_seed,
+                            streaming=True, merge_loops=eno_merge_loops
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Eno.mid"
                         st.session_state.midi_report   = build_report(
                             uploaded_midi_file.name, midi_data, result_midi,
                             ["MIDI Eno Generative"],
-                            {"MIDI Eno Generative": (num_loops, min_loop_beats, max_loop_beats, note_length_ratio, duration_multiplier, velocity_base)},
+                            {"MIDI Eno Generative": (num_loops, min_loop_beats, max_loop_beats, note_length_ratio, duration_multiplier, velocity_base, eno_system)},
                             midi_methods, stile=compositore_label
                         )
                         st.session_state.midi_ready = True
-                        loop_desc = ", ".join(f"{p}t" for _, p, _ in loops_info[:6])
+                        loop_desc = ", ".join(f"{p}t" for _, p, _, _ in loops_info[:6])
                         st.success(f"✅ Sistema generativo creato! {len(loops_info)} loop asincroni, cicli: {loop_desc}{'...' if len(loops_info) > 6 else ''}")
+                        if eno_system:
+                            tpb_eno = midi_data.ticks_per_beat
+                            realign = eno_system['realign']
+                            if realign is None:
+                                realign_desc = "nessuna coppia di loop si riallinea mai"
+                            else:
+                                realign_mult = math.ceil(realign[0] / eno_system['base_ticks'])
+                                realign_desc = (f"primo riallineamento a {realign[0] / tpb_eno:g} beat (loop {realign[1] + 1} e {realign[2] + 1}, "
+                                                f"udibile con estensione ×{realign_mult})")
+                            st.caption(f"Periodo esatto del sistema (MCM dei cicli): {eno_system['period_ticks'] / tpb_eno:g} beat — {realign_desc}")
 
             elif compositore_key == "MIDI Bach Canon":
                 st.info(
                     "**Canone rigoroso** (*L'Arte della Fuga*, *Offerta Musicale*) — il soggetto (dux) "
-                    "viene estratto dalle prime note del brano; ogni voce successiva (comes) lo "
+                    "e' l'intera prima linea melodica del brano; ogni voce successiva (comes) lo "
                     "ripropone a distanza di tempo fissa, trasposta a un dato intervallo, ed "
                     "eventualmente **invertita** (canone al rovescio), **retrogradata** (canone "
                     "cancrizzante) o **aumentata ritmicamente**. Costruzione interamente deterministica."
                 )
                 col_bc1, col_bc2 = st.columns(2)
                 with col_bc1:
-                    num_voices = st.slider("Numero di voci (dux + comes):", 2, 4, 2, key="bach_num_voices")
+                    num_voices = st.slider("Numero di voci (dux + comes):", 2, 8, 2, key="bach_num_voices")
                     interval_semitones = st.slider("Intervallo tra voci (semitoni):", -12, 12, 7, key="bach_interval")
                 with col_bc2:
                     delay_beats = st.slider("Ritardo del comes (beat):", 0.5, 8.0, 2.0, 0.5, key="bach_delay")
                     transformation = st.selectbox(
                         "Trasformazione del comes:",
-                        ["Nessuna (canone rigoroso)", "Inversione (canone al rovescio)",
-                         "Retrogrado (canone cancrizzante)", "Aumentazione ritmica (comes raddoppiato)"],
+                        BACH_TRANSFORMATIONS,
                         key="bach_transformation"
                     )
+                bach_form = st.radio(
+                    "Forma:", BACH_FORMS, horizontal=True, key="bach_form",
+                    help="Esposizione di fuga: ingressi di soggetto/risposta a ogni frase rilevata, "
+                         "ruotando tra le voci per tutto il brano (il ritardo del comes non si usa)."
+                )
                 augmentation_factor = 2
 
                 if st.button("🎻 Applica Canone", type="primary", use_container_width=True, key="btn_bach"):
                     with st.spinner("Costruendo il canone (dux/comes)..."):
                         result_midi, voices_info = midi_bach_canon(
-                            midi_data, num_voices, interval_semitones, delay_beats, transformation, augmentation_factor
+                            midi_data, num_voices, interval_semitones, delay_beats, transformation, augmentation_factor,
+                            form=bach_form
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Bach.mid"
                         st.session_state.midi_report   = build_report(
                             uploaded_midi_file.name, midi_data, result_midi,
                             ["MIDI Bach Canon"],
-                            {"MIDI Bach Canon": (num_voices, interval_semitones, delay_beats, transformation)},
+                            {"MIDI Bach Canon": (num_voices, interval_semitones, delay_beats, transformation, bach_form)},
                             midi_methods, stile=compositore_label
                         )
                         st.session_state.midi_ready = True
@@ -2804,29 +4900,36 @@ if uploaded_midi_file is not None:
                 )
                 col_gl1, col_gl2 = st.columns(2)
                 with col_gl1:
-                    cell_length_notes = st.slider("Lunghezza cellula (note):", 3, 16, 8, key="glass_cell_len")
+                    cell_length_notes = st.slider("Lunghezza cellula (note):", 3, 256, 8, key="glass_cell_len")
                     repeats_per_stage = st.slider("Ripetizioni per stadio:", 1, 8, 2, key="glass_repeats")
                 with col_gl2:
                     direction = st.selectbox(
                         "Direzione del processo:",
-                        ["Additivo (solo crescita)", "Additivo-sottrattivo (cresce poi decresce)"],
+                        GLASS_DIRECTIONS,
                         key="glass_direction"
                     )
+                    glass_formula = GLASS_DEFAULT_FORMULA
+                    if direction == "1+1 (combinazioni di due cellule)":
+                        glass_formula = st.text_input(
+                            "Formula 1+1 (stadi di cellule a/b):", value=GLASS_DEFAULT_FORMULA, key="glass_formula",
+                            help="a = prime N note del brano, b = le N successive. Es. 'ab, aab, aaab' oppure 'a+b, a+a+b'."
+                        )
 
                 if st.button("➕ Applica Processo Additivo", type="primary", use_container_width=True, key="btn_glass"):
                     with st.spinner("Costruendo il processo additivo..."):
                         result_midi, stages = midi_glass_additive(
-                            midi_data, cell_length_notes, direction, repeats_per_stage
+                            midi_data, cell_length_notes, direction, repeats_per_stage, glass_formula
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Glass.mid"
                         st.session_state.midi_report   = build_report(
                             uploaded_midi_file.name, midi_data, result_midi,
                             ["MIDI Glass Additive"],
-                            {"MIDI Glass Additive": (cell_length_notes, direction, repeats_per_stage)},
+                            {"MIDI Glass Additive": (cell_length_notes, direction, repeats_per_stage, glass_formula)},
                             midi_methods, stile=compositore_label
                         )
                         st.session_state.midi_ready = True
@@ -2838,7 +4941,7 @@ if uploaded_midi_file is not None:
                     "ogni altezza del brano viene riquantizzata sulla classe più vicina del modo "
                     "scelto (scale a simmetria interna, con meno di 12 trasposizioni distinte). "
                     "Opzionalmente il ritmo viene sostituito da una sequenza **non retrogradabile** "
-                    "(palindroma: identica letta avanti o indietro)."
+                    "(palindroma: identica letta avanti o indietro) o da un **tala** indiano."
                 )
                 col_me1, col_me2 = st.columns(2)
                 with col_me1:
@@ -2846,25 +4949,33 @@ if uploaded_midi_file is not None:
                                                 format_func=lambda m: f"Modo {m} ({len(MESSIAEN_MODES[m])} note)")
                     transposition = st.slider("Trasposizione (semitoni):", 0, 11, 0, key="messiaen_transp")
                 with col_me2:
-                    non_retrogradable_rhythm = st.checkbox("Ritmo non retrogradabile (palindromo)", value=True, key="messiaen_nrr")
-                    rhythm_cell_notes = st.slider("Lunghezza cellula ritmica:", 3, 15, 7, key="messiaen_rhythm_len") if non_retrogradable_rhythm else 7
+                    non_retrogradable_rhythm = st.checkbox("Sostituisci il ritmo (cellula ciclica)", value=True, key="messiaen_nrr")
+                    messiaen_rhythm_source = st.selectbox(
+                        "Cellula ritmica:", MESSIAEN_RHYTHM_SOURCES, key="messiaen_rhythm_source",
+                        disabled=not non_retrogradable_rhythm,
+                        help="Un ritmo palindromo dal catalogo precalcolato, oppure un tala indiano (sistema suladi)."
+                    )
+                    rhythm_cell_notes = st.slider("Lunghezza cellula ritmica:", 3, 15, 7, key="messiaen_rhythm_len") \
+                        if non_retrogradable_rhythm and not messiaen_rhythm_source.startswith("Tala: ") else 7
                 messiaen_seed_input = st.text_input("Seed (opzionale, per riproducibilità):", value="", key="messiaen_seed")
                 messiaen_seed = int(messiaen_seed_input) if messiaen_seed_input.strip().isdigit() else None
 
                 if st.button("🕊️ Applica Modi di Messiaen", type="primary", use_container_width=True, key="btn_messiaen"):
                     with st.spinner("Riquantizzando sul modo scelto..."):
                         result_midi, mode_used = midi_messiaen_modes(
-                            midi_data, mode_number, transposition, non_retrogradable_rhythm, rhythm_cell_notes, seed=messiaen_seed
+                            midi_data, mode_number, transposition, non_retrogradable_rhythm, rhythm_cell_notes, seed=messiaen_seed,
+                            rhythm_source=messiaen_rhythm_source
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Messiaen.mid"
                         st.session_state.midi_report   = build_report(
                             uploaded_midi_file.name, midi_data, result_midi,
                             ["MIDI Messiaen Modes"],
-                            {"MIDI Messiaen Modes": (mode_number, transposition, non_retrogradable_rhythm, rhythm_cell_notes)},
+                            {"MIDI Messiaen Modes": (mode_number, transposition, non_retrogradable_rhythm, rhythm_cell_notes, messiaen_rhythm_source)},
                             midi_methods, stile=compositore_label
                         )
                         st.session_state.midi_ready = True
@@ -2884,7 +4995,8 @@ if uploaded_midi_file is not None:
                 with col_pa2:
                     t_voice_position = st.selectbox(
                         "Posizione voce T:",
-                        ["T-1 (piu' vicina sotto)", "T+1 (piu' vicina sopra)", "T-2 (seconda piu' vicina sotto)", "T+2 (seconda piu' vicina sopra)"],
+                        ["T-1 (piu' vicina sotto)", "T+1 (piu' vicina sopra)", "T-2 (seconda piu' vicina sotto)", "T+2 (seconda piu' vicina sopra)",
+                         "T-1 (evita le note gia' suonanti)"],
                         key="part_t_position"
                     )
 
@@ -2893,8 +5005,9 @@ if uploaded_midi_file is not None:
                         result_midi, triad_used = midi_part_tintinnabuli(
                             midi_data, tonic_key, triad_type, t_voice_position
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Part.mid"
@@ -2910,8 +5023,9 @@ if uploaded_midi_file is not None:
             elif compositore_key == "MIDI Reich Phasing":
                 st.info(
                     "**Phasing processuale** (*Piano Phase*, 1967 / *Clapping Music*, 1972) — una "
-                    "cellula viene estratta dal brano e suonata in loop su due voci identiche: la voce "
-                    "A resta fissa, la voce B si sfasa gradualmente di un incremento fisso ogni N cicli. "
+                    "cellula viene estratta dal brano e suonata in loop su piu' voci identiche: la voce "
+                    "A resta fissa, le altre si sfasano gradualmente di un incremento fisso ogni N cicli "
+                    "(a gradini) o con una deriva continua di tempo, come in *Piano Phase*. "
                     "Un processo udibile, passo per passo, non un effetto casuale."
                 )
                 col_re1, col_re2 = st.columns(2)
@@ -2921,21 +5035,35 @@ if uploaded_midi_file is not None:
                 with col_re2:
                     phase_shift_units = st.slider("Ampiezza sfasamento (unità cellula):", 1, 4, 1, key="reich_shift_units")
                     shift_every_n_cycles = st.slider("Sfasa ogni N cicli:", 1, 16, 4, key="reich_shift_every")
+                col_re3, col_re4 = st.columns(2)
+                with col_re3:
+                    reich_num_voices = st.slider("Numero di voci:", 2, len(REICH_VOICE_LETTERS), 2, key="reich_num_voices")
+                    reich_phase_mode = st.selectbox("Modalità di sfasamento:", REICH_PHASE_MODES, key="reich_phase_mode")
+                with col_re4:
+                    reich_rates_input = st.text_input(
+                        "Moltiplicatori di sfasamento per voce (opzionale, es. '1, 2, 3'):", value="", key="reich_rates",
+                        help="Uno per ogni voce mobile (B, C, ...). Vuoto = 1x, 2x, 3x..."
+                    )
+                reich_shift_rates = parse_reich_shift_rates(reich_rates_input, reich_num_voices - 1)
 
                 if st.button("🌀 Applica Phasing", type="primary", use_container_width=True, key="btn_reich"):
                     with st.spinner("Costruendo lo sfasamento processuale..."):
                         result_midi, final_phase = midi_reich_phasing(
-                            midi_data, cell_length_notes_r, num_cycles, phase_shift_units, shift_every_n_cycles
+                            midi_data, cell_length_notes_r, num_cycles, phase_shift_units, shift_every_n_cycles,
+                            streaming=True, num_voices=reich_num_voices, shift_rates=reich_shift_rates,
+                            phase_mode=reich_phase_mode
                         )
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Reich.mid"
                         st.session_state.midi_report   = build_report(
                             uploaded_midi_file.name, midi_data, result_midi,
                             ["MIDI Reich Phasing"],
-                            {"MIDI Reich Phasing": (cell_length_notes_r, num_cycles, phase_shift_units, shift_every_n_cycles)},
+                            {"MIDI Reich Phasing": (cell_length_notes_r, num_cycles, phase_shift_units, shift_every_n_cycles,
+                                                    reich_num_voices, reich_phase_mode, reich_shift_rates)},
                             midi_methods, stile=compositore_label
                         )
                         st.session_state.midi_ready = True
@@ -2943,7 +5071,7 @@ if uploaded_midi_file is not None:
 
             else:  # Costas Sequencer
                 st.caption(
-                    "Basato sulla costruzione di Welch (Scott Rickard / J.P. Costas): "
+                    "Basato sulle costruzioni di Welch, Lempel e Golomb (Scott Rickard / J.P. Costas): "
                     "una permutazione algoritmica in cui nessun vettore-differenza tra "
                     "coppie si ripete. Nessuna rete neurale, nessun random puro — pura DSP/combinatoria."
                 )
@@ -2956,38 +5084,43 @@ if uploaded_midi_file is not None:
                 if costas_mode == "Permutazione Pitch (Cromatica)":
                     st.info("Usa una matrice di Costas di ordine 12 (p=13) come cifrario di sostituzione fisso per le 12 classi di altezza. Ritmo invariato.")
                     transpose_octave = st.slider("Trasposizione (ottave):", -2, 2, 0, key="costas_transpose_compositori")
-                    costas_params = (costas_mode, 12, transpose_octave, 0, 1.0)
+                    costas_params = (costas_mode, 12, transpose_octave, 0, 1.0, "Welch")
 
                 elif costas_mode == "Griglia Ritmica Costas":
-                    costas_order_req = st.slider("Ordine minimo della matrice (n):", 3, 24, 8, key="costas_order_grid_compositori")
-                    _p_preview = _costas_find_prime(costas_order_req)
-                    st.caption(f"Ordine effettivo: n = {_p_preview - 1} (primo p = {_p_preview})")
-                    costas_params = (costas_mode, costas_order_req, 0, 0, 1.0)
+                    costas_order_req = st.slider("Ordine minimo della matrice (n):", 3, 2048, 8, key="costas_order_grid_compositori")
+                    costas_construction = st.selectbox("Costruzione:", COSTAS_CONSTRUCTIONS, key="costas_construction_grid_compositori")
+                    _c_preview, _q_preview = _costas_order_candidates(costas_order_req, costas_construction)
+                    st.caption(f"Ordine effettivo: n = {_q_preview - (1 if _c_preview == 'Welch' else 2)} ({_c_preview}, q = {_q_preview})")
+                    costas_grid_mode = st.radio("Permutazione:", COSTAS_GRID_MODES, horizontal=True, key="costas_grid_mode_compositori",
+                                                help="'Onset + pitch (2D)': anche le altezze di ogni blocco seguono la matrice (tempo x altezza).")
+                    costas_params = (costas_mode, costas_order_req, costas_grid_mode, 0, 1.0, costas_construction)
 
                 else:  # Generatore Costas (Nuova Melodia)
-                    costas_order_req = st.slider("Ordine minimo della matrice (n):", 3, 24, 12, key="costas_order_gen_compositori")
-                    _p_preview = _costas_find_prime(costas_order_req)
-                    st.caption(f"Ordine effettivo: n = {_p_preview - 1} (primo p = {_p_preview})")
+                    costas_order_req = st.slider("Ordine minimo della matrice (n):", 3, 128, 12, key="costas_order_gen_compositori")
+                    costas_construction = st.selectbox("Costruzione:", COSTAS_CONSTRUCTIONS, key="costas_construction_gen_compositori")
+                    _c_preview, _q_preview = _costas_order_candidates(costas_order_req, costas_construction)
+                    st.caption(f"Ordine effettivo: n = {_q_preview - (1 if _c_preview == 'Welch' else 2)} ({_c_preview}, q = {_q_preview})")
                     col_c1, col_c2 = st.columns(2)
                     with col_c1:
                         base_pitch = st.slider("Pitch base (MIDI):", 24, 96, 60, key="costas_base_pitch_compositori")
                     with col_c2:
                         pitch_range_semitones = st.slider("Estensione (semitoni):", 6, 48, 24, key="costas_pitch_range_compositori")
                     step_beats = st.slider("Durata di ogni passo (in battute/beat):", 0.125, 2.0, 0.25, 0.125, key="costas_step_beats_compositori")
-                    costas_params = (costas_mode, costas_order_req, base_pitch, pitch_range_semitones, step_beats)
+                    costas_params = (costas_mode, costas_order_req, base_pitch, pitch_range_semitones, step_beats, costas_construction)
 
                 if st.button("🧮 Applica Costas Sequencer", type="primary", use_container_width=True, key="btn_costas"):
-                    with st.spinner("Generando la matrice di Costas (costruzione di Welch)..."):
-                        cmode, corder, cp1, cp2, cp3 = costas_params
+                    with st.spinner("Generando la matrice di Costas..."):
+                        cmode, corder, cp1, cp2, cp3, cconstruction = costas_params
                         if cmode == "Permutazione Pitch (Cromatica)":
                             result_midi, costas_info = midi_costas_pitch_permutation(midi_data, transpose_octave=cp1)
                         elif cmode == "Griglia Ritmica Costas":
-                            result_midi, costas_info = midi_costas_rhythmic_grid(midi_data, corder)
+                            result_midi, costas_info = midi_costas_rhythmic_grid(midi_data, corder, construction=cconstruction, grid_mode=cp1)
                         else:
-                            result_midi, costas_info = midi_costas_generator(midi_data, corder, cp1, cp2, cp3)
+                            result_midi, costas_info = midi_costas_generator(midi_data, corder, cp1, cp2, cp3, streaming=True, construction=cconstruction)
 
+                        result_midi = prepare_export(result_midi, export_ppq, export_optimize)
                         midi_out_bytes = io.BytesIO()
-                        result_midi.save(file=midi_out_bytes)
+                        save_midi_file(result_midi, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Costas.mid"
@@ -2998,7 +5131,7 @@ if uploaded_midi_file is not None:
                         )
                         st.session_state.midi_ready = True
                         n_costas, p_costas, g_costas = costas_info
-                        st.success(f"✅ Costas Sequencer applicato! Ordine effettivo n={n_costas} (p={p_costas}, g={g_costas})")
+                        st.success(f"✅ Costas Sequencer applicato! Ordine effettivo n={n_costas} (q={p_costas}, g={g_costas})")
 
         else:  # 🔧 Avanzato
             st.markdown("#### Metodi di Decomposizione")
@@ -3011,17 +5144,31 @@ if uploaded_midi_file is not None:
                 if selected_method == "MIDI Note Remapper":
                     col1_remap, col2_remap = st.columns(2)
                     with col1_remap:
-                        target_scale = st.selectbox("Scala Target:", ["Cromatica", "Maggiore", "Minore Naturale", "Pentatonica Maggiore", "Blues"], key=f"remap_scale_{selected_method}")
+                        target_scale = st.selectbox("Scala Target:", ["Cromatica", "Maggiore", "Minore Naturale", "Pentatonica Maggiore", "Blues", "Auto (modo rilevato)"], key=f"remap_scale_{selected_method}")
                     with col2_remap:
-                        target_key = st.selectbox("Tonalità Target:", ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B','Cm', 'C#m', 'Dm', 'D#m', 'Em', 'Fm', 'F#m', 'Gm', 'G#m', 'Am', 'A#m', 'Bm'], index=0, key=f"remap_key_{selected_method}")
+                        target_key = st.selectbox("Tonalità Target:", ["Auto (tonalità globale)", "Auto (segue le modulazioni)", 'C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B','Cm', 'C#m', 'Dm', 'D#m', 'Em', 'Fm', 'F#m', 'Gm', 'G#m', 'Am', 'A#m', 'Bm'], index=2, key=f"remap_key_{selected_method}")
+                    if target_key.startswith("Auto"):
+                        st.caption(f"Tonalita' rilevata: {key_index_name(global_key(midi_data))}")
                     pitch_shift_range = st.slider("Range Pitch Shift Randomico (semitoni):", 0, 12, 0, key=f"remap_pitch_shift_{selected_method}")
                     velocity_randomization = st.slider("Percentuale Randomizzazione Velocity:", 0, 100, 0, key=f"remap_velocity_{selected_method}")
                     parameters[selected_method] = (target_scale, target_key, int(pitch_shift_range), int(velocity_randomization))
 
                 elif selected_method == "MIDI Phrase Reconstructor":
-                    phrase_length_beats = st.slider("Lunghezza Frase (battute):", 1, 16, 4, key=f"phrase_length_{selected_method}")
+                    phrase_length_auto = st.checkbox("Lunghezza frase automatica (dalla metrica rilevata)", value=False, key=f"phrase_length_auto_{selected_method}")
+                    if phrase_length_auto:
+                        _meter = detect_meter(midi_data)
+                        st.caption(f"Metrica rilevata: {_meter['numerator']}/{_meter['denominator']} | Frase: {_meter['phrase_bars']} battute")
+                        phrase_length_beats = "auto"
+                    else:
+                        phrase_length_beats = st.slider("Lunghezza Frase (battute):", 1, 16, 4, key=f"phrase_length_{selected_method}")
                     reassembly_style = st.selectbox("Stile Riorganizzazione Frasi:", ["Casuale", "Inversione", "Ciclico A-B-A", "Dal Più Corto al Più Lungo"], index=0, key=f"phrase_style_{selected_method}")
-                    parameters[selected_method] = (phrase_length_beats, reassembly_style)
+                    col1_phrase, col2_phrase = st.columns(2)
+                    with col1_phrase:
+                        phrase_segmentation = st.selectbox("Segmentazione:", ["Beat fissi", "Griglia di battuta (dal file)", "Griglia di battuta (rilevata)"], key=f"phrase_segmentation_{selected_method}",
+                                                           help="'Griglia di battuta' conta la lunghezza in battute seguendo i cambi di metrica (time_signature) del file, oppure la metrica e la fase rilevate dagli attacchi.")
+                    with col2_phrase:
+                        phrase_boundary_notes = st.selectbox("Note a cavallo delle frasi:", ["Spezza", "Chiudi al confine"], key=f"phrase_boundary_{selected_method}")
+                    parameters[selected_method] = (phrase_length_beats, reassembly_style, phrase_segmentation, phrase_boundary_notes)
 
                 elif selected_method == "MIDI Time Scrambler":
                     keep_original_duration = st.checkbox("Mantieni Durata Originale", key=f"time_keep_duration_{selected_method}")
@@ -3034,18 +5181,38 @@ if uploaded_midi_file is not None:
                     stretch_factor = st.slider("Fattore di Stiramento/Compressione (Time Warp):", 0.1, 5.0, default_stretch_factor, 0.1, key=f"time_stretch_factor_{selected_method}")
                     quantization_strength = st.slider("Forza Quantizzazione (0=libero, 100=rigido):", 0, 100, 50, key=f"time_quant_strength_{selected_method}")
                     swing_amount = st.slider("Quantità di Swing (%):", 0, 100, 0, key=f"time_swing_amount_{selected_method}")
+                    col1_grid, col2_grid = st.columns(2)
+                    with col1_grid:
+                        quant_grid = st.selectbox("Griglia di Quantizzazione:", list(TIME_GRIDS.keys()), index=1, key=f"time_grid_{selected_method}")
+                    with col2_grid:
+                        swing_curve_input = st.text_input("Curva di Swing per beat (%, opzionale, es. '50, 70, 50, 90'):", value="", key=f"time_swing_curve_{selected_method}",
+                                                          help="Un valore per ogni beat, ripetuto ciclicamente. Se vuoto si usa la Quantità di Swing uniforme.")
+                    swing_curve = parse_swing_curve(swing_curve_input) or None
+                    groove_file = st.file_uploader("Groove Template (MIDI di riferimento, opzionale):", type=["mid", "midi"], key=f"time_groove_file_{selected_method}")
+                    groove_template = None
+                    if groove_file is not None:
+                        groove_template = extract_groove_template(mido.MidiFile(file=groove_file), quant_grid)
+                        st.caption(f"Groove estratto da '{groove_file.name}': {len(groove_template)} posizioni per battuta")
+                    stretch_mode = st.selectbox("Modalità Stretch:", ["Automatico (tempo map)", "Riscrivi tick"], key=f"time_stretch_mode_{selected_method}",
+                                                help="'Automatico' scala solo i set_tempo (note intatte) quando non c'è quantizzazione; altrimenti riscrive i tick di ogni evento.")
                     if keep_original_duration: stretch_factor = 1.0
-                    parameters[selected_method] = (stretch_factor, quantization_strength, swing_amount)
+                    parameters[selected_method] = (stretch_factor, quantization_strength, swing_amount, quant_grid, swing_curve, groove_template, stretch_mode)
 
                 elif selected_method == "MIDI Density Transformer":
                     add_note_probability = st.slider("Probabilità di Aggiungere Note (%):", 0, 50, 0, key=f"density_add_prob_{selected_method}")
                     remove_note_probability = st.slider("Probabilità di Rimuovere Note (%):", 0, 50, 0, key=f"density_remove_prob_{selected_method}")
                     polyphony_mode = st.selectbox("Modalità Polifonia Aggiuntiva:", ["Nessuna", "Riempi Accordo (Triadi)", "Aggiungi Contro-Melodia", "Droni"], key=f"density_poly_mode_{selected_method}")
-                    parameters[selected_method] = (add_note_probability, remove_note_probability, polyphony_mode)
+                    density_key_aware = st.checkbox("Armonizza nella tonalità locale rilevata", value=True, key=f"density_key_aware_{selected_method}",
+                                                    help="Triadi, contro-melodia e drone vengono agganciati alla tonalità rilevata nel brano (profili di Krumhansl) invece di usare intervalli cromatici fissi.")
+                    parameters[selected_method] = (add_note_probability, remove_note_probability, polyphony_mode, density_key_aware)
 
                 elif selected_method == "MIDI Random Pitch Transformer":
                     random_pitch_strength = st.slider("Forza Randomizzazione Pitch (%):", 0, 100, 100, key=f"random_pitch_strength_{selected_method}")
-                    parameters[selected_method] = (random_pitch_strength,)
+                    random_pitch_distribution = st.selectbox("Distribuzione dei nuovi pitch:", RANDOM_PITCH_DISTRIBUTIONS, key=f"random_pitch_dist_{selected_method}")
+                    random_pitch_sigma = 7
+                    if random_pitch_distribution == "Gaussiana attorno all'originale":
+                        random_pitch_sigma = st.slider("Deviazione gaussiana (semitoni):", 1, 24, 7, key=f"random_pitch_sigma_{selected_method}")
+                    parameters[selected_method] = (random_pitch_strength, random_pitch_distribution, random_pitch_sigma)
 
                 elif selected_method == "MIDI Rhythmic Base":
                     st.markdown("Seleziona gli elementi ritmici per costruire il tuo pattern:")
@@ -3055,9 +5222,12 @@ if uploaded_midi_file is not None:
                         snare_enabled = st.checkbox("Rullante", value=True, key="rhythm_snare")
                         hihat_enabled = st.checkbox("Hi-hat", value=True, key="rhythm_hihat")
                     with col_rhythm2:
-                        time_signature = st.text_input("Metrica (es. '4/4', '3/4', '5/8'):", value="4/4", key=f"rhythm_time_sig_{selected_method}")
-                        rhythmic_pattern_style = st.selectbox("Stile Pattern Ritmico:", ["Pattern Adattivo", "Pattern Fisso (Pop/Rock)", "Pattern Casuale"], key=f"rhythm_pattern_style_{selected_method}")
-                    parameters[selected_method] = (kick_enabled, snare_enabled, hihat_enabled, time_signature, rhythmic_pattern_style)
+                        time_signature = st.text_input("Metrica (es. '4/4', '3/4', '5/8' o 'auto'):", value="4/4", key=f"rhythm_time_sig_{selected_method}",
+                                                       help="'auto' usa metrica e fase delle battute rilevate dagli attacchi del brano.")
+                        rhythmic_pattern_style = st.selectbox("Stile Pattern Ritmico:", RHYTHMIC_PATTERN_STYLES, key=f"rhythm_pattern_style_{selected_method}")
+                        follow_time_signature = st.checkbox("Segui i cambi di metrica del file", value=True, key=f"rhythm_follow_ts_{selected_method}",
+                                                            help="Se il file contiene time_signature, la base ritmica li segue; la metrica sopra vale dove il file non ne dichiara.")
+                    parameters[selected_method] = (kick_enabled, snare_enabled, hihat_enabled, time_signature, rhythmic_pattern_style, follow_time_signature)
 
                 elif selected_method == "MIDI Recomposer":
                     recomposer_style_adv = st.selectbox(
@@ -3087,12 +5257,14 @@ if uploaded_midi_file is not None:
                         elif method_key == "MIDI Recomposer":
                             recompose_style = method_params[0] if method_params else "minimal"
                             current_midi = midi_recomposer(current_midi, recompose_style)
-                    decomposed_midi_file = current_midi
+                        # le tracce passate intatte restano condivise, le nuove diventano in sola lettura
+                        share_tracks(current_midi)
+                    decomposed_midi_file = prepare_export(current_midi, export_ppq, export_optimize)
 
                     if decomposed_midi_file:
                         st.success("Decomposizione MIDI completata!")
                         midi_out_bytes = io.BytesIO()
-                        decomposed_midi_file.save(file=midi_out_bytes)
+                        save_midi_file(decomposed_midi_file, midi_out_bytes, note_off_as_note_on=export_optimize)
                         midi_out_bytes.seek(0)
                         st.session_state.midi_bytes    = midi_out_bytes.getvalue()
                         st.session_state.midi_filename = f"{uploaded_midi_file.name.split('.')[0]}_Decomposed.mid"
@@ -0,0 +1,76 @@
+import mido
+import numpy as np
+
+import app
+
+
+def _controller_events(track):
+    tick, events = 0, []
+    for msg in track:
+        tick += msg.time
+        if msg.type == 'control_change':
+            events.append((tick, msg.channel, msg.control, msg.value))
+    return events
+
+
+def test_thinning_keeps_rpn_burst_and_channel_mode_messages():
+    track = mido.MidiTrack()
+    # RPN 0 (pitch bend range = 12) poi RPN 1 (fine tuning) a tick 0
+    for control, value in [(101, 0), (100, 0), (6, 12), (38, 0), (101, 0), (100, 1), (6, 12), (38, 0)]:
+        track.append(mido.Message('control_change', control=control, value=value, time=0))
+    track.append(mido.Message('note_on', note=60, velocity=90, time=0))
+    track.append(mido.Message('note_on', note=62, velocity=90, time=0))
+    for i in range(32):
+        track.append(mido.Message('control_change', control=7, value=100 + (i % 2), time=10))
+    # due All Notes Off ripetuti: il secondo chiude la nota 62 ritriggerata
+    track.append(mido.Message('control_change', control=123, value=0, time=10))
+    track.append(mido.Message('note_on', note=62, velocity=90, time=10))
+    track.append(mido.Message('control_change', control=123, value=0, time=10))
+    # dopo un Reset All Controllers lo stesso valore di CC 7 va riscritto
+    track.append(mido.Message('control_change', control=121, value=0, time=10))
+    track.append(mido.Message('control_change', control=7, value=101, time=10))
+    midi = mido.MidiFile(ticks_per_beat=480)
+    midi.tracks.append(track)
+
+    thinned = app.thin_controller_curves(midi, tolerance=2).tracks[0]
+
+    before = [e for e in _controller_events(track) if e[2] != 7]
+    after = [e for e in _controller_events(thinned) if e[2] != 7]
+    assert after == before
+    volume = [e for e in _controller_events(thinned) if e[2] == 7]
+    assert volume[-1] == _controller_events(track)[-1]
+    assert len(volume) < 33
+    assert sum(msg.time for msg in thinned) == sum(msg.time for msg in track)
+
+
+def test_thinning_bounds_held_value_error():
+    track = mido.MidiTrack()
+    values = np.round(63 + 63 * np.sin(np.arange(2000) / 50)).astype(int)
+    for v in values:
+        track.append(mido.Message('control_change', control=11, value=int(v), time=5))
+    midi = mido.MidiFile(ticks_per_beat=480)
+    midi.tracks.append(track)
+
+    keep = app.thin_controller_rows(app.message_table(track), 3)
+    held = np.maximum.accumulate(np.where(keep, np.arange(values.size), 0))
+    assert np.all(np.abs(values - values[held]) <= 3)
+    assert keep.sum() < values.size // 3
+
+
+def test_tempo_map_stretch_scales_tempo_outside_conductor_track():
+    midi = mido.MidiFile(ticks_per_beat=480, type=1)
+    conductor = mido.MidiTrack([mido.MetaMessage('time_signature', numerator=4, denominator=4, time=0)])
+    part = mido.MidiTrack([
+        mido.MetaMessage('set_tempo', tempo=400000, time=0),
+        mido.Message('note_on', note=60, velocity=90, time=0),
+        mido.Message('note_off', note=60, velocity=0, time=480 * 8),
+        mido.MetaMessage('set_tempo', tempo=600000, time=0),
+        mido.Message('note_on', note=64, velocity=90, time=0),
+        mido.Message('note_off', note=64, velocity=0, time=480 * 8),
+    ])
+    midi.tracks.extend([conductor, part])
+
+    stretched = app.midi_time_scrambler(midi, 2.0, 0, 0)
+
+    assert abs(stretched.length - 2 * midi.length) < 1e-6
+    assert not any(msg.type == 'set_tempo' for msg in stretched.tracks[0])